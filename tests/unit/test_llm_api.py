@@ -0,0 +1,757 @@
+"""Unit tests for the LLM API client."""
+
+import asyncio
+import multiprocessing
+import threading
+import time
+import pytest
+from tools import llm_api
+from tools.llm_api import (
+    AdaptiveConcurrencyLimiter,
+    CacheEntry,
+    HedgeBudget,
+    LLMClient,
+    create_llm_client,
+    get_config,
+    MemoryResponseCache,
+    NearDuplicateIndex,
+    QueryResult,
+    RateLimiter,
+    ResponseCache,
+    SharedRateLimiter,
+    SingleFlight,
+    canonicalize_prompt,
+    get_near_duplicate_index,
+    get_response_cache,
+    query_llm
+)
+
+@pytest.fixture
+def cache_path(tmp_path, monkeypatch):
+    """Point the response cache at a fresh database."""
+    path = tmp_path / "cache" / "responses.db"
+    monkeypatch.setenv("LLM_CACHE_PATH", str(path))
+    monkeypatch.setattr(llm_api, "_response_caches", {})
+    monkeypatch.setattr(llm_api, "memory_response_cache", MemoryResponseCache())
+    monkeypatch.setenv("LLM_RATE_LIMIT_DIR", str(tmp_path / "rate_limits"))
+    monkeypatch.setattr(llm_api, "_shared_limiters", {})
+    monkeypatch.setattr(llm_api, "request_flights", SingleFlight())
+    monkeypatch.setenv("LLM_CONFIG_PATH", str(tmp_path / "llm_config.json"))
+    monkeypatch.setattr(llm_api, "_configs", {})
+    monkeypatch.setattr(llm_api, "_clients", {})
+    monkeypatch.setattr(llm_api, "query_timings", llm_api.QueryTimings())
+    monkeypatch.setattr(llm_api, "_near_duplicate_indexes", {})
+    monkeypatch.setattr(llm_api, "_hedge_budgets", {})
+    monkeypatch.setattr(llm_api, "_concurrency_limiters", {})
+    return path
+
+@pytest.fixture
+def provider_calls(monkeypatch):
+    """Count fresh provider queries and answer them with a fixed response."""
+    calls = []
+    def fake_query(self, prompt):
+        calls.append(prompt)
+        return f"answer to {prompt}"
+    monkeypatch.setattr(LLMClient, "_query_provider", fake_query)
+    return calls
+
+def put_from_child(path):
+    """Store a response from another process."""
+    cache = ResponseCache(path)
+    cache.put(ResponseCache.key("openai", "gpt-4o", "shared"), "from child", "openai", "gpt-4o")
+    cache.close()
+
+def admit_from_child(path, attempts, admitted):
+    """Try to make requests against a shared limit from another process."""
+    limiter = SharedRateLimiter(path, 60)
+    with admitted.get_lock():
+        admitted.value += sum(limiter.can_make_request() for _ in range(attempts))
+
+def test_repeated_prompts_are_served_from_cache(cache_path, provider_calls):
+    """A second client (e.g. a later CLI run) gets the cached response."""
+    assert LLMClient("openai", "gpt-4o").query("plan it") == "answer to plan it"
+    assert LLMClient("openai", "gpt-4o").query("plan it") == "answer to plan it"
+    assert LLMClient("openai", "gpt-4o-mini").query("plan it") == "answer to plan it"
+    assert provider_calls == ["plan it", "plan it"]
+
+    # The second lookup was answered in memory, before the database
+    stats = get_response_cache().stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (0, 2, 2)
+    assert llm_api.memory_response_cache.stats()["hits"] == 1
+    assert cache_path.exists()
+
+    # A later run starts with an empty memory cache and reads the database
+    llm_api.memory_response_cache.clear()
+    assert LLMClient("openai", "gpt-4o").query("plan it") == "answer to plan it"
+    assert get_response_cache().stats()["hits"] == 1
+    assert len(provider_calls) == 2
+
+def test_cache_honors_ttl_and_can_be_disabled(cache_path, provider_calls, monkeypatch):
+    """Expired entries are refetched; a zero TTL or disabled cache skips it."""
+    cache = ResponseCache(cache_path)
+    key = ResponseCache.key("openai", None, "p")
+    cache.put(key, "old", "openai")
+    assert cache.get(key, ttl=60) == "old"
+    assert cache.get(key, ttl=0) is None
+    assert cache.get(key, ttl=60) is None
+    assert cache.stats()["expired"] == 1
+
+    client = LLMClient("openai", "gpt-4o")
+    client.config.config["providers"]["openai"] = {"cache_ttl": 0}
+    client.query("q")
+    client.config.config["cache_enabled"] = False
+    client.query("q")
+    assert provider_calls == ["q", "q"]
+    assert get_response_cache().stats()["entries"] == 0
+
+def test_cache_evicts_least_recently_used(cache_path):
+    """Once over max_bytes, the least recently read responses go first."""
+    cache = ResponseCache(cache_path, max_bytes=250)
+    for name in ("a", "b", "c"):
+        cache.put(name, name * 100, "openai")
+    assert cache.get("a", ttl=60) is None
+    assert cache.get("b", ttl=60) == "b" * 100
+    cache.put("d", "d" * 100, "openai")
+    assert cache.get("c", ttl=60) is None
+    assert cache.get("b", ttl=60) is not None
+    stats = cache.stats()
+    assert stats["evictions"] == 2
+    assert stats["bytes"] == 200
+
+def test_cache_keeps_a_running_byte_total(cache_path):
+    """The byte total follows replacements, expiry and invalidation without scans."""
+    cache = ResponseCache(cache_path)
+    cache.put("a", "a" * 100, "openai")
+    cache.put("a", "a" * 40, "openai")
+    cache.put("b", "b" * 10, "anthropic")
+    assert cache.stats()["bytes"] == 50
+    assert cache.get("b", ttl=0) is None
+    assert cache.stats()["bytes"] == 40
+    cache.put("c", "c" * 5, "anthropic")
+    assert cache.invalidate(provider="openai") == 1
+    assert cache.stats()["bytes"] == 5
+    cache.close()
+    # Reopening keeps the stored total rather than rescanning
+    assert ResponseCache(cache_path).stats()["bytes"] == 5
+
+def test_cache_is_shared_across_processes(cache_path):
+    """Responses stored by one process are hits in another."""
+    cache_path.parent.mkdir(parents=True)
+    ResponseCache(cache_path).close()
+    process = multiprocessing.get_context("spawn").Process(target=put_from_child, args=(cache_path,))
+    process.start()
+    process.join(60)
+    assert process.exitcode == 0
+    cache = ResponseCache(cache_path)
+    assert cache.get(ResponseCache.key("openai", "gpt-4o", "shared"), ttl=60) == "from child"
+
+def make_entry(response, ttl=60.0, latency=0.5, provider="openai", model="gpt-4o"):
+    """Create a memory cache entry."""
+    now = time.time()
+    return CacheEntry(response, provider, model, now, now + ttl, latency, len(response))
+
+def test_query_llm_reuses_responses_across_clients(cache_path, provider_calls):
+    """query_llm builds a client per call but shares one in-process cache."""
+    assert query_llm("hello", provider="openai") == "answer to hello"
+    assert query_llm("  hello \r\n", provider="openai") == "answer to hello"
+    assert query_llm("hello", provider="openai", model="other") == "answer to hello"
+    client = LLMClient("openai", None)
+    client.query("hello", temperature=0.2)
+    client.query("hello", temperature=0.2)
+    assert provider_calls == ["hello", "hello", "hello"]
+
+    stats = llm_api.memory_response_cache.stats()
+    assert (stats["hits"], stats["entries"]) == (2, 3)
+    entry = llm_api.memory_response_cache.entry(client._get_cache_key("hello", {"temperature": 0.2}))
+    assert entry.hits == 1 and entry.latency >= 0 and entry.provider == "openai"
+
+    assert client.invalidate("hello", temperature=0.2) == 1
+    client.query("hello", temperature=0.2)
+    assert len(provider_calls) == 4
+    assert LLMClient("openai", "other").invalidate() == 1
+    assert llm_api.memory_response_cache.stats()["entries"] == 2
+
+def test_memory_cache_ttl_bytes_and_metadata():
+    """Entries expire, the byte bound evicts LRU entries, hits add up saved time."""
+    cache = MemoryResponseCache(max_bytes=25)
+    cache.put("a", make_entry("a" * 10, latency=2.0))
+    cache.put("b", make_entry("b" * 10))
+    assert cache.get("a").response == "a" * 10
+    cache.put("c", make_entry("c" * 10))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    cache.put("huge", make_entry("x" * 100))
+    assert cache.entry("huge") is None
+
+    cache.put("short", make_entry("s", ttl=0.01))
+    time.sleep(0.02)
+    assert cache.get("short") is None
+    stats = cache.stats()
+    assert stats["expired"] == 1 and stats["evictions"] == 1
+    assert stats["latency_saved"] == 4.0
+    assert stats["bytes"] == 20 and stats["entries"] == 2
+    assert cache.invalidate(provider="openai") == 2 and cache.stats()["bytes"] == 0
+
+def test_memory_cache_is_thread_safe():
+    """Concurrent gets, puts and invalidations keep the byte accounting exact."""
+    cache = MemoryResponseCache(max_bytes=500)
+    def worker(n):
+        for i in range(2000):
+            key = f"k{(n * 7 + i) % 97}"
+            if cache.get(key) is None:
+                cache.put(key, make_entry("v" * (i % 23 + 1)))
+            if i % 500 == 0:
+                cache.invalidate(key)
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = cache.stats()
+    assert stats["hits"] + stats["misses"] == 16 * 2000
+    assert stats["bytes"] == sum(cache.entry(key).size for key in list(cache._entries)) <= 500
+
+def test_rate_limiter_allows_a_minute_of_burst_then_exact_waits():
+    """Admission allows one minute's budget at once, then says exactly how long to wait."""
+    limiter = RateLimiter(60)
+    assert all(limiter.can_make_request() for _ in range(60))
+    assert not limiter.can_make_request()
+    assert limiter.reserve() == pytest.approx(1.0, abs=0.05)
+    assert limiter.reserve() == pytest.approx(2.0, abs=0.05)
+
+    tokens = RateLimiter(None, tokens_per_minute=1000)
+    assert tokens.can_make_request(tokens=600)
+    assert not tokens.can_make_request(tokens=600)
+    assert tokens.can_make_request(tokens=400)
+    tokens.record_tokens(100)
+    assert tokens.reserve(tokens=50) == pytest.approx(9.0, abs=0.05)
+    # A request larger than the whole budget waits for a full minute, not forever
+    assert RateLimiter(None, 10).reserve(tokens=10_000) == 0
+    assert RateLimiter(0).can_make_request()
+
+def test_rate_limiter_sleeps_until_available_sync_and_async():
+    """Throttled callers sleep once, for exactly their slot."""
+    limiter = RateLimiter(600)
+    for _ in range(600):
+        limiter.can_make_request()
+    start = time.monotonic()
+    limiter.acquire()
+    assert 0.08 <= time.monotonic() - start < 0.3
+
+    async def burst():
+        return await asyncio.gather(*(limiter.acquire_async() for _ in range(3)))
+    start = time.monotonic()
+    delays = asyncio.run(burst())
+    assert delays == pytest.approx([0.1, 0.2, 0.3], abs=0.05)
+    assert 0.25 <= time.monotonic() - start < 0.6
+
+@pytest.mark.skipif(llm_api.fcntl is None, reason="needs flock")
+def test_shared_rate_limiter_spans_processes(tmp_path):
+    """Worker processes share one budget instead of each getting the full limit."""
+    path = tmp_path / "openai.state"
+    context = multiprocessing.get_context("spawn")
+    admitted = context.Value("i", 0)
+    workers = [context.Process(target=admit_from_child, args=(path, 40, admitted)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+    assert [worker.exitcode for worker in workers] == [0] * 4
+    assert admitted.value == 60
+
+    limiter = SharedRateLimiter(path, 60)
+    assert not limiter.can_make_request()
+    usage = limiter.utilization()
+    # The window is full up to the time that has passed since the burst
+    assert 0 < usage["wait"] <= 1.0
+    assert usage["requests"] * 60 == pytest.approx(59 + usage["wait"], abs=0.01)
+    assert (usage["admitted"], usage["throttled"]) == (60, 101)
+
+@pytest.mark.skipif(llm_api.fcntl is None, reason="needs flock")
+def test_shared_rate_limiter_admission_is_fast(tmp_path):
+    """Admission through the shared file stays well under 100 microseconds."""
+    limiter = SharedRateLimiter(tmp_path / "fast.state", None)
+    count = 20_000
+    start = time.perf_counter()
+    for _ in range(count):
+        limiter.can_make_request(tokens=10)
+    per_call = (time.perf_counter() - start) / count
+    assert limiter.utilization()["admitted"] == count
+    assert per_call < 100e-6, f"{per_call * 1e6:.1f}us per admission"
+
+def test_clients_share_the_host_rate_limiter(cache_path):
+    """Clients for one provider draw from the same limiter unless scoped to the process."""
+    first, second = LLMClient("openai", "gpt-4o"), LLMClient("openai", "other")
+    if llm_api.fcntl is not None:
+        assert isinstance(first.rate_limiter, SharedRateLimiter)
+    assert first.rate_limiter is second.rate_limiter
+    client = LLMClient("openai")
+    client.config.config["rate_limit_scope"] = "process"
+    assert type(llm_api.create_rate_limiter(client.config, "openai")) is RateLimiter
+
+def test_concurrent_identical_queries_share_one_request(cache_path, monkeypatch):
+    """Threads asking the same thing at once send a single upstream call."""
+    calls = []
+    def slow_query(self, prompt):
+        calls.append(prompt)
+        time.sleep(0.3)
+        return f"answer to {prompt}"
+    monkeypatch.setattr(LLMClient, "_query_provider", slow_query)
+    barrier = threading.Barrier(8)
+    results = []
+    def ask():
+        client = LLMClient("openai", "gpt-4o")
+        barrier.wait()
+        results.append(client.query("same question"))
+    threads = [threading.Thread(target=ask) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls == ["same question"]
+    assert results == ["answer to same question"] * 8
+    stats = llm_api.request_flights.stats()
+    assert (stats["leaders"], stats["coalesced"], stats["in_flight"]) == (1, 7, 0)
+    assert stats["dedup_rate"] == 7 / 8
+
+def test_single_flight_spans_asyncio_tasks_and_threads():
+    """Tasks and threads join the same flight and share results and errors."""
+    flights = SingleFlight()
+    runs = []
+    async def fetch():
+        runs.append("fetch")
+        await asyncio.sleep(0.2)
+        return "shared"
+    async def fail():
+        runs.append("fail")
+        await asyncio.sleep(0.2)
+        raise ValueError("upstream error")
+    thread_results = []
+    def from_thread():
+        time.sleep(0.05)
+        thread_results.append(flights.do("k", lambda: "not run"))
+
+    async def main():
+        thread = threading.Thread(target=from_thread)
+        thread.start()
+        results = await asyncio.gather(*(flights.do_async("k", fetch) for _ in range(4)))
+        await asyncio.get_running_loop().run_in_executor(None, thread.join)
+        errors = await asyncio.gather(*(flights.do_async("e", fail) for _ in range(3)), return_exceptions=True)
+        return results, errors
+
+    results, errors = asyncio.run(main())
+    assert results == ["shared"] * 4 and thread_results == ["shared"]
+    assert runs == ["fetch", "fail"]
+    assert all(isinstance(error, ValueError) for error in errors)
+    assert flights.stats() == {"leaders": 2, "coalesced": 6, "in_flight": 0, "dedup_rate": 0.75}
+
+def test_query_many_overlaps_requests_and_keeps_errors(cache_path, monkeypatch):
+    """A batch takes about as long as its slowest calls, not their sum."""
+    def slow_query(self, prompt):
+        time.sleep(0.1)
+        if prompt.startswith("bad"):
+            raise RuntimeError(f"failed on {prompt}")
+        return f"answer to {prompt}"
+    monkeypatch.setattr(LLMClient, "_query_provider", slow_query)
+    client = LLMClient("openai", "gpt-4o")
+    client.config.config["rate_limiting_enabled"] = False
+    prompts = [f"bad {i}" if i % 50 == 7 else f"lesson {i}" for i in range(200)]
+    
+    start = time.perf_counter()
+    results = client.query_many(prompts, concurrency=50)
+    assert time.perf_counter() - start < 5
+    assert [result.prompt for result in results] == prompts
+    failed = [result for result in results if not result.ok]
+    assert [result.index for result in failed] == [7, 57, 107, 157]
+    assert isinstance(failed[0].error, RuntimeError)
+    assert results[0] == QueryResult(0, "lesson 0", "answer to lesson 0")
+    
+    async def collect():
+        return [result.index async for result in client.aiter_query_many(prompts[:20], concurrency=4)]
+    assert sorted(asyncio.run(collect())) == list(range(20))
+    with pytest.raises(ValueError):
+        client.query_many(prompts, concurrency=0)
+
+def test_query_many_survives_a_cancelled_request_it_joined(cache_path, monkeypatch):
+    """Cancelling the caller that leads a shared request fails the batch item instead of hanging it."""
+    async def slow_fetch(self, prompt, cache_key, sampling):
+        await asyncio.sleep(0.3)
+        return f"answer to {prompt}"
+    monkeypatch.setattr(LLMClient, "_afetch", slow_fetch)
+    client = LLMClient("openai", "gpt-4o")
+    
+    async def main():
+        leader = asyncio.create_task(client.aquery("same"))
+        await asyncio.sleep(0.05)
+        batch = asyncio.create_task(client.aquery_many(["same", "other"], concurrency=2))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        return await asyncio.wait_for(batch, 3)
+    
+    joined, other = asyncio.run(main())
+    assert isinstance(joined.error, RuntimeError)
+    assert other == QueryResult(1, "other", "answer to other")
+    assert llm_api.request_flights.stats()["in_flight"] == 0
+
+def test_query_many_waits_for_the_rate_limiter(cache_path, provider_calls):
+    """Concurrent batch requests still go through the provider's limit."""
+    client = LLMClient("openai", "gpt-4o")
+    client.rate_limiter = RateLimiter(600)
+    for _ in range(600):
+        client.rate_limiter.can_make_request()
+    start = time.monotonic()
+    results = client.query_many(["a", "b", "c", "d"], concurrency=4, as_completed=True)
+    assert sorted(result.response for result in results) == [f"answer to {p}" for p in "abcd"]
+    assert 0.35 <= time.monotonic() - start < 1.0
+    assert client.rate_limiter.utilization()["throttled"] == 4
+
+def test_clients_are_reused_and_config_reloads_on_change(cache_path, provider_calls, monkeypatch):
+    """Queries share one client per provider and model; editing the config is picked up."""
+    config_file = cache_path.parent.parent / "llm_config.json"
+    loads = []
+    load_config = llm_api.LLMConfig._load_config
+    def counting_load(self):
+        loads.append(self.config_path)
+        return load_config(self)
+    monkeypatch.setattr(llm_api.LLMConfig, "_load_config", counting_load)
+    
+    client = create_llm_client("openai", "gpt-4o")
+    for _ in range(3):
+        query_llm("plan it", provider="openai", model="gpt-4o")
+    assert create_llm_client("openai", "gpt-4o") is client
+    assert create_llm_client("openai", "gpt-4o-mini") is not client
+    assert get_config() is client.config
+    assert len(loads) == 1
+    
+    limiter = client.rate_limiter
+    config_file.write_text('{"providers": {"openai": {"default_model": "gpt-4o", "rate_limit": 5}}}')
+    assert create_llm_client("openai") is client
+    assert len(loads) == 2
+    assert client.rate_limiter is not limiter
+    assert client.rate_limiter.requests_per_minute == 5
+    if isinstance(limiter, SharedRateLimiter):
+        assert limiter._map.closed  # The replaced limiter's file is released...
+        assert limiter.can_make_request()  # ...and reopened if a straggler still uses it
+        limiter.close()
+    assert create_llm_client("openai", "gpt-4o") is client
+    assert len(loads) == 2
+
+def test_stream_yields_chunks_as_they_arrive_and_records_timings(cache_path, monkeypatch):
+    """Chunks reach the caller before the response completes; query buffers the same stream."""
+    def slow_stream(self, prompt):
+        for line in ("[PLAN]\n", "step one\n", "[/PLAN]"):
+            time.sleep(0.05)
+            yield line
+    monkeypatch.setattr(LLMClient, "_stream_provider", slow_stream)
+    client = LLMClient("openai", "gpt-4o")
+    
+    start = time.perf_counter()
+    arrivals = [(chunk, time.perf_counter() - start) for chunk in client.stream("plan it")]
+    assert [chunk for chunk, _ in arrivals] == ["[PLAN]\n", "step one\n", "[/PLAN]"]
+    assert arrivals[0][1] < arrivals[-1][1] - 0.08
+    timings = llm_api.query_timings.stats()["openai/gpt-4o"]
+    assert timings["count"] == 1
+    assert 0.04 <= timings["ttft_p50"] < timings["total_p50"]
+    assert timings["total_p50"] >= 0.14
+    
+    # The streamed response was cached whole; cache hits are not timed
+    assert list(client.stream("plan it")) == ["[PLAN]\nstep one\n[/PLAN]"]
+    assert client.query("plan it") == "[PLAN]\nstep one\n[/PLAN]"
+    assert client.query("other") == "[PLAN]\nstep one\n[/PLAN]"
+    assert llm_api.query_timings.stats()["openai/gpt-4o"]["count"] == 2
+
+def test_streams_joining_an_in_flight_request_get_the_whole_response(cache_path, monkeypatch):
+    """A concurrent identical stream waits for the leader and gets one chunk."""
+    def gated_stream(self, prompt):
+        yield "first "
+        yield "second"
+    monkeypatch.setattr(LLMClient, "_stream_provider", gated_stream)
+    client = LLMClient("openai", "gpt-4o")
+    
+    leader = client.stream("plan it")
+    assert next(leader) == "first "
+    follower = []
+    thread = threading.Thread(target=lambda: follower.extend(client.stream("plan it")))
+    thread.start()
+    deadline = time.monotonic() + 5
+    while llm_api.request_flights.stats()["coalesced"] < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert list(leader) == ["second"]
+    thread.join(5)
+    assert follower == ["first second"]
+    
+    abandoned = LLMClient("openai", "gpt-4o").stream("abandoned")
+    next(abandoned)
+    abandoned.close()
+    assert llm_api.request_flights.stats()["in_flight"] == 0
+
+def status_prompt(updated, tasks=40, changed=None):
+    """A planner prompt embedding a status file, like query_llm_with_plan builds."""
+    lines = [f"- [ ] Task {i}: implement component {i} and cover it with unit tests" for i in range(tasks)]
+    if changed is not None:
+        lines[changed] = f"- [x] Task {changed}: done"
+    return "\n".join(["Project Plan and Status:", f"Last updated: {updated}", *lines, "Plan the next step."])
+
+def test_canonical_prompts_drop_whitespace_and_volatile_lines():
+    """Whitespace and timestamp lines do not change the canonical prompt; other lines do."""
+    patterns = llm_api.DEFAULT_VOLATILE_LINE_PATTERNS
+    first = canonicalize_prompt(status_prompt("2024-05-01 10:00"), patterns)
+    assert canonicalize_prompt(status_prompt("2024-05-02 11:30").replace(": ", ":   ") + "\n\n", patterns) == first
+    assert "Last updated" not in first
+    assert canonicalize_prompt("Time complexity: O(n)\n2024-05-01T10:00:00Z", patterns) == "Time complexity: O(n)"
+    
+    near = llm_api.shingles(canonicalize_prompt(status_prompt("x", changed=3), patterns))
+    base = llm_api.shingles(first)
+    assert 0.9 <= llm_api.jaccard(base, near) < 1
+    assert set(llm_api.lsh_buckets(base)) & set(llm_api.lsh_buckets(near))
+    other = llm_api.shingles("Summarize the release notes for version two of the upload service")
+    assert not set(llm_api.lsh_buckets(base)) & set(llm_api.lsh_buckets(other))
+
+def test_near_duplicate_prompts_reuse_confirmed_cached_responses(cache_path, provider_calls):
+    """With the opt-in layer, edited status prompts above the threshold reuse the cached response."""
+    client = LLMClient("openai", "gpt-4o")
+    client.query(status_prompt("08:00"))
+    client.query(status_prompt("08:30"))
+    assert len(provider_calls) == 2  # The layer is off by default
+    client.config.config["near_duplicate_cache"] = True
+    client.query(status_prompt("09:00"))
+    assert len(provider_calls) == 3
+    
+    # Only the timestamp line differs, then one task line too
+    assert client.query(status_prompt("10:00")) == f"answer to {status_prompt('09:00')}"
+    assert client.query(status_prompt("10:00", changed=5)) == f"answer to {status_prompt('09:00')}"
+    assert len(provider_calls) == 3
+    client.query(status_prompt("10:00", tasks=10))
+    client.query(status_prompt("10:00"), temperature=0.2)
+    assert len(provider_calls) == 5
+    
+    stats = get_near_duplicate_index().stats()
+    assert stats["exact_hits"] == 1
+    assert stats["near_hits"] == 1
+    assert stats["lookups"] == 5
+    assert stats["entries"] == 3
+    assert stats["hit_rate"] == pytest.approx(2 / 5)
+    
+    # Responses that left the cache are dropped from the index, not reused
+    client.invalidate(status_prompt("09:00"))
+    client.query(status_prompt("11:00"))
+    assert len(provider_calls) == 6
+
+def test_near_duplicate_index_sweeps_stale_entries_periodically(cache_path, monkeypatch):
+    """Entries whose responses left the cache are swept every few adds, not on each."""
+    monkeypatch.setattr(NearDuplicateIndex, "SWEEP_EVERY", 3)
+    cache, index = get_response_cache(), get_near_duplicate_index()
+    scope = NearDuplicateIndex.scope("openai", "gpt-4o")
+    for name in ("a", "b", "c"):
+        if name == "c":
+            cache.invalidate(key="a")
+            assert index.stats()["entries"] == 2
+        cache.put(name, f"answer {name}", "openai", "gpt-4o")
+        index.add(scope, name, f"prompt {name}")
+    assert index.stats()["entries"] == 2
+
+def test_near_duplicate_hits_can_be_audited(cache_path, monkeypatch):
+    """Sampled hits are re-queried and disagreements count as false positives."""
+    answers = iter(["the plan is to ship it", "the plan is to ship it", "something else entirely"])
+    monkeypatch.setattr(LLMClient, "_query_provider", lambda self, prompt: next(answers))
+    client = LLMClient("openai", "gpt-4o")
+    client.config.config.update(near_duplicate_cache=True, near_duplicate_audit_rate=1.0)
+    
+    assert client.query(status_prompt("09:00")) == "the plan is to ship it"
+    assert client.query(status_prompt("10:00", changed=1)) == "the plan is to ship it"
+    assert client.query(status_prompt("10:00", changed=2)) == "something else entirely"
+    stats = get_near_duplicate_index().stats()
+    assert stats["audited"] == 2
+    assert stats["audit_mismatches"] == 1
+    assert stats["false_positive_rate"] == 0.5
+
+def test_hedge_budget_caps_the_hedge_rate():
+    """Hedges are earned per request, banked up to the burst."""
+    budget = HedgeBudget(0.25, 2)
+    assert budget.try_spend() and budget.try_spend()
+    assert not budget.try_spend()
+    for _ in range(3):
+        budget.earn()
+    assert not budget.try_spend()
+    budget.earn()
+    assert budget.try_spend()
+    assert budget.stats()["hedged"] == 3
+    assert budget.stats()["denied"] == 2
+
+@pytest.fixture
+def hedged_client(cache_path, monkeypatch):
+    """A client whose slow or failing openai requests are hedged to a fast backup."""
+    def fake_stream(self, prompt):
+        if self.provider == "openai":
+            if "fail" in prompt:
+                raise RuntimeError("openai is down")
+            time.sleep(0.5 if "slow" in prompt else 0.01)
+        yield f"{self.provider} answers {prompt}"
+    monkeypatch.setattr(LLMClient, "_stream_provider", fake_stream)
+    client = LLMClient("openai", "gpt-4o")
+    client.config.config.update(rate_limiting_enabled=False, hedge_min_samples=5, hedge_burst=1)
+    client.config.config["providers"]["openai"] = {"hedge": {"provider": "anthropic", "model": "claude"}}
+    return client
+
+def test_slow_requests_are_hedged_to_the_backup_within_budget(hedged_client):
+    """Past the primary's p95 the backup is tried; the first response wins."""
+    assert hedged_client.query("slow 0") == "openai answers slow 0"  # Too few timings to hedge yet
+    for i in range(20):
+        hedged_client.query(f"fast {i}")
+    assert llm_api.query_timings.percentile("openai", "gpt-4o") < 0.5
+    
+    start = time.monotonic()
+    assert hedged_client.query("slow 1") == "anthropic answers slow 1"
+    assert time.monotonic() - start < 0.45
+    assert hedged_client.query("fast 20") == "openai answers fast 20"
+    # The budget is spent, so the next slow request waits for the primary
+    assert hedged_client.query("slow 2") == "openai answers slow 2"
+    
+    stats = llm_api.hedging_stats()["openai/gpt-4o"]
+    assert stats["hedged"] == 1
+    assert stats["backup_wins"] == 1
+    assert stats["denied"] >= 1
+    assert stats["requests"] == 24
+
+def test_failing_primary_fails_over_to_the_backup(hedged_client):
+    """A primary that errors before responding fails over; without budget the error surfaces."""
+    for i in range(5):
+        hedged_client.query(f"fast {i}")
+    assert asyncio.run(hedged_client.aquery("fail 0")) == "anthropic answers fail 0"
+    with pytest.raises(RuntimeError, match="openai is down"):
+        hedged_client.query("fail 1")
+
+def test_hedges_ignore_our_own_queueing_and_cancelled_requests_never_call(hedged_client, monkeypatch):
+    """The hedge delay runs from the provider call; a cancelled queued request never calls its provider."""
+    for i in range(5):
+        hedged_client.query(f"fast {i}")
+    calls = []
+    fake_stream = LLMClient._stream_provider
+    monkeypatch.setattr(LLMClient, "_stream_provider",
+                        lambda self, prompt: calls.append(self.provider) or fake_stream(self, prompt))
+    limiters = {name: AdaptiveConcurrencyLimiter(name, initial=1) for name in ("openai", "anthropic")}
+    monkeypatch.setattr(LLMClient, "_concurrency_limiter", lambda self: limiters[self.provider])
+
+    # Waiting for a slot far longer than the primary's p95 is not a reason to hedge
+    held = limiters["openai"].acquire()
+    threading.Timer(0.3, limiters["openai"].release, args=(held,)).start()
+    assert hedged_client.query("fast 5") == "openai answers fast 5"
+    assert llm_api.hedging_stats()["openai/gpt-4o"]["hedged"] == 0
+
+    # The backup is still queued when the primary wins, so it gives up there
+    held = limiters["anthropic"].acquire()
+    assert hedged_client.query("slow 0") == "openai answers slow 0"
+    assert llm_api.hedging_stats()["openai/gpt-4o"]["hedged"] == 1
+    limiters["anthropic"].release(held)
+    time.sleep(0.1)
+    assert calls == ["openai", "openai"]
+    assert limiters["anthropic"].stats()["in_flight"] == 0
+
+def test_concurrency_limit_grows_additively_and_shrinks_multiplicatively():
+    """Successes raise the limit, overloads halve it once per window, waiters get freed slots."""
+    limiter = AdaptiveConcurrencyLimiter("openai/gpt-4o", initial=2, min_samples=3)
+    first, second = limiter.acquire(), limiter.acquire()
+    waiter = threading.Thread(target=limiter.acquire)
+    waiter.start()
+    time.sleep(0.05)
+    assert limiter.stats()["waiting"] == 1
+    
+    limiter.release(first, latency=0.1)  # Slow start: one more slot per success
+    waiter.join(1)
+    assert limiter.limit == 3
+    assert limiter.in_flight == 2
+    third = limiter.acquire()
+    limiter.release(second, error=RuntimeError("HTTP 429 Too Many Requests"))
+    assert limiter.limit == 1.5
+    limiter.release(third, error=TimeoutError())  # Started before the cut: no second cut
+    assert limiter.limit == 1.5
+    limiter.release(limiter.clock(), error=ValueError("bad prompt"))  # Not an overload
+    assert limiter.limit == 1.5
+    
+    # Now growth is additive, and only while the limit is what holds requests back
+    limiter.release(limiter.acquire(), latency=0.1)
+    expected = 1.5 + 1 / 1.5
+    assert limiter.limit == pytest.approx(expected)
+    limiter.release(limiter.acquire(), latency=0.1)
+    assert limiter.limit == pytest.approx(expected)
+    held = limiter.acquire()
+    for _ in range(2):
+        limiter.release(limiter.acquire(), latency=0.1)
+        expected += 1 / expected
+    assert limiter.limit == pytest.approx(expected)
+    limiter.release(limiter.acquire(), latency=1.0)
+    assert limiter.limit == pytest.approx(expected / 2)
+    limiter.release(held)
+    stats = limiter.stats()
+    assert (stats["rate_limited"], stats["timeouts"], stats["latency_spikes"], stats["decreases"]) == (1, 1, 1, 2)
+    assert stats["in_flight"] == 0
+    assert not stats["slow_start"]
+
+def test_concurrency_limit_recovers_after_a_sustained_latency_shift():
+    """A lasting step up in latency becomes the new baseline instead of pinning the limit at 1."""
+    limiter = AdaptiveConcurrencyLimiter("openai/gpt-4o", initial=8)
+    for _ in range(50):
+        limiter.release(limiter.acquire(), latency=0.1)
+    for _ in range(300):
+        limiter.release(limiter.acquire(), latency=0.25)
+    stats = limiter.stats()
+    assert stats["latency_spikes"] < 10
+    assert stats["baseline_latency"] == pytest.approx(0.25, rel=0.05)
+    assert limiter.limit >= 2
+    
+    eager = AdaptiveConcurrencyLimiter("openai/gpt-4o-mini", min_samples=0)
+    eager.release(eager.acquire(), latency=0.1)  # No baseline yet: nothing to compare against
+    assert eager.stats()["latency_spikes"] == 0
+
+def test_concurrency_limit_waits_and_cancels_in_asyncio():
+    """Tasks wait in turn; a cancelled waiter does not leak its slot."""
+    limiter = AdaptiveConcurrencyLimiter("openai/gpt-4o", initial=1)
+    
+    async def scenario():
+        held = await limiter.acquire_async()
+        waiting = asyncio.create_task(limiter.acquire_async())
+        cancelled = asyncio.create_task(limiter.acquire_async())
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        limiter.release(held)
+        await asyncio.wait_for(waiting, 1)
+        assert limiter.in_flight == 1
+        limiter.release(waiting.result())
+    asyncio.run(scenario())
+    assert limiter.stats()["in_flight"] == 0
+    assert limiter.stats()["waiting"] == 0
+
+def test_adaptive_concurrency_settles_near_provider_capacity(cache_path, monkeypatch):
+    """Against a provider that answers 429 beyond 8 concurrent requests, the limit converges near 8."""
+    capacity = 8
+    in_flight = [0]
+    lock = threading.Lock()
+    def limited_stream(self, prompt):
+        with lock:
+            in_flight[0] += 1
+            overloaded = in_flight[0] > capacity
+        try:
+            time.sleep(0.002 if overloaded else 0.02)
+            if overloaded:
+                raise RuntimeError("429 Too Many Requests")
+        finally:
+            with lock:
+                in_flight[0] -= 1
+        yield f"answer to {prompt}"
+    monkeypatch.setattr(LLMClient, "_stream_provider", limited_stream)
+    client = LLMClient("openai", "gpt-4o")
+    client.rate_limiter = RateLimiter(0)
+    assert client._concurrency_limiter() is None  # Opt-in
+    client.config.config["adaptive_concurrency"] = True
+    
+    results = client.query_many([f"lesson {i}" for i in range(400)], concurrency=64)
+    failed = [result for result in results if not result.ok]
+    stats = llm_api.concurrency_stats()["openai/gpt-4o"]
+    assert len(failed) < 40
+    assert stats["rate_limited"] == len(failed)
+    assert stats["decreases"] >= 1
+    assert capacity / 2 <= stats["limit"] <= capacity * 1.5
+    assert stats["in_flight"] == 0
+    
+    from tools.token_tracker import usage_metrics
+    assert 'llm_concurrency_limit{provider="openai",model="gpt-4o"}' in usage_metrics.exposition()
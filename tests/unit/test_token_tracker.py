@@ -0,0 +1,895 @@
+"""Unit tests for the token usage tracker."""
+
+import gc
+import io
+import math
+import json
+import os
+import threading
+import urllib.request
+import weakref
+import time
+import multiprocessing
+import pytest
+from tools import token_tracker
+from tools.token_tracker import (
+    APIResponse,
+    BackgroundLogWriter,
+    FlushSettings,
+    ModelPrice,
+    PricingRegistry,
+    RequestColumns,
+    RotationSettings,
+    SqliteUsageStore,
+    TokenTracker,
+    TokenUsage,
+    UsageMetrics,
+    UsageRollup,
+    compact_session,
+    compact_segments,
+    display_session_analytics,
+    find_session_files,
+    list_sessions,
+    get_token_tracker,
+    iter_all_requests,
+    iter_session_requests,
+    load_session,
+    parse_time,
+    read_manifest,
+    read_rollups,
+    rebuild_manifest,
+    recost_session,
+    segment_time_range,
+    session_segments,
+    start_metrics_server,
+    upgrade_sessions,
+    write_rollup,
+    write_segment
+)
+
+# Benchmarks at full size take a while; run them with RUN_SLOW_TESTS=1
+slow = pytest.mark.skipif(not os.environ.get("RUN_SLOW_TESTS"), reason="slow benchmark, set RUN_SLOW_TESTS=1")
+
+def make_response(provider="openai", model="gpt-4o", prompt=10, completion=20, cost=0.5, thinking_time=1.0):
+    """Create an APIResponse for tracking."""
+    return APIResponse(
+        content="ok",
+        token_usage=TokenUsage(prompt, completion, prompt + completion),
+        cost=cost,
+        thinking_time=thinking_time,
+        provider=provider,
+        model=model
+    )
+
+@pytest.fixture
+def logs_dir(tmp_path):
+    """Create an empty token logs directory."""
+    path = tmp_path / "token_logs"
+    path.mkdir()
+    return path
+
+def test_track_request_appends_one_line(logs_dir):
+    """Each tracked request is appended as a single JSONL line."""
+    tracker = TokenTracker("s1", logs_dir=logs_dir)
+    tracker.track_request(make_response())
+    tracker.track_request(make_response(provider="anthropic", model="claude-3-sonnet-20240229"))
+
+    lines = tracker.shard_file.read_text().splitlines()
+    assert tracker.shard_file.name == f"session_s1.p{os.getpid()}.jsonl"
+    assert len(lines) == 2
+    assert json.loads(lines[1])["provider"] == "anthropic"
+
+    tracker.flush()
+    sidecar = json.loads((logs_dir / "session_s1.summary.json").read_text())
+    assert sidecar["summary"]["total_requests"] == 2
+    assert "requests" not in sidecar
+
+def test_load_session_rebuilds_from_log(logs_dir):
+    """load_session rebuilds requests and summary from the JSONL log."""
+    tracker = TokenTracker("s1", logs_dir=logs_dir)
+    for _ in range(3):
+        tracker.track_request(make_response())
+    (logs_dir / "session_s1.summary.json").unlink()
+    with open(tracker.shard_file, "a") as f:
+        f.write('{"torn": ')
+
+    data = load_session(logs_dir / "session_s1.jsonl")
+    assert data["session_id"] == "s1"
+    assert len(data["requests"]) == 3
+    assert data["summary"]["total_tokens"] == 90
+    assert data["summary"]["total_cost"] == pytest.approx(1.5)
+
+def test_tracker_resumes_existing_log(logs_dir):
+    """A new tracker for the same session continues the existing log."""
+    TokenTracker("s1", logs_dir=logs_dir).track_request(make_response())
+    tracker = TokenTracker("s1", logs_dir=logs_dir)
+    tracker.track_request(make_response())
+    assert len(tracker.requests) == 2
+    assert len(tracker.shard_file.read_text().splitlines()) == 2
+
+def test_legacy_session_upgrade(logs_dir):
+    """Legacy session_<id>.json files are imported into the JSONL layout."""
+    legacy = {
+        "session_id": "old",
+        "start_time": 100.0,
+        "requests": [{
+            "timestamp": 101.0,
+            "provider": "openai",
+            "model": "o1",
+            "token_usage": {"prompt_tokens": 1, "completion_tokens": 2, "total_tokens": 3, "reasoning_tokens": None},
+            "cost": 0.25,
+            "thinking_time": 0.5
+        }],
+        "summary": {}
+    }
+    (logs_dir / "session_old.json").write_text(json.dumps(legacy))
+    (logs_dir / "session_older.json").write_text(json.dumps({**legacy, "session_id": "older"}))
+
+    assert load_session(logs_dir / "session_old.json")["session_id"] == "old"
+
+    tracker = TokenTracker("old", logs_dir=logs_dir)
+    assert tracker.session_start == 100.0
+    assert len(tracker.requests) == 1
+    assert not (logs_dir / "session_old.json").exists()
+    assert (logs_dir / "session_old.json.bak").exists()
+
+    assert find_session_files(logs_dir)["older"].suffix == ".json"
+    assert upgrade_sessions(logs_dir) == 1
+    assert find_session_files(logs_dir)["older"].suffix == ".jsonl"
+
+def test_incremental_summary_matches_recompute(logs_dir):
+    """Running aggregates match a full recompute exactly."""
+    tracker = TokenTracker("s1", logs_dir=logs_dir, verify_aggregates=True)
+    costs = [0.1, 1e-9, 0.2, 1e6, 0.3, -1e6, 0.7]
+    for i, cost in enumerate(costs):
+        provider, model = ("openai", "gpt-4o") if i % 2 else ("anthropic", "claude-3-sonnet-20240229")
+        tracker.track_request(make_response(provider=provider, model=model, cost=cost, thinking_time=i / 3))
+    tracker.verify_summary()
+
+    summary = tracker.get_session_summary()
+    assert summary["total_requests"] == len(costs)
+    assert summary["model_stats"]["gpt-4o"]["requests"] == 3
+    assert summary["model_stats"]["gpt-4o"]["prompt_tokens"] == 30
+    assert summary["provider_stats"]["anthropic"]["total_tokens"] == 120
+
+    reloaded = TokenTracker("s1", logs_dir=logs_dir)
+    assert reloaded.get_session_summary()["total_cost"] == summary["total_cost"]
+
+def test_verify_summary_detects_divergence(logs_dir):
+    """verify_summary raises when the aggregates are out of sync."""
+    tracker = TokenTracker("s1", logs_dir=logs_dir)
+    tracker.track_request(make_response())
+    tracker._history.append(dict(tracker.requests[0]))
+    with pytest.raises(RuntimeError, match="total_requests"):
+        tracker.verify_summary()
+
+def test_background_writer_batches_and_flushes(logs_dir):
+    """Background writes reach disk on flush and on close."""
+    settings = FlushSettings(background=True, flush_interval=0.05, batch_size=16, fsync="interval")
+    tracker = TokenTracker("bg", logs_dir=logs_dir, flush_settings=settings)
+    for _ in range(100):
+        tracker.track_request(make_response())
+    tracker.flush()
+    assert len(tracker.shard_file.read_text().splitlines()) == 100
+
+    tracker.track_request(make_response())
+    tracker.close()
+    assert len((logs_dir / "session_bg.jsonl").read_text().splitlines()) == 101
+    sidecar = json.loads((logs_dir / "session_bg.summary.json").read_text())
+    assert sidecar["summary"]["total_requests"] == 101
+
+def test_background_writer_drops_and_counts_when_full(logs_dir, monkeypatch):
+    """With on_full='drop' a full queue drops samples and counts them."""
+    entered, release = threading.Event(), threading.Event()
+    real_append = token_tracker._append_text
+
+    def stalled_append(path, text, fsync=False):
+        entered.set()
+        release.wait()
+        real_append(path, text, fsync)
+
+    monkeypatch.setattr(token_tracker, "_append_text", stalled_append)
+    writer = BackgroundLogWriter(FlushSettings(background=True, flush_interval=0, queue_size=1, on_full="drop"))
+    target = logs_dir / "out.jsonl"
+    assert writer.append(target, "a\n")
+    entered.wait(5)
+    assert writer.append(target, "b\n")
+    assert writer.append(target, "c\n") is False
+    assert writer.dropped == 1
+    release.set()
+    writer.close()
+    assert target.read_text() == "a\nb\n"
+
+def test_invalid_flush_settings():
+    """Unknown fsync and queue-full policies are rejected."""
+    with pytest.raises(ValueError):
+        FlushSettings(fsync="sometimes")
+    with pytest.raises(ValueError):
+        FlushSettings(on_full="ignore")
+
+def test_session_switch_flushes_previous_tracker(logs_dir, monkeypatch):
+    """Switching sessions through get_token_tracker flushes the old writer."""
+    monkeypatch.setattr(token_tracker, "_token_tracker", None)
+    monkeypatch.setenv("TOKEN_TRACKER_BACKGROUND", "1")
+    monkeypatch.setenv("TOKEN_TRACKER_FLUSH_INTERVAL", "60")
+    first = get_token_tracker("a", logs_dir=logs_dir)
+    first.track_request(make_response())
+    second = get_token_tracker("b", logs_dir=logs_dir)
+    assert second is not first
+    assert len((logs_dir / "session_a.jsonl").read_text().splitlines()) == 1
+    second.close()
+
+def _track_in_subprocess(logs_dir, count):
+    """Track requests from a separate process sharing the session."""
+    tracker = TokenTracker("shared", logs_dir=logs_dir)
+    for _ in range(count):
+        tracker.track_request(make_response(cost=0.25))
+
+def test_concurrent_processes_keep_every_request(logs_dir, capsys):
+    """Processes sharing a session write shards that merge without loss."""
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_track_in_subprocess, args=(logs_dir, 50)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert all(worker.exitcode == 0 for worker in workers)
+
+    log_file = logs_dir / "session_shared.jsonl"
+    assert len(list(logs_dir.glob("session_shared.p*.jsonl"))) == 4
+    data = load_session(log_file)
+    assert data["summary"]["total_requests"] == 200
+    assert data["summary"]["total_cost"] == 50.0
+
+    list_sessions(logs_dir)
+    assert "Requests: 200" in capsys.readouterr().out
+
+    # Finished processes are folded into the log; a repeat is a no-op
+    assert compact_session(log_file) == 4
+    assert compact_session(log_file) == 0
+    assert not list(logs_dir.glob("session_shared.p*.jsonl"))
+    assert load_session(log_file)["summary"]["total_requests"] == 200
+
+    tracker = TokenTracker("shared", logs_dir=logs_dir)
+    tracker.track_request(make_response())
+    assert tracker.get_session_summary()["total_requests"] == 201
+
+def test_duplicate_compaction_is_absorbed(logs_dir):
+    """A shard already in the log, left by a crashed compactor, is counted once."""
+    tracker = TokenTracker("dup", logs_dir=logs_dir)
+    tracker.track_request(make_response())
+    tracker.track_request(make_response())
+    shard_text = tracker.shard_file.read_text()
+    with open(logs_dir / "session_dup.jsonl", "a") as f:
+        f.write(shard_text)
+
+    assert load_session(logs_dir / "session_dup.jsonl")["summary"]["total_requests"] == 2
+    tracker.close()
+    assert load_session(logs_dir / "session_dup.jsonl")["summary"]["total_requests"] == 2
+
+def test_sqlite_backend_tracks_and_reloads(logs_dir):
+    """The SQLite backend stores requests in usage.db and reloads them."""
+    tracker = TokenTracker("db", logs_dir=logs_dir, backend="sqlite")
+    tracker.track_request(make_response())
+    tracker.track_request(make_response(provider="anthropic", model="claude-3-sonnet-20240229"))
+    assert (logs_dir / "usage.db").exists()
+    assert not list(logs_dir.glob("session_db*"))
+
+    reloaded = TokenTracker("db", logs_dir=logs_dir, backend="sqlite")
+    assert reloaded.session_start == tracker.session_start
+    assert reloaded.get_session_summary()["total_requests"] == 2
+    assert [r["model"] for r in reloaded.requests] == ["gpt-4o", "claude-3-sonnet-20240229"]
+
+def test_sqlite_store_filters_and_import(logs_dir):
+    """The importer is idempotent and filters are answered from the index."""
+    jsonl = TokenTracker("s1", logs_dir=logs_dir)
+    jsonl.track_request(make_response(model="gpt-4o"))
+    jsonl.track_request(make_response(model="o1", cost=2.0))
+    jsonl.close()
+    (logs_dir / "session_old.json").write_text(json.dumps({
+        "session_id": "old",
+        "start_time": 100.0,
+        "requests": [{
+            "timestamp": 101.0, "provider": "openai", "model": "o1",
+            "token_usage": {"prompt_tokens": 1, "completion_tokens": 2, "total_tokens": 3, "reasoning_tokens": None},
+            "cost": 0.25, "thinking_time": 0.5
+        }],
+        "summary": {}
+    }))
+
+    store = SqliteUsageStore(logs_dir / "usage.db")
+    assert store.import_sessions(logs_dir) == 3
+    assert store.import_sessions(logs_dir) == 0
+
+    assert [s["session_id"] for s in store.list_sessions(model="o1")] == ["old", "s1"]
+    assert [s["session_id"] for s in store.list_sessions(since=1000.0)] == ["s1"]
+    summary = store.summarize(model="o1")
+    assert summary["total_requests"] == 2
+    assert summary["total_cost"] == pytest.approx(2.25)
+    assert set(summary["model_stats"]) == {"o1"}
+
+    plan = store._conn.execute(
+        "EXPLAIN QUERY PLAN SELECT COUNT(*) FROM requests WHERE model = ? AND timestamp >= ?", ("o1", 0)
+    ).fetchall()
+    assert "idx_requests_model" in str(plan)
+    store.close()
+
+def test_manifest_built_on_first_listing_and_updated(logs_dir, capsys):
+    """Listing builds the manifest once; trackers then append delta rows."""
+    first = TokenTracker("m1", logs_dir=logs_dir)
+    first.track_request(make_response(cost=1.0))
+    first.close()
+    assert read_manifest(logs_dir) is None
+
+    list_sessions(logs_dir)
+    assert "Session: m1" in capsys.readouterr().out
+    assert read_manifest(logs_dir)["m1"]["requests"] == 1
+
+    second = TokenTracker("m2", logs_dir=logs_dir)
+    second.track_request(make_response(cost=0.5))
+    second.track_request(make_response(cost=0.25))
+    assert "m2" not in read_manifest(logs_dir)
+    second.flush()
+    again = TokenTracker("m1", logs_dir=logs_dir)
+    again.track_request(make_response(cost=2.0))
+    again.close()
+
+    manifest = read_manifest(logs_dir)
+    assert manifest["m1"]["requests"] == 2
+    assert manifest["m1"]["cost"] == 3.0
+    assert manifest["m2"]["total_tokens"] == 60
+
+    (logs_dir / "session_m2.jsonl").write_text("")
+    for shard in logs_dir.glob("session_m2.p*.jsonl"):
+        shard.unlink()
+    assert rebuild_manifest(logs_dir) == 2
+    assert read_manifest(logs_dir)["m2"]["requests"] == 0
+
+def test_manifest_rebuild_does_not_double_count_live_trackers(logs_dir, capsys):
+    """Totals a live tracker has not appended yet are not added on top of a rebuild."""
+    tracker = TokenTracker("live", logs_dir=logs_dir)
+    for _ in range(3):
+        tracker.track_request(make_response(cost=0.02))
+    list_sessions(logs_dir)
+    tracker.flush()
+    assert read_manifest(logs_dir)["live"]["requests"] == 3
+    tracker.track_request(make_response(cost=0.02))
+    tracker.flush()
+    manifest = read_manifest(logs_dir)["live"]
+    assert manifest["requests"] == 4
+    assert manifest["cost"] == pytest.approx(0.08)
+    
+    # Requests expired by retention are kept through their rollups
+    (logs_dir / "rollups.jsonl").write_text(json.dumps({
+        "session_id": "expired", "source": "x", "bucket": 3600.0, "provider": "openai", "model": "o1",
+        "requests": 2, "prompt_tokens": 20, "completion_tokens": 40, "total_tokens": 60, "cost": 1.0,
+        "thinking_time": 2.0
+    }) + "\n")
+    assert rebuild_manifest(logs_dir) == 2
+    assert read_manifest(logs_dir)["expired"]["requests"] == 2
+    assert read_manifest(logs_dir)["live"]["requests"] == 4
+
+def test_exit_manifest_rows_do_not_keep_trackers_alive(logs_dir):
+    """Trackers are only weakly registered for their exit manifest row, and closing unregisters them."""
+    tracker = TokenTracker("dropped", logs_dir=logs_dir)
+    tracker.track_request(make_response())
+    tracker.close()
+    assert tracker not in token_tracker._manifest_trackers
+    list_sessions(logs_dir)
+    tracker.track_request(make_response())  # Written right away, and registered again
+    assert tracker in token_tracker._manifest_trackers
+    assert read_manifest(logs_dir)["dropped"]["requests"] == 2
+    
+    dropped = weakref.ref(tracker)
+    del tracker
+    gc.collect()
+    assert dropped() is None
+
+def test_manifest_lists_thousands_of_sessions_quickly(logs_dir, capsys):
+    """Listing 5,000 sessions reads only the manifest."""
+    rows = [
+        json.dumps({
+            "session_id": f"s{i:05d}", "start_time": 0.0, "last_time": 60.0, "requests": 3,
+            "prompt_tokens": 30, "completion_tokens": 60, "total_tokens": 90, "cost": 1.5, "thinking_time": 3.0
+        })
+        for i in range(5000)
+    ]
+    (logs_dir / "manifest.jsonl").write_text("\n".join(rows) + "\n")
+
+    start = time.perf_counter()
+    list_sessions(logs_dir)
+    elapsed = time.perf_counter() - start
+    assert capsys.readouterr().out.count("Session: ") == 5000
+    assert elapsed < 1.0
+
+@pytest.fixture(params=["numpy", "python"])
+def analytics_backend(request, monkeypatch):
+    """Run analytics through NumPy (when installed) and pure Python."""
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(token_tracker, "np", None)
+    return request.param
+
+def test_request_columns_round_trip(logs_dir):
+    """Columnar history materializes the same request dicts it was given."""
+    tracker = TokenTracker("cols", logs_dir=logs_dir)
+    tracker.track_request(make_response())
+    tracker.track_request(make_response(provider="anthropic", model="claude-3-sonnet-20240229"))
+    history = tracker.requests
+    assert isinstance(history, RequestColumns)
+    assert len(history) == 2
+    assert history[-1]["provider"] == "anthropic"
+    assert history[0]["token_usage"] == {
+        "prompt_tokens": 10, "completion_tokens": 20, "total_tokens": 30, "reasoning_tokens": None
+    }
+    assert [r["model"] for r in history[0:2]] == ["gpt-4o", "claude-3-sonnet-20240229"]
+    assert history.memory_bytes() <= 64 * len(history) + 1024
+
+def test_cli_times_are_utc_unless_they_have_an_offset(monkeypatch):
+    """--since/--until match the UTC timestamps in the logs, whatever the local time zone."""
+    with monkeypatch.context() as patch:
+        patch.setenv("TZ", "America/New_York")
+        time.tzset()
+        assert parse_time("1970-01-02") == 86400.0
+        assert parse_time("1970-01-01T01:00:00") == 3600.0
+        assert parse_time("1970-01-01T01:00:00+01:00") == 0.0
+    time.tzset()
+
+def test_request_columns_analytics(analytics_backend, capsys, monkeypatch):
+    """Percentiles, throughput and hourly cost are computed per column."""
+    columns = RequestColumns()
+    for i in range(1, 101):
+        columns.append({
+            "timestamp": 3600.0 * (i % 2) + i,
+            "provider": "openai",
+            "model": "gpt-4o" if i % 2 else "o1",
+            "token_usage": {"prompt_tokens": 1, "completion_tokens": 10, "total_tokens": 11, "reasoning_tokens": None},
+            "cost": 0.5,
+            "thinking_time": float(i)
+        })
+
+    percentiles = columns.latency_percentiles()
+    assert percentiles[50] == pytest.approx(50.5)
+    assert percentiles[95] == pytest.approx(95.05)
+    assert columns.latency_percentiles((50,), model="o1")[50] == pytest.approx(51.0)
+
+    throughput = columns.tokens_per_second()
+    assert throughput["gpt-4o"] == pytest.approx(500 / 2500)
+
+    hourly = columns.cost_per_model_per_hour()
+    assert hourly == {"gpt-4o": {3600.0: 25.0}, "o1": {0.0: 25.0}}
+
+    # Hours are shown in UTC, whatever the local time zone
+    with monkeypatch.context() as patch:
+        patch.setenv("TZ", "Asia/Tokyo")
+        time.tzset()
+        display_session_analytics(columns)
+    time.tzset()
+    out = capsys.readouterr().out
+    assert "1970-01-01 01:00" in out and "1970-01-01 00:00" in out
+    assert "0.2" in out  # gpt-4o tokens/s
+
+def _request(timestamp, provider="openai", model="gpt-4o", cost=0.5):
+    return {
+        "timestamp": timestamp,
+        "provider": provider,
+        "model": model,
+        "token_usage": {"prompt_tokens": 1, "completion_tokens": 2, "total_tokens": 3, "reasoning_tokens": None},
+        "cost": cost,
+        "thinking_time": 1.0
+    }
+
+def test_iter_legacy_requests_streams_across_chunks(tmp_path):
+    """The incremental legacy reader decodes elements split across chunks."""
+    legacy = tmp_path / "session_old.json"
+    requests = [_request(float(i), model=f"model-{i}") for i in range(50)]
+    legacy.write_text(json.dumps({"session_id": "old", "start_time": 0.0, "requests": requests,
+                                  "summary": {"provider_stats": {"openai": {"requests": 50}}}}, indent=2))
+    assert list(token_tracker.iter_legacy_requests(legacy, chunk_size=7)) == requests
+    assert list(token_tracker.iter_legacy_requests(legacy)) == requests
+
+def test_rollup_buckets_all_sessions(logs_dir):
+    """Rollups stream JSONL and legacy sessions into time buckets."""
+    day = 86400.0
+    # 1970-01-05 was a Monday, so these land in two different weeks
+    with open(logs_dir / "session_a.jsonl", "w") as f:
+        for ts in (4 * day + 10, 4 * day + 3700, 10 * day):
+            f.write(json.dumps(_request(ts)) + "\n")
+    (logs_dir / "session_b.json").write_text(json.dumps({
+        "session_id": "b", "start_time": 0.0, "requests": [_request(4 * day + 20, provider="anthropic", model="claude")]
+    }))
+
+    rollup = UsageRollup("hour")
+    for _, request in iter_all_requests(logs_dir):
+        rollup.add(request)
+    assert [(r["bucket"], r["model"], r["requests"]) for r in rollup.rows()] == [
+        ("1970-01-05T00:00Z", "claude", 1),
+        ("1970-01-05T00:00Z", "gpt-4o", 1),
+        ("1970-01-05T01:00Z", "gpt-4o", 1),
+        ("1970-01-11T00:00Z", "gpt-4o", 1),
+    ]
+
+    weekly = UsageRollup("week")
+    for _, request in iter_all_requests(logs_dir):
+        weekly.add(request)
+    rows = weekly.rows()
+    assert [(r["bucket"], r["provider"], r["requests"], r["cost"]) for r in rows] == [
+        ("1970-01-05T00:00Z", "anthropic", 1, 0.5),
+        ("1970-01-05T00:00Z", "openai", 3, 1.5),
+    ]
+
+    out = io.StringIO()
+    write_rollup(rows, "csv", out)
+    assert out.getvalue().splitlines()[0].startswith("bucket,provider,model,requests")
+    out = io.StringIO()
+    write_rollup(rows, "jsonl", out)
+    assert json.loads(out.getvalue().splitlines()[1])["total_tokens"] == 9
+
+    with pytest.raises(ValueError):
+        UsageRollup("minute")
+
+def test_request_columns_ring_buffer(analytics_backend):
+    """A bounded column store keeps only the newest rows for analytics."""
+    columns = RequestColumns(capacity=4)
+    for i in range(10):
+        columns.append(dict(_request(float(i)), thinking_time=float(i)))
+    assert len(columns) == 4
+    assert [r["timestamp"] for r in columns] == [6.0, 7.0, 8.0, 9.0]
+    assert columns.latency_percentiles((50,))[50] == pytest.approx(7.5)
+    assert columns.cost_per_model_per_hour() == {"gpt-4o": {0.0: 2.0}}
+    assert columns.memory_bytes() <= 2 * 64 * 4 + 1024
+
+def test_bounded_history_spills_to_segments(logs_dir, capsys):
+    """A bounded tracker keeps memory flat but summaries and reads exact."""
+    tracker = TokenTracker("bounded", logs_dir=logs_dir, max_history=10, verify_aggregates=True,
+                           rotation=RotationSettings(max_bytes=2_000))
+    for i in range(35):
+        tracker.track_request(make_response(cost=0.1 * (i + 1)))
+    assert len(tracker.requests) == 10
+    assert len(list(logs_dir.glob("session_bounded.p*.jsonl.gz"))) >= 2
+    assert tracker.get_session_summary()["total_requests"] == 35
+    assert sum(1 for _ in tracker.iter_history()) == 35
+    tracker.close()
+
+    assert find_session_files(logs_dir) == {"bounded": logs_dir / "session_bounded.jsonl"}
+    data = load_session(logs_dir / "session_bounded.jsonl", stream_requests=True)
+    assert data["summary"]["total_requests"] == 35
+    assert sum(1 for _ in data["requests"]) == 35
+
+    reloaded = TokenTracker("bounded", logs_dir=logs_dir, max_history=10)
+    expected = tracker.get_session_summary()
+    actual = reloaded.get_session_summary()
+    expected.pop("session_duration"), actual.pop("session_duration")
+    assert actual == expected
+    assert [round(r["cost"], 1) for r in reloaded.requests] == [round(0.1 * i, 1) for i in range(26, 36)]
+
+def test_bounded_history_does_not_size_segments(logs_dir):
+    """A small max_history does not seal a segment every few requests."""
+    tracker = TokenTracker("tiny", logs_dir=logs_dir, max_history=2)
+    assert tracker.rotation.max_bytes == TokenTracker.BOUNDED_SHARD_BYTES
+    for _ in range(20):
+        tracker.track_request(make_response())
+    assert len(tracker.requests) == 2
+    assert not session_segments(logs_dir / "session_tiny.jsonl")
+    assert sum(1 for _ in tracker.iter_history()) == 20
+
+def test_construction_is_lazy_and_writes_nothing(tmp_path, monkeypatch):
+    """Trackers touch no files until used and append without reading history."""
+    logs_dir = tmp_path / "token_logs"
+    TokenTracker("lazy", logs_dir=logs_dir)
+    TokenTracker("lazy", logs_dir=logs_dir, backend="sqlite")
+    assert not logs_dir.exists()
+
+    first = TokenTracker("lazy", logs_dir=logs_dir)
+    for _ in range(3):
+        first.track_request(make_response())
+    first.close()
+    before = {path.name: path.read_bytes() for path in logs_dir.iterdir()}
+
+    def fail(*args, **kwargs):
+        raise AssertionError("history was read")
+    monkeypatch.setattr(token_tracker, "iter_log_requests", fail)
+    tracker = TokenTracker("lazy", logs_dir=logs_dir)
+    assert {path.name: path.read_bytes() for path in logs_dir.iterdir()} == before
+    tracker.track_request(make_response(cost=1.0))
+    monkeypatch.undo()
+
+    summary = tracker.get_session_summary()
+    assert summary["total_requests"] == 4
+    assert summary["total_cost"] == pytest.approx(2.5)
+    assert tracker.session_start == first.session_start
+
+@pytest.mark.parametrize("threads,per_thread,min_rate", [
+    (16, 2_000, None),
+    pytest.param(64, 10_000, 5_000, marks=slow),
+])
+def test_concurrent_threads_keep_exact_totals(logs_dir, threads, per_thread, min_rate):
+    """Racing threads: no lost updates, exact totals, no torn lines; at full
+    size (64 threads x 10k requests) also a throughput floor."""
+    tracker = TokenTracker("threads", logs_dir=logs_dir)
+    responses = [make_response(prompt=t + 1, completion=1, cost=0.001 * (t + 1), thinking_time=0.1)
+                 for t in range(threads)]
+    start = threading.Barrier(threads + 1)
+    done = threading.Event()
+    snapshots = []
+
+    def worker(response):
+        start.wait()
+        for _ in range(per_thread):
+            tracker.track_request(response)
+
+    def reader():
+        while not done.is_set():
+            snapshots.append(tracker.get_session_summary()["total_requests"])
+            time.sleep(0.01)
+
+    workers = [threading.Thread(target=worker, args=(response,)) for response in responses]
+    for thread in workers:
+        thread.start()
+    watcher = threading.Thread(target=reader)
+    watcher.start()
+    start.wait()
+    began = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - began
+    done.set()
+    watcher.join()
+    tracker.flush()
+
+    total = threads * per_thread
+    summary = tracker.get_session_summary()
+    assert summary["total_requests"] == total
+    assert summary["total_prompt_tokens"] == per_thread * sum(range(1, threads + 1))
+    assert summary["total_cost"] == math.fsum(0.001 * (t + 1) for t in range(threads) for _ in range(per_thread))
+    assert summary["total_thinking_time"] == math.fsum([0.1] * total)
+    assert snapshots == sorted(snapshots)
+    assert len(tracker.requests) == total
+    lines = tracker.shard_file.read_text().splitlines()
+    assert len(lines) == total
+    assert len({json.loads(line)["id"] for line in lines}) == total
+    if min_rate is not None:
+        assert total / elapsed > min_rate, f"only {total / elapsed:.0f} requests/s"
+
+def test_exited_threads_are_folded_in_and_dropped(logs_dir):
+    """Thread churn neither loses requests nor grows per-thread state."""
+    tracker = TokenTracker("churn", logs_dir=logs_dir)
+    tracker.track_request(make_response(cost=1.0))
+    tracker.flush()
+    list_sessions(logs_dir)
+    for _ in range(50):
+        thread = threading.Thread(target=tracker.track_request, args=(make_response(cost=1.0),))
+        thread.start()
+        thread.join()
+    tracker.track_request(make_response(cost=1.0))
+
+    assert len(tracker._stripes) <= 2
+    assert len(tracker.metrics._thread_series) <= 2
+    assert tracker.get_session_summary()["total_requests"] == 52
+    assert sum(row["requests"] for row in tracker.metrics.snapshot()) >= 52
+    tracker.flush()
+    assert read_manifest(logs_dir)["churn"]["requests"] == 52
+
+def test_requests_is_a_snapshot(logs_dir):
+    """The history returned by ``requests`` does not change afterwards."""
+    tracker = TokenTracker("snap", logs_dir=logs_dir)
+    tracker.track_request(make_response())
+    requests = tracker.requests
+    tracker.track_request(make_response())
+    assert len(requests) == 1
+    assert len(tracker.requests) == 2
+
+def test_pricing_registry_versions_and_wrappers():
+    """Prices are looked up by provider, model and effective date."""
+    registry = PricingRegistry(list(PricingRegistry.DEFAULT_PRICES) + [
+        ModelPrice("openai", "gpt-4o", "2024-05-13", 5.0, 15.0)
+    ])
+    may_13 = 1715558400.0
+    assert registry.price("openai", "gpt-4o").input_per_m == 5.0
+    assert registry.price("openai", "gpt-4o", at=may_13 - 1).input_per_m == 10.0
+    assert registry.price("openai", "gpt-4o", at=may_13).input_per_m == 5.0
+    assert registry.price_on("openai", "gpt-4o", "2024-05-13").output_per_m == 15.0
+    assert registry.price_on("openai", "gpt-4o", "2024-05-14") is None
+    with pytest.raises(ValueError, match="Unsupported openai model"):
+        registry.price("openai", "gpt-2")
+
+    assert TokenTracker.calculate_openai_cost(1_000_000, 1_000_000, "o1") == 75.0
+    assert TokenTracker.calculate_claude_cost(2_000, 1_000, "claude-3-sonnet-20240229") == pytest.approx(0.021)
+    with pytest.raises(ValueError):
+        TokenTracker.calculate_claude_cost(1, 1, "gpt-4o")
+
+def test_cost_columns_prices_each_row_at_its_time(analytics_backend):
+    """Column-wise pricing matches the scalar formula per row."""
+    registry = PricingRegistry([ModelPrice("openai", "gpt-4o", "1970-01-01", 10.0, 30.0),
+                                ModelPrice("openai", "gpt-4o", "1970-01-02", 5.0, 15.0)])
+    columns = RequestColumns.from_records([
+        _request(0.0), _request(86400.0), _request(90000.0, model="unknown", cost=0.25)
+    ])
+    costs, unpriced = registry.cost_columns(columns)
+    assert list(costs) == [1 / 1e6 * 10.0 + 2 / 1e6 * 30.0, 1 / 1e6 * 5.0 + 2 / 1e6 * 15.0, 0.25]
+    assert list(unpriced) == [False, False, True]
+
+def test_recost_session_rewrites_logs_and_segments(logs_dir):
+    """Re-costing streams every record, segments included, into one log."""
+    tracker = TokenTracker("old", logs_dir=logs_dir, max_history=4, rotation=RotationSettings(max_bytes=1_000))
+    for _ in range(10):
+        tracker.track_request(make_response(prompt=1_000, completion=1_000, cost=1.0))
+    tracker.close()
+    log_file = logs_dir / "session_old.jsonl"
+    assert token_tracker.session_segments(log_file)
+
+    registry = PricingRegistry([ModelPrice("openai", "gpt-4o", "1970-01-01", 1.0, 2.0)])
+    assert recost_session(log_file, registry, write=False)["new_cost"] == pytest.approx(0.03)
+    assert load_session(log_file)["summary"]["total_cost"] == 10.0
+
+    result = recost_session(log_file, registry)
+    assert result == {"requests": 10, "old_cost": 10.0, "new_cost": pytest.approx(0.03), "unpriced": 0}
+    assert not token_tracker.session_segments(log_file)
+    assert load_session(log_file)["summary"]["total_cost"] == pytest.approx(0.03)
+    assert json.loads((logs_dir / "session_old.summary.json").read_text())["summary"]["total_requests"] == 10
+
+def test_metrics_count_tracked_requests(logs_dir):
+    """Tracked requests feed counters and latency histograms per model."""
+    metrics = UsageMetrics(latency_buckets=(0.5, 2.0))
+    tracker = TokenTracker("metrics", logs_dir=logs_dir, metrics=metrics)
+    tracker.track_request(make_response(thinking_time=0.5))
+    tracker.track_request(make_response(thinking_time=1.0, cost=0.25))
+    worker = threading.Thread(target=tracker.track_request,
+                              args=(make_response(provider="anthropic", model="claude-3-sonnet-20240229",
+                                                  thinking_time=3.0),))
+    worker.start()
+    worker.join()
+
+    snapshot = metrics.snapshot()
+    assert [(row["provider"], row["requests"]) for row in snapshot] == [("anthropic", 1), ("openai", 2)]
+    openai = snapshot[1]
+    assert openai["prompt_tokens"] == 20 and openai["cost"] == 0.75
+    assert openai["latency_buckets"] == {0.5: 1, 2.0: 2, math.inf: 2}
+    assert snapshot[0]["latency_buckets"] == {0.5: 0, 2.0: 0, math.inf: 1}
+
+    server = start_metrics_server(port=0, metrics=metrics)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        text = urllib.request.urlopen(url, timeout=5).read().decode()
+    finally:
+        server.shutdown()
+    assert '# TYPE llm_request_duration_seconds histogram' in text
+    assert 'llm_requests_total{provider="openai",model="gpt-4o"} 2' in text
+    assert 'llm_tokens_total{provider="openai",model="gpt-4o",type="completion"} 40' in text
+    assert 'llm_request_duration_seconds_bucket{provider="openai",model="gpt-4o",le="+Inf"} 2' in text
+    assert 'llm_request_duration_seconds_sum{provider="openai",model="gpt-4o"} 1.5' in text
+
+@slow
+def test_metrics_observe_is_cheap():
+    """Observing a request costs under a microsecond."""
+    metrics = UsageMetrics()
+    count = 200_000
+    per_call = math.inf
+    for _ in range(5):  # Best of a few runs, to not measure other load
+        start = time.perf_counter()
+        for _ in range(count):
+            metrics.observe("openai", "gpt-4o", 10, 20, 30, 0.5, 1.0)
+        per_call = min(per_call, (time.perf_counter() - start) / count)
+    assert metrics.snapshot()[0]["requests"] == 5 * count
+    assert per_call < 1e-6, f"{per_call * 1e6:.2f}us per observation"
+
+def test_metrics_fold_exited_threads():
+    """Series of exited threads keep counting after they are dropped."""
+    metrics = UsageMetrics()
+
+    def observe():
+        for _ in range(100):
+            metrics.observe("openai", "gpt-4o", 10, 20, 30, 0.5, 1.0)
+
+    for _ in range(20):
+        thread = threading.Thread(target=observe)
+        thread.start()
+        thread.join()
+    observe()
+    assert metrics.snapshot()[0]["requests"] == 2100
+    assert metrics.snapshot()[0]["cost"] == pytest.approx(1050.0)
+    assert len(metrics._thread_series) <= 2
+
+def test_rotation_seals_shard_by_size_and_age(logs_dir):
+    """Shards are sealed into time-ranged segments once too big or too old."""
+    tracker = TokenTracker("rot", logs_dir=logs_dir, rotation=RotationSettings(max_bytes=1000))
+    for _ in range(20):
+        tracker.track_request(make_response())
+    segments = session_segments(tracker.session_file)
+    assert len(segments) >= 4
+    assert all(segment_time_range(segment) is not None for segment in segments)
+    assert len(load_session(tracker.session_file)["requests"]) == 20
+
+    aged = TokenTracker("aged", logs_dir=logs_dir, rotation=RotationSettings(max_age=0.05))
+    aged.track_request(make_response())
+    assert not session_segments(aged.session_file)
+    time.sleep(0.1)
+    aged.track_request(make_response())
+    assert len(session_segments(aged.session_file)) == 1
+    assert not aged.shard_file.exists()
+
+    with pytest.raises(ValueError):
+        RotationSettings(compression="lz4")
+
+def test_zstd_segments_round_trip(logs_dir):
+    """zstd-compressed segments are read back transparently."""
+    pytest.importorskip("zstandard")
+    tracker = TokenTracker("zst", logs_dir=logs_dir,
+                           rotation=RotationSettings(max_bytes=1, compression="zstd"))
+    for _ in range(3):
+        tracker.track_request(make_response())
+    assert all(segment.name.endswith(".jsonl.zst") for segment in session_segments(tracker.session_file))
+    assert load_session(tracker.session_file)["summary"]["total_requests"] == 3
+
+def make_record(i, timestamp):
+    """Create a stored request record."""
+    return {"id": f"r{i}", "timestamp": timestamp, "provider": "openai", "model": "gpt-4o",
+            "token_usage": {"prompt_tokens": 10, "completion_tokens": 20, "total_tokens": 30,
+                            "reasoning_tokens": None},
+            "cost": 0.5, "thinking_time": 1.0}
+
+def test_compact_segments_merges_and_expires_into_rollups(logs_dir, monkeypatch):
+    """Compaction merges small segments and rolls expired requests up by hour."""
+    log_file = logs_dir / "session_old.jsonl"
+    base = 1_700_000_000
+    records = [make_record(i, base + i * 600) for i in range(20)]
+    for seq in range(10):
+        text = "".join(json.dumps(record) + "\n" for record in records[seq * 2:seq * 2 + 2])
+        write_segment(log_file, 1, seq, text)
+    # The compacted log is cut into segments as well
+    (logs_dir / "session_old.jsonl").write_text(json.dumps(make_record(99, base + 11_000)) + "\n")
+
+    now = base + 20 * 600
+    result = compact_segments(log_file, retention=3600, now=now)
+    assert result == {"read": 11, "written": 2, "expired": 14}
+    assert not log_file.exists()
+    segments = session_segments(log_file)
+    assert len(segments) == 1 and segment_time_range(segments[0])[0] >= now - 3600
+    assert sorted(r["id"] for r in iter_session_requests(log_file)) == sorted(
+        [f"r{i}" for i in range(14, 20)] + ["r99"])
+
+    rows = read_rollups(logs_dir)
+    assert sum(row["requests"] for row in rows) == 14
+    assert all(row["bucket"] % 3600 == 0 for row in rows)
+    # Re-running is a no-op and never rolls the same requests up twice
+    assert compact_segments(log_file, retention=3600, now=now)["expired"] == 0
+    assert sum(row["requests"] for row in read_rollups(logs_dir)) == 14
+
+    rollup = UsageRollup("week")
+    for _, request in iter_all_requests(logs_dir):
+        rollup.add(request)
+    for row in read_rollups(logs_dir):
+        rollup.add_rollup(row)
+    assert sum(row["requests"] for row in rollup.rows()) == 21
+    assert sum(row["cost"] for row in rollup.rows()) == 21 * 0.5
+
+    # Time windows skip segments that lie outside them
+    opened = []
+    real_iter = token_tracker.iter_log_requests
+    monkeypatch.setattr(token_tracker, "iter_log_requests", lambda path: opened.append(path) or real_iter(path))
+    assert list(iter_session_requests(log_file, since=now + 1)) == []
+    assert segments[0] not in opened
+
+def test_crashed_compaction_is_read_once_and_finished(logs_dir):
+    """Files left by a compaction that crashed midway never double count."""
+    log_file = logs_dir / "session_crash.jsonl"
+    records = [make_record(i, 1_700_000_000 + i) for i in range(4)]
+    log_file.write_text("".join(json.dumps(record) + "\n" for record in records))
+    journal = logs_dir / "session_crash.jsonl.compacting"
+    ids = [f"r{i}" for i in range(4)]
+
+    # Cut off after writing the first of the log's segments
+    write_segment(log_file, 7, 1, "".join(json.dumps(record) + "\n" for record in records[:2]))
+    journal.write_text(json.dumps({"inputs": [log_file.name]}) + "\n" + json.dumps({"output": [7, 1]}) + "\n")
+    assert sorted(r["id"] for r in iter_session_requests(log_file)) == ids
+
+    # Cut off after the segments were complete but before the log was removed
+    write_segment(log_file, 7, 2, "".join(json.dumps(record) + "\n" for record in records[2:]))
+    with open(journal, "a") as f:
+        f.write(json.dumps({"output": [7, 2]}) + "\n" + json.dumps({"done": True}) + "\n")
+    assert sorted(r["id"] for r in iter_session_requests(log_file)) == ids
+
+    compact_segments(log_file)
+    assert not journal.exists() and not log_file.exists()
+    assert sorted(r["id"] for r in iter_session_requests(log_file)) == ids
@@ -1,15 +1,37 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import contextlib
 import sys
 import logging
 import json
+import mmap
 import os
+import queue
+import random
+import re
+import struct
+import tempfile
 from pathlib import Path
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple, Callable, Awaitable, AsyncIterator, Iterable, Iterator, List
 import hashlib
+import sqlite3
+import threading
 import time
-from functools import lru_cache
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+
+try:
+    import fcntl
+except ImportError:  # No flock (Windows): rate limits stay per process
+    fcntl = None
+
+try:
+    from tools.token_tracker import usage_metrics
+except ImportError:  # Run as a script from tools/: no metrics endpoint to report to
+    usage_metrics = None
 
 # Configure logging
 logging.basicConfig(
@@ -20,12 +42,41 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 class LLMConfig:
-    """Configuration manager for LLM settings."""
+    """Configuration manager for LLM settings.
+
+    The path defaults to LLM_CONFIG_PATH, then ``llm_config.json``. ``refresh``
+    reloads the file in place when its modification time changes; every
+    reload bumps ``generation`` so holders can rebuild derived state.
+    """
     
-    def __init__(self, config_path: str = "llm_config.json"):
-        self.config_path = config_path
+    def __init__(self, config_path: Optional[str] = None):
+        self.config_path = config_path or os.environ.get("LLM_CONFIG_PATH") or "llm_config.json"
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._stamp = self._file_stamp()
         self.config = self._load_config()
     
+    def _file_stamp(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.config_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+    
+    def refresh(self) -> bool:
+        """Reload the configuration if the file changed since it was read."""
+        stamp = self._file_stamp()
+        if stamp == self._stamp:
+            return False
+        with self._lock:
+            if stamp == self._stamp:
+                return False
+            self.config = self._load_config()
+            self._stamp = stamp
+            self.generation += 1
+        logger.info(f"Reloaded LLM configuration from {self.config_path}")
+        return True
+    
     def _load_config(self) -> Dict[str, Any]:
         """Load configuration from file or use defaults."""
         default_config = {
@@ -33,11 +84,26 @@ class LLMConfig:
                 "cursor": {
                     "default_model": "cursor-ai",
                     "rate_limit": 60,  # requests per minute
+                    "token_rate_limit": None,  # tokens per minute, unlimited if None
                     "cache_ttl": 3600  # cache time-to-live in seconds
                 }
             },
             "cache_enabled": True,
-            "rate_limiting_enabled": True
+            "cache_path": ".llm_cache/responses.db",
+            "cache_max_bytes": 64 * 1024 * 1024,
+            "rate_limiting_enabled": True,
+            "rate_limit_scope": "host",  # share limits with every process on this host, or "process"
+            "coalesce_requests": True,
+            "near_duplicate_cache": False,
+            "near_duplicate_threshold": 0.9,
+            "near_duplicate_audit_rate": 0.0,
+            "volatile_line_patterns": DEFAULT_VOLATILE_LINE_PATTERNS,
+            "hedge_budget": 0.1,  # hedged requests allowed per primary request
+            "hedge_burst": 3,
+            "hedge_min_samples": 20,
+            "adaptive_concurrency": False,  # opt-in; applies while rate limiting is enabled
+            "concurrency_initial": 4,
+            "concurrency_max": 64
         }
         
         try:
@@ -62,55 +128,1764 @@ class LLMConfig:
     def is_rate_limiting_enabled(self) -> bool:
         """Check if rate limiting is enabled."""
         return self.config.get("rate_limiting_enabled", True)
+    
+    def is_coalescing_enabled(self) -> bool:
+        """Check if concurrent identical queries share one upstream request."""
+        return self.config.get("coalesce_requests", True)
+    
+    def get_cache_ttl(self, provider: str) -> float:
+        """Get how long, in seconds, a provider's responses stay cached."""
+        return self.get_provider_config(provider).get("cache_ttl", DEFAULT_CACHE_TTL)
+    
+    def get_cache_path(self) -> Path:
+        """Get the response cache database path (LLM_CACHE_PATH overrides it)."""
+        return Path(os.environ.get("LLM_CACHE_PATH") or self.config.get("cache_path", ".llm_cache/responses.db"))
+    
+    def get_cache_max_bytes(self) -> int:
+        """Get the size bound of the response cache."""
+        return self.config.get("cache_max_bytes", 64 * 1024 * 1024)
+    
+    def get_rate_limit_dir(self) -> Path:
+        """Get the directory holding host-wide rate limit state (LLM_RATE_LIMIT_DIR overrides it)."""
+        default = Path(tempfile.gettempdir()) / "llm_rate_limits"
+        return Path(os.environ.get("LLM_RATE_LIMIT_DIR") or self.config.get("rate_limit_dir") or default)
+    
+    def is_near_duplicate_cache_enabled(self) -> bool:
+        """Check if near-duplicate prompts may be answered from the cache."""
+        return self.config.get("near_duplicate_cache", False)
+    
+    def get_near_duplicate_threshold(self) -> float:
+        """Get the shingle similarity a cached prompt needs to be reused."""
+        return self.config.get("near_duplicate_threshold", 0.9)
+    
+    def get_near_duplicate_audit_rate(self) -> float:
+        """Get the share of near-duplicate hits that are re-queried to audit them."""
+        return self.config.get("near_duplicate_audit_rate", 0.0)
+    
+    def get_hedge_target(self, provider: str) -> Optional[Tuple[str, Optional[str]]]:
+        """Get the (provider, model) that backs up slow requests to a provider, if any."""
+        hedge = self.get_provider_config(provider).get("hedge")
+        if not hedge or not hedge.get("provider"):
+            return None
+        return hedge["provider"], hedge.get("model")
+    
+    def get_volatile_line_patterns(self) -> list:
+        """Get the regexes of prompt lines ignored when matching near duplicates."""
+        return self.config.get("volatile_line_patterns", DEFAULT_VOLATILE_LINE_PATTERNS)
+
+DEFAULT_CACHE_TTL = 3600
+
+# Lines such as "Last updated: ..." or a bare timestamp change on every run
+# without changing what the prompt asks
+DEFAULT_VOLATILE_LINE_PATTERNS = [
+    r"(?i)^\W*(last[ _-]?(updated|modified|run)|updated|generated|timestamp|date)\W*\s*[:=]\s*\S*\d",
+    r"^\W*\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?)?\W*$"
+]
+
+_configs: Dict[str, LLMConfig] = {}
+_configs_lock = threading.Lock()
+
+def get_config(config_path: Optional[str] = None) -> LLMConfig:
+    """Get the process-wide configuration for a path, reloaded if the file changed."""
+    path = os.path.abspath(config_path or os.environ.get("LLM_CONFIG_PATH") or "llm_config.json")
+    with _configs_lock:
+        config = _configs.get(path)
+        if config is None:
+            config = _configs[path] = LLMConfig(path)
+            return config
+    config.refresh()
+    return config
+
+def normalize_prompt(prompt: str) -> str:
+    """Normalize line endings and trailing whitespace, which do not change a prompt's meaning."""
+    return "\n".join(line.rstrip() for line in prompt.strip().splitlines())
+
+@dataclass
+class CacheEntry:
+    """A cached response and what producing it cost."""
+    response: str
+    provider: str
+    model: Optional[str]
+    created: float
+    expires: float
+    latency: float  # Seconds the original provider call took
+    size: int
+    hits: int = 0
+    last_access: float = 0.0
+
+class MemoryResponseCache:
+    """Thread-safe in-process response cache shared by every LLMClient.
+
+    Entries expire after the TTL they were stored with; once the cached
+    responses exceed ``max_bytes`` the least recently used are evicted.
+    Keys are the same content addresses the persistent ``ResponseCache`` uses.
+    """
+    STATS = ("hits", "misses", "expired", "evictions", "invalidations")
+    
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._bytes = 0
+        self._counts = dict.fromkeys(self.STATS, 0)
+        self._latency_saved = 0.0
+        self._lock = threading.Lock()
+    
+    def _remove(self, key: str) -> CacheEntry:
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+        return entry
+    
+    def get(self, key: str) -> Optional[CacheEntry]:
+        """Return the live entry for a key, marking it recently used."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= now:
+                self._remove(key)
+                self._counts["expired"] += 1
+                entry = None
+            if entry is None:
+                self._counts["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            entry.hits += 1
+            entry.last_access = now
+            self._counts["hits"] += 1
+            self._latency_saved += entry.latency
+            return entry
+    
+    def put(self, key: str, entry: CacheEntry):
+        """Store an entry, then evict least recently used ones over max_bytes."""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if entry.size > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self._bytes += entry.size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._counts["evictions"] += 1
+    
+    def entry(self, key: str) -> Optional[CacheEntry]:
+        """Look at an entry's metadata without counting a lookup."""
+        with self._lock:
+            return self._entries.get(key)
+    
+    def invalidate(self, key: Optional[str] = None, provider: Optional[str] = None,
+                   model: Optional[str] = None) -> int:
+        """Drop one key, or every entry matching provider/model (all if neither)."""
+        with self._lock:
+            if key is not None:
+                keys = [key] if key in self._entries else []
+            else:
+                keys = [k for k, entry in self._entries.items()
+                        if (provider is None or entry.provider == provider)
+                        and (model is None or entry.model == model)]
+            for k in keys:
+                self._remove(k)
+            self._counts["invalidations"] += len(keys)
+            return len(keys)
+    
+    def clear(self) -> int:
+        """Drop every entry."""
+        return self.invalidate()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Lookup counts, current entries and bytes, and provider time saved."""
+        with self._lock:
+            stats = dict(self._counts)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+            stats["latency_saved"] = self._latency_saved
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+memory_response_cache = MemoryResponseCache()
+
+class ResponseCache:
+    """Persistent LLM response cache shared across processes.
+
+    Responses are stored in a SQLite database under a content address: the
+    SHA-256 of provider, model and prompt. WAL mode lets several CLI
+    invocations and processes read and write it at once. Entries older than
+    the caller's TTL are treated as misses and removed; once the stored
+    responses exceed ``max_bytes`` the least recently used ones are evicted.
+    Hit, miss, expiry and eviction counts are kept in the database too,
+    along with a running total of the stored bytes, so a put never has to
+    scan the table.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            provider TEXT NOT NULL,
+            model TEXT,
+            response TEXT NOT NULL,
+            created REAL NOT NULL,
+            accessed REAL NOT NULL,
+            size INTEGER NOT NULL,
+            latency REAL NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed);
+        CREATE TABLE IF NOT EXISTS stats (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+    """
+    STATS = ("hits", "misses", "expired", "evictions")
+    # Least recently used entries are read this many at a time when evicting
+    EVICT_BATCH = 64
+    
+    def __init__(self, db_path: Path, max_bytes: int = 64 * 1024 * 1024):
+        self.db_path = Path(db_path)
+        self.max_bytes = max_bytes
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(responses)")}
+        if "latency" not in columns:
+            # Databases created before latencies were recorded
+            with self._conn:
+                self._conn.execute("ALTER TABLE responses ADD COLUMN latency REAL NOT NULL DEFAULT 0")
+        with self._conn:
+            # Databases created before the byte total was kept start from a scan
+            self._conn.execute(
+                "INSERT OR IGNORE INTO stats (name, value) "
+                "SELECT 'bytes', COALESCE(SUM(size), 0) FROM responses"
+            )
+        self._lock = threading.Lock()
+    
+    def close(self):
+        self._conn.close()
+    
+    @staticmethod
+    def key(provider: str, model: Optional[str], prompt: str, sampling: Optional[Dict[str, Any]] = None) -> str:
+        """Content address of a normalized prompt for a provider, model and sampling parameters."""
+        payload = [provider, model, normalize_prompt(prompt)]
+        if sampling:
+            payload.append(sorted(sampling.items()))
+        return hashlib.sha256(json.dumps(payload).encode()).hexdigest()
+    
+    def _count(self, name: str, amount: int = 1):
+        self._conn.execute(
+            "INSERT INTO stats (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, amount)
+        )
+    
+    def get_entry(self, key: str, ttl: float) -> Optional[CacheEntry]:
+        """Return the cached entry for a key if it is younger than ttl seconds."""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT response, provider, model, created, latency, size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[3] >= ttl:
+                if self._conn.execute("DELETE FROM responses WHERE key = ? AND created = ?", (key, row[3])).rowcount:
+                    self._count("bytes", -row[5])
+                self._count("expired")
+                row = None
+            if row is None:
+                self._count("misses")
+                return None
+            self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._count("hits")
+        response, provider, model, created, latency, size = row
+        return CacheEntry(response, provider, model, created, created + ttl, latency, size, last_access=now)
+    
+    def get(self, key: str, ttl: float) -> Optional[str]:
+        """Return the cached response for a key if it is younger than ttl seconds."""
+        entry = self.get_entry(key, ttl)
+        return entry.response if entry is not None else None
+    
+    def put(self, key: str, response: str, provider: str, model: Optional[str] = None, latency: float = 0.0):
+        """Store a response, then evict least recently used ones over max_bytes."""
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        with self._lock, self._conn:
+            # Counting first takes the write lock, so no other process can
+            # change the entry being replaced before its size is read
+            self._count("bytes", size)
+            replaced = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if replaced:
+                self._count("bytes", -replaced[0])
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, provider, model, response, created, accessed, size, latency) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, provider, model, response, now, now, size, latency)
+            )
+            total = self._conn.execute("SELECT value FROM stats WHERE name = 'bytes'").fetchone()[0]
+            evicted = freed = 0
+            while total > self.max_bytes:
+                batch = self._conn.execute(
+                    "SELECT key, size FROM responses ORDER BY accessed LIMIT ?", (self.EVICT_BATCH,)
+                ).fetchall()
+                if not batch:
+                    break
+                for old_key, old_size in batch:
+                    if total <= self.max_bytes:
+                        break
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                    total -= old_size
+                    freed += old_size
+                    evicted += 1
+            if evicted:
+                self._count("evictions", evicted)
+                self._count("bytes", -freed)
+    
+    def invalidate(self, key: Optional[str] = None, provider: Optional[str] = None,
+                   model: Optional[str] = None) -> int:
+        """Drop one key, or every response matching provider/model (all if neither)."""
+        if key is not None:
+            where, params = "key = ?", [key]
+        else:
+            clauses, params = [], []
+            if provider is not None:
+                clauses.append("provider = ?")
+                params.append(provider)
+            if model is not None:
+                clauses.append("model = ?")
+                params.append(model)
+            where = " AND ".join(clauses) or "1"
+        with self._lock, self._conn:
+            # Take the write lock before summing what is about to be deleted
+            self._count("bytes", 0)
+            freed = self._conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM responses WHERE {where}", params).fetchone()[0]
+            self._count("bytes", -freed)
+            return self._conn.execute(f"DELETE FROM responses WHERE {where}", params).rowcount
+    
+    def clear(self) -> int:
+        """Drop every cached response; the counters are kept."""
+        return self.invalidate()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss/expiry/eviction counts plus current entries and bytes."""
+        with self._lock:
+            counters = dict(self._conn.execute("SELECT name, value FROM stats").fetchall())
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        stats = {name: counters.get(name, 0) for name in self.STATS}
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        stats["entries"] = entries
+        stats["bytes"] = counters.get("bytes", 0)
+        return stats
+
+_response_caches: Dict[Path, ResponseCache] = {}
+_response_caches_lock = threading.Lock()
+
+def get_response_cache(config: Optional[LLMConfig] = None) -> ResponseCache:
+    """Get the process-wide response cache for a configuration's cache path."""
+    config = config or get_config()
+    path = config.get_cache_path().resolve()
+    with _response_caches_lock:
+        cache = _response_caches.get(path)
+        if cache is None:
+            cache = _response_caches[path] = ResponseCache(path, config.get_cache_max_bytes())
+        return cache
+
+def canonicalize_prompt(prompt: str, volatile_patterns: Iterable[str] = ()) -> str:
+    """Reduce a prompt to what near-duplicate matching compares: runs of
+    whitespace collapsed, blank lines and lines matching a volatile pattern dropped."""
+    patterns = [re.compile(pattern) for pattern in volatile_patterns]
+    lines = []
+    for line in prompt.splitlines():
+        if any(pattern.search(line) for pattern in patterns):
+            continue
+        line = " ".join(line.split())
+        if line:
+            lines.append(line)
+    return "\n".join(lines)
+
+SHINGLE_WORDS = 5
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16
+# One 64-bit mask per permutation: the minimum of each shingle hash XOR a
+# mask stands in for the minimum under a random permutation
+_MINHASH_MASKS = [
+    int.from_bytes(hashlib.blake2b(f"minhash-{i}".encode(), digest_size=8).digest(), "big")
+    for i in range(MINHASH_PERMUTATIONS)
+]
+
+def shingles(text: str, size: int = SHINGLE_WORDS) -> set:
+    """Stable 64-bit hashes of a text's overlapping word n-grams."""
+    words = text.split()
+    grams = [" ".join(words[i:i + size]) for i in range(max(1, len(words) - size + 1))]
+    return {int.from_bytes(hashlib.blake2b(gram.encode(), digest_size=8).digest(), "big") for gram in grams}
+
+def jaccard(a: set, b: set) -> float:
+    """Jaccard similarity of two shingle sets."""
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+def lsh_buckets(hashes: set) -> List[str]:
+    """The MinHash signature of a shingle set, cut into one LSH bucket per band.
+
+    Two sets with Jaccard similarity s share at least one bucket with
+    probability 1 - (1 - s**4)**16: almost surely at 0.9, about 0.64 at 0.5.
+    """
+    signature = [min(h ^ mask for h in hashes) for mask in _MINHASH_MASKS] if hashes else [0] * MINHASH_PERMUTATIONS
+    rows = MINHASH_PERMUTATIONS // LSH_BANDS
+    return [
+        hashlib.blake2b(struct.pack(f"<{rows}Q", *signature[band * rows:(band + 1) * rows]), digest_size=8).hexdigest()
+        for band in range(LSH_BANDS)
+    ]
+
+class NearDuplicateIndex:
+    """Index of cached prompts for answering near-duplicate prompts.
+
+    Prompts are canonicalized, then indexed by the LSH buckets of their
+    MinHash signature, within a scope of provider, model and sampling
+    parameters. A lookup confirms each candidate by the exact Jaccard
+    similarity of the shingles before it is reused, so LSH false positives
+    are rejected (and counted). The index lives in the response cache
+    database and points at response cache keys; responses themselves stay
+    in the response caches.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS near_prompts (
+            key TEXT PRIMARY KEY,
+            scope TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            canonical TEXT NOT NULL,
+            created REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_near_prompts_digest ON near_prompts (scope, digest);
+        CREATE TABLE IF NOT EXISTS near_buckets (
+            scope TEXT NOT NULL,
+            band INTEGER NOT NULL,
+            bucket TEXT NOT NULL,
+            key TEXT NOT NULL,
+            PRIMARY KEY (scope, band, bucket, key)
+        );
+        CREATE TABLE IF NOT EXISTS stats (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+    """
+    STATS = ("lookups", "exact_hits", "near_hits", "candidates", "rejected", "audited", "audit_mismatches")
+    MAX_CANDIDATES = 8
+    # Entries whose responses left the cache are swept once per this many adds;
+    # in between, lookups that find no response discard them one at a time
+    SWEEP_EVERY = 256
+    
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._lock = threading.Lock()
+        self._adds = 0
+    
+    def close(self):
+        self._conn.close()
+    
+    @staticmethod
+    def scope(provider: str, model: Optional[str], sampling: Optional[Dict[str, Any]] = None) -> str:
+        """Prompts are only matched against others sent to the same provider, model and sampling parameters."""
+        return ResponseCache.key(provider, model, "", sampling)
+    
+    def _count(self, name: str, amount: int = 1):
+        self._conn.execute(
+            "INSERT INTO stats (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (f"near_{name}", amount)
+        )
+    
+    def add(self, scope: str, key: str, canonical: str):
+        """Index a cached prompt; every ``SWEEP_EVERY`` adds, entries whose
+        responses left the cache are dropped."""
+        digest = hashlib.sha256(canonical.encode()).hexdigest()
+        buckets = lsh_buckets(shingles(canonical))
+        with self._lock, self._conn:
+            self._discard(key)
+            self._conn.execute(
+                "INSERT INTO near_prompts (key, scope, digest, canonical, created) VALUES (?, ?, ?, ?, ?)",
+                (key, scope, digest, canonical, time.time())
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO near_buckets (scope, band, bucket, key) VALUES (?, ?, ?, ?)",
+                [(scope, band, bucket, key) for band, bucket in enumerate(buckets)]
+            )
+            self._adds += 1
+            if self._adds % self.SWEEP_EVERY == 0:
+                self._sweep()
+    
+    def _sweep(self):
+        if self._conn.execute("SELECT name FROM sqlite_master WHERE name = 'responses'").fetchone():
+            self._conn.execute("DELETE FROM near_prompts WHERE key NOT IN (SELECT key FROM responses)")
+            self._conn.execute("DELETE FROM near_buckets WHERE key NOT IN (SELECT key FROM near_prompts)")
+    
+    def lookup(self, scope: str, canonical: str, threshold: float) -> List[Tuple[str, float]]:
+        """Cache keys of indexed prompts at least ``threshold`` similar, most similar first."""
+        digest = hashlib.sha256(canonical.encode()).hexdigest()
+        with self._lock, self._conn:
+            self._count("lookups")
+            exact = [row[0] for row in self._conn.execute(
+                "SELECT key FROM near_prompts WHERE scope = ? AND digest = ?", (scope, digest)
+            )]
+            if exact:
+                return [(key, 1.0) for key in exact]
+            hashes = shingles(canonical)
+            buckets = lsh_buckets(hashes)
+            candidates = self._conn.execute(
+                "SELECT p.key, p.canonical, COUNT(*) AS bands FROM near_buckets b "
+                "JOIN near_prompts p ON p.key = b.key "
+                f"WHERE b.scope = ? AND ({' OR '.join(['(b.band = ? AND b.bucket = ?)'] * len(buckets))}) "
+                "GROUP BY p.key ORDER BY bands DESC LIMIT ?",
+                [scope, *(value for band, bucket in enumerate(buckets) for value in (band, bucket)), self.MAX_CANDIDATES]
+            ).fetchall()
+            matches = []
+            for key, text, _ in candidates:
+                similarity = jaccard(hashes, shingles(text))
+                if similarity >= threshold:
+                    matches.append((key, similarity))
+            self._count("candidates", len(candidates))
+            self._count("rejected", len(candidates) - len(matches))
+        return sorted(matches, key=lambda match: -match[1])
+    
+    def record_hit(self, similarity: float):
+        with self._lock, self._conn:
+            self._count("exact_hits" if similarity >= 1.0 else "near_hits")
+    
+    def record_audit(self, agreed: bool):
+        """Count an audited hit and whether a fresh response agreed with the reused one."""
+        with self._lock, self._conn:
+            self._count("audited")
+            if not agreed:
+                self._count("audit_mismatches")
+    
+    def _discard(self, key: str):
+        self._conn.execute("DELETE FROM near_prompts WHERE key = ?", (key,))
+        self._conn.execute("DELETE FROM near_buckets WHERE key = ?", (key,))
+    
+    def discard(self, key: str):
+        """Drop an indexed prompt, e.g. once its response has expired."""
+        with self._lock, self._conn:
+            self._discard(key)
+    
+    def clear(self):
+        """Drop every indexed prompt; the counters are kept."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM near_prompts")
+            self._conn.execute("DELETE FROM near_buckets")
+    
+    def stats(self) -> Dict[str, Any]:
+        """Lookup, hit, candidate and audit counts plus the indexed prompts.
+
+        ``rejected`` counts LSH candidates that failed confirmation;
+        ``false_positive_rate`` is the share of audited hits whose fresh
+        response disagreed with the reused one.
+        """
+        with self._lock:
+            counters = dict(self._conn.execute("SELECT name, value FROM stats WHERE name LIKE 'near_%'").fetchall())
+            entries = self._conn.execute("SELECT COUNT(*) FROM near_prompts").fetchone()[0]
+        stats = {name: counters.get(f"near_{name}", 0) for name in self.STATS}
+        hits = stats["exact_hits"] + stats["near_hits"]
+        stats["hit_rate"] = hits / stats["lookups"] if stats["lookups"] else 0.0
+        stats["candidate_rejection_rate"] = stats["rejected"] / stats["candidates"] if stats["candidates"] else 0.0
+        stats["false_positive_rate"] = stats["audit_mismatches"] / stats["audited"] if stats["audited"] else 0.0
+        stats["entries"] = entries
+        return stats
+
+_near_duplicate_indexes: Dict[Path, NearDuplicateIndex] = {}
+
+def get_near_duplicate_index(config: Optional[LLMConfig] = None) -> NearDuplicateIndex:
+    """Get the process-wide near-duplicate index stored with a configuration's response cache."""
+    config = config or get_config()
+    path = config.get_cache_path().resolve()
+    with _response_caches_lock:
+        index = _near_duplicate_indexes.get(path)
+        if index is None:
+            index = _near_duplicate_indexes[path] = NearDuplicateIndex(path)
+        return index
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key into one execution.
+
+    The first caller for a key (the leader) runs the call; callers that
+    arrive while it is in flight wait for its result, or its exception,
+    instead of repeating it. Threads use ``do`` and asyncio tasks
+    ``do_async``; both wait on the same ``concurrent.futures.Future``, so a
+    call led by a thread is shared with tasks and vice versa. A thread must
+    not wait from inside a running event loop on a call led by a task of
+    that loop. If the leader is cancelled, its followers get a
+    ``RuntimeError`` rather than a cancellation of their own.
+    """
+    
+    def __init__(self):
+        self._calls: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._leaders = 0
+        self._coalesced = 0
+    
+    def _join(self, key: str) -> Tuple[Future, bool]:
+        """The in-flight future for a key, and whether the caller leads it"""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self._coalesced += 1
+                return future, False
+            future = self._calls[key] = Future()
+            self._leaders += 1
+            return future, True
+    
+    def _finish(self, key: str, future: Future, result=None, error: Optional[BaseException] = None):
+        with self._lock:
+            del self._calls[key]
+        if error is not None:
+            if not isinstance(error, Exception):
+                # The leader was cancelled or interrupted; that is not the followers' to re-raise
+                follower_error = RuntimeError(f"Request was abandoned by the caller leading it ({type(error).__name__})")
+                follower_error.__cause__ = error
+                error = follower_error
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """Run ``fn`` unless a call for ``key`` is in flight; either way return its result."""
+        future, leader = self._join(key)
+        if not leader:
+            logger.debug(f"Joining in-flight request for key: {key}")
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result
+    
+    async def do_async(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Await ``fn()`` unless a call for ``key`` is in flight; either way return its result."""
+        future, leader = self._join(key)
+        if not leader:
+            logger.debug(f"Joining in-flight request for key: {key}")
+            return await asyncio.wrap_future(future)
+        try:
+            result = await fn()
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result
+    
+    def stream(self, key: str, fn: Callable[[], Iterator[str]]) -> Iterator[str]:
+        """Streaming ``do``: the leader yields chunks as ``fn()`` produces them;
+        callers that join it get the whole response as one chunk once it completes.
+
+        If the leader stops reading early, the callers waiting on it fail
+        rather than receive a partial response.
+        """
+        future, leader = self._join(key)
+        if not leader:
+            logger.debug(f"Joining in-flight request for key: {key}")
+            yield future.result()
+            return
+        chunks = []
+        try:
+            for chunk in fn():
+                chunks.append(chunk)
+                yield chunk
+        except GeneratorExit:
+            self._finish(key, future, error=RuntimeError("Streaming request was abandoned before it completed"))
+            raise
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, "".join(chunks))
+    
+    def stats(self) -> Dict[str, Any]:
+        """How many calls ran, how many were deduplicated, and how many are in flight."""
+        with self._lock:
+            calls = self._leaders + self._coalesced
+            return {
+                "leaders": self._leaders,
+                "coalesced": self._coalesced,
+                "in_flight": len(self._calls),
+                "dedup_rate": self._coalesced / calls if calls else 0.0
+            }
+
+request_flights = SingleFlight()
+
+class QueryTimings:
+    """Rolling time-to-first-token and total latency of fresh provider calls,
+    per provider and model. Cached responses are not recorded."""
+    
+    def __init__(self, window: int = 256):
+        self.window = window
+        self._samples: Dict[Tuple[str, Optional[str]], deque] = {}
+        self._lock = threading.Lock()
+    
+    def record(self, provider: str, model: Optional[str], ttft: float, total: float):
+        with self._lock:
+            samples = self._samples.get((provider, model))
+            if samples is None:
+                samples = self._samples[(provider, model)] = deque(maxlen=self.window)
+            samples.append((ttft, total))
+    
+    def percentile(self, provider: str, model: Optional[str], q: float = 0.95, ttft: bool = True,
+                   min_samples: int = 1) -> Optional[float]:
+        """A percentile of the time to first chunk (or total time), or None
+        while fewer than ``min_samples`` calls were recorded."""
+        with self._lock:
+            values = sorted(sample[0 if ttft else 1] for sample in self._samples.get((provider, model), ()))
+        if not values or len(values) < min_samples:
+            return None
+        return values[min(len(values) - 1, int(len(values) * q))]
+    
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Sample count and p50/p95 of each timing, keyed by "provider/model"."""
+        with self._lock:
+            samples = {key: list(values) for key, values in self._samples.items()}
+        stats = {}
+        for (provider, model), values in samples.items():
+            ttfts = sorted(ttft for ttft, _ in values)
+            totals = sorted(total for _, total in values)
+            stats[f"{provider}/{model}"] = {
+                "count": len(values),
+                "ttft_p50": ttfts[len(ttfts) // 2],
+                "ttft_p95": ttfts[min(len(ttfts) - 1, int(len(ttfts) * 0.95))],
+                "total_p50": totals[len(totals) // 2],
+                "total_p95": totals[min(len(totals) - 1, int(len(totals) * 0.95))]
+            }
+        return stats
+    
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+
+query_timings = QueryTimings()
+
+class HedgeBudget:
+    """Caps how often requests to a provider may be hedged.
+
+    Each primary request earns ``ratio`` of a hedge, up to ``burst`` banked;
+    each hedge spends one. Over time at most about ``ratio`` of requests are
+    duplicated, however slow the provider gets.
+    """
+    
+    def __init__(self, ratio: float, burst: float):
+        self.ratio = ratio
+        self.burst = burst
+        self._tokens = burst
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(("requests", "hedged", "denied", "backup_wins", "primary_wins"), 0)
+    
+    def earn(self):
+        """Credit one primary request."""
+        with self._lock:
+            self._counts["requests"] += 1
+            self._tokens = min(self.burst, self._tokens + self.ratio)
+    
+    def try_spend(self) -> bool:
+        """Take a hedge from the budget, if one is left."""
+        with self._lock:
+            if self._tokens < 1:
+                self._counts["denied"] += 1
+                return False
+            self._tokens -= 1
+            self._counts["hedged"] += 1
+            return True
+    
+    def record_winner(self, backup: bool):
+        with self._lock:
+            self._counts["backup_wins" if backup else "primary_wins"] += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._counts)
+            stats["available"] = self._tokens
+        stats["hedge_rate"] = stats["hedged"] / stats["requests"] if stats["requests"] else 0.0
+        return stats
+
+_hedge_budgets: Dict[Tuple[str, Optional[str]], HedgeBudget] = {}
+_hedge_budgets_lock = threading.Lock()
+
+def get_hedge_budget(config: LLMConfig, provider: str, model: Optional[str]) -> HedgeBudget:
+    """Get the process-wide hedge budget of a provider and model."""
+    with _hedge_budgets_lock:
+        budget = _hedge_budgets.get((provider, model))
+        if budget is None:
+            budget = _hedge_budgets[(provider, model)] = HedgeBudget(
+                config.config.get("hedge_budget", 0.1), config.config.get("hedge_burst", 3)
+            )
+        return budget
+
+def hedging_stats() -> Dict[str, Dict[str, Any]]:
+    """Hedge budget counters, keyed by "provider/model" of the primary."""
+    with _hedge_budgets_lock:
+        budgets = dict(_hedge_budgets)
+    return {f"{provider}/{model}": budget.stats() for (provider, model), budget in budgets.items()}
+
+_STREAM_DONE = object()
+_STREAM_CALLING = object()
+
+def drain(stream: Iterator[str]) -> Tuple[str, Any]:
+    """Read a chunk stream to the end: the joined chunks and the generator's return value."""
+    chunks = []
+    while True:
+        try:
+            chunks.append(next(stream))
+        except StopIteration as stop:
+            return "".join(chunks), stop.value
+
+def overload_reason(error: BaseException) -> Optional[str]:
+    """Whether an error means the provider is overloaded: "timeouts" or
+    "rate_limited" (HTTP 429/503 or a rate limit message), else None."""
+    if isinstance(error, TimeoutError):
+        return "timeouts"
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if status in (429, 503) or re.search(r"\b429\b|rate.?limit|too many requests|overloaded", str(error), re.I):
+        return "rate_limited"
+    return None
+
+def _resolve_waiter(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD limit on the requests in flight to one provider and model.
+
+    Each success whose time to first chunk is not a spike grows the limit
+    by 1/limit, i.e. by one per window of requests; until the first
+    overload it grows by one per success instead (slow start). A 429,
+    timeout or latency spike (more than ``latency_tolerance`` times the
+    baseline, an average of normal latencies) cuts it by ``backoff``, at
+    most once per window: requests that started before the last cut do not
+    cut it again. Spikes still pull the baseline towards them, slowly, so a
+    lasting step up in latency becomes the new normal after a few cuts
+    instead of holding the limit at its minimum. Callers beyond the limit
+    wait in FIFO order, threads in ``acquire`` and tasks in
+    ``acquire_async`` alike.
+
+    Clients only use it with ``adaptive_concurrency`` set in the config: it
+    starts at ``concurrency_initial``, so it holds back callers that ask for
+    more concurrency, such as ``query_many``, until it has grown.
+    """
+    STATS = ("admitted", "queued", "successes", "rate_limited", "timeouts", "latency_spikes", "decreases")
+    
+    def __init__(self, name: str, initial: float = 4, min_limit: float = 1, max_limit: float = 64,
+                 backoff: float = 0.5, latency_tolerance: float = 2.0, min_samples: int = 10):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.min_samples = min_samples
+        self.in_flight = 0
+        self._waiters: deque = deque()
+        self._lock = threading.Lock()
+        self._baseline: Optional[float] = None
+        self._samples = 0
+        self._slow_start = True
+        self._last_decrease = float("-inf")
+        self._peak = 0
+        self._counts = dict.fromkeys(self.STATS, 0)
+    
+    @staticmethod
+    def clock() -> float:
+        return time.monotonic()
+    
+    def _admit(self) -> bool:
+        if self._waiters or self.in_flight >= max(1, int(self.limit)):
+            return False
+        self.in_flight += 1
+        self._counts["admitted"] += 1
+        self._peak = max(self._peak, self.in_flight)
+        return True
+    
+    def _wake(self):
+        # Hand freed slots to waiters directly, so a new arrival cannot take them first
+        while self._waiters and self.in_flight < max(1, int(self.limit)):
+            self.in_flight += 1
+            self._counts["admitted"] += 1
+            self._peak = max(self._peak, self.in_flight)
+            self._waiters.popleft()()
+    
+    def acquire(self) -> float:
+        """Wait for a slot; return when it was granted, for ``release``."""
+        with self._lock:
+            if self._admit():
+                return self.clock()
+            granted = threading.Event()
+            self._waiters.append(granted.set)
+            self._counts["queued"] += 1
+        granted.wait()
+        return self.clock()
+    
+    async def acquire_async(self) -> float:
+        """Asyncio version of ``acquire``."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._admit():
+                return self.clock()
+            granted = loop.create_future()
+            wake = lambda: loop.call_soon_threadsafe(_resolve_waiter, granted)
+            self._waiters.append(wake)
+            self._counts["queued"] += 1
+        try:
+            await granted
+        except asyncio.CancelledError:
+            with self._lock:
+                try:
+                    self._waiters.remove(wake)
+                    handed_over = False
+                except ValueError:
+                    handed_over = True
+            if handed_over:
+                self.release(self.clock())
+            raise
+        return self.clock()
+    
+    def release(self, started: float, latency: Optional[float] = None, error: Optional[BaseException] = None):
+        """Free a slot granted at ``started`` and adapt the limit to how the
+        request went: ``latency`` (time to first chunk) if it succeeded, the
+        ``error`` if it failed, neither if it was cancelled."""
+        message = None
+        with self._lock:
+            old = self.limit
+            reason = overload_reason(error) if error is not None else None
+            if reason is None and latency is not None:
+                if (self._baseline is not None and self._samples >= self.min_samples
+                        and latency > self.latency_tolerance * self._baseline):
+                    reason = "latency_spikes"
+                    self._baseline = 0.95 * self._baseline + 0.05 * latency
+                else:
+                    self._counts["successes"] += 1
+                    self._samples += 1
+                    self._baseline = latency if self._baseline is None else 0.9 * self._baseline + 0.1 * latency
+                    # Only grow while the limit is what holds requests back
+                    if self.in_flight >= self.limit / 2:
+                        self.limit = min(self.max_limit, self.limit + (1 if self._slow_start else 1 / self.limit))
+            if reason is not None:
+                self._counts[reason] += 1
+                if started >= self._last_decrease:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self._slow_start = False
+                    self._last_decrease = self.clock()
+                    self._counts["decreases"] += 1
+                    message = (f"{self.name}: {reason.replace('_', ' ')}, concurrency limit {old:.1f} -> "
+                               f"{self.limit:.1f} ({self.in_flight} in flight, {len(self._waiters)} waiting)")
+            self.in_flight -= 1
+            self._wake()
+            grew = int(self.limit) > int(old)
+        if message:
+            logger.warning(message)
+        elif grew:
+            logger.debug(f"{self.name}: concurrency limit raised to {int(self.limit)}")
+    
+    def stats(self) -> Dict[str, Any]:
+        """Current limit, requests in flight and waiting, and lifetime counts."""
+        with self._lock:
+            stats = {
+                "limit": self.limit,
+                "in_flight": self.in_flight,
+                "waiting": len(self._waiters),
+                "peak_in_flight": self._peak,
+                "baseline_latency": self._baseline,
+                "slow_start": self._slow_start,
+                **self._counts
+            }
+        return stats
+
+_concurrency_limiters: Dict[Tuple[str, Optional[str]], AdaptiveConcurrencyLimiter] = {}
+_concurrency_limiters_lock = threading.Lock()
+
+def get_concurrency_limiter(config: LLMConfig, provider: str, model: Optional[str]) -> AdaptiveConcurrencyLimiter:
+    """Get the process-wide adaptive concurrency limiter of a provider and model."""
+    with _concurrency_limiters_lock:
+        limiter = _concurrency_limiters.get((provider, model))
+        if limiter is None:
+            limiter = _concurrency_limiters[(provider, model)] = AdaptiveConcurrencyLimiter(
+                f"{provider}/{model}", config.config.get("concurrency_initial", 4),
+                max_limit=config.config.get("concurrency_max", 64)
+            )
+        return limiter
+
+def concurrency_stats() -> Dict[str, Dict[str, Any]]:
+    """Adaptive concurrency state, keyed by "provider/model"."""
+    with _concurrency_limiters_lock:
+        limiters = dict(_concurrency_limiters)
+    return {f"{provider}/{model}": limiter.stats() for (provider, model), limiter in limiters.items()}
+
+def concurrency_exposition() -> List[str]:
+    """Adaptive concurrency state in the text exposition format."""
+    with _concurrency_limiters_lock:
+        limiters = sorted(_concurrency_limiters.items(), key=lambda item: (item[0][0], str(item[0][1])))
+    
+    def labels(provider, model, **extra):
+        pairs = {"provider": provider, "model": model, **extra}
+        return "{" + ",".join(f"{key}={json.dumps(str(value))}" for key, value in pairs.items()) + "}"
+    
+    lines = []
+    for name, kind, help_text in (
+        ("llm_concurrency_limit", "gauge", "Adaptive limit on LLM requests in flight."),
+        ("llm_concurrency_in_flight", "gauge", "LLM requests in flight."),
+        ("llm_concurrency_waiting", "gauge", "LLM requests waiting for a concurrency slot."),
+        ("llm_concurrency_decreases_total", "counter", "Cuts of the adaptive concurrency limit."),
+        ("llm_concurrency_overloads_total", "counter", "Requests that signalled overload, by reason.")
+    ):
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        for (provider, model), limiter in limiters:
+            stats = limiter.stats()
+            if name == "llm_concurrency_overloads_total":
+                for reason in ("rate_limited", "timeouts", "latency_spikes"):
+                    lines.append(f"{name}{labels(provider, model, reason=reason)} {stats[reason]}")
+                continue
+            value = {
+                "llm_concurrency_limit": stats["limit"],
+                "llm_concurrency_in_flight": stats["in_flight"],
+                "llm_concurrency_waiting": stats["waiting"],
+                "llm_concurrency_decreases_total": stats["decreases"]
+            }[name]
+            lines.append(f"{name}{labels(provider, model)} {value!r}")
+    return lines
+
+if usage_metrics is not None:
+    usage_metrics.add_collector(concurrency_exposition)
+
+@dataclass
+class QueryResult:
+    """Outcome of one prompt in a batch: its response, or the error it raised."""
+    index: int
+    prompt: str
+    response: Optional[str] = None
+    error: Optional[Exception] = None
+    
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+CURSOR_UNAVAILABLE = "This functionality is only available within the Cursor IDE environment."
+
+# Blocking provider calls made by aquery run here rather than in the event
+# loop's default executor, which is too small to keep large batches in flight
+PROVIDER_THREADS = 64
+_provider_executor: Optional[ThreadPoolExecutor] = None
+_provider_executor_lock = threading.Lock()
+
+def provider_executor() -> ThreadPoolExecutor:
+    """Get the thread pool that runs blocking provider calls for aquery."""
+    global _provider_executor
+    with _provider_executor_lock:
+        if _provider_executor is None:
+            _provider_executor = ThreadPoolExecutor(PROVIDER_THREADS, thread_name_prefix="llm-provider")
+        return _provider_executor
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of a text (about four characters per token)."""
+    return max(1, len(text) // 4)
 
 class RateLimiter:
-    """Simple rate limiter implementation."""
+    """Rate limiter for requests and tokens per minute, using GCRA.
+
+    Each limit is a generic cell rate algorithm: one "theoretical arrival
+    time" per limit is advanced by a cost's share of the minute, and a
+    request is admitted when that stays within a minute of now. That allows
+    bursts of up to a full minute's budget, like a token bucket, with O(1)
+    admission, and tells a throttled caller exactly how long to wait.
+    Thread-safe; ``acquire`` sleeps and ``acquire_async`` awaits.
+    """
+    WINDOW = 60.0
+    # Index of each field in the state yielded by _locked()
+    REQUEST_TAT, TOKEN_TAT, ADMITTED, THROTTLED, WAITED = range(5)
     
-    def __init__(self, requests_per_minute: int):
+    def __init__(self, requests_per_minute: Optional[float], tokens_per_minute: Optional[float] = None):
         self.requests_per_minute = requests_per_minute
-        self.requests = []
+        self.tokens_per_minute = tokens_per_minute
+        # Arrival times (on the monotonic clock), admitted and throttled
+        # counts, and total seconds callers were told to wait
+        self._state = [0.0, 0.0, 0, 0, 0.0]
+        self._lock = threading.Lock()
     
-    def can_make_request(self) -> bool:
-        """Check if a request can be made based on rate limits."""
-        now = time.time()
-        # Remove requests older than 1 minute
-        self.requests = [t for t in self.requests if now - t < 60]
-        
-        if len(self.requests) < self.requests_per_minute:
-            self.requests.append(now)
+    @staticmethod
+    def clock() -> float:
+        return time.monotonic()
+    
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the limiter's state for a read-modify-write"""
+        with self._lock:
+            yield self._state
+    
+    def _cost(self, limit: Optional[float], amount: float) -> float:
+        """Seconds of a limit's budget used by an amount; never more than the
+        whole window, so oversized requests still get through eventually"""
+        if not limit:
+            return 0.0
+        return min(amount, limit) * self.WINDOW / limit
+    
+    def _delay(self, state, now: float, tokens: int) -> Tuple[float, float, float]:
+        """Seconds until a request of this many tokens fits, and the new arrival times"""
+        request_tat = max(state[self.REQUEST_TAT], now) + self._cost(self.requests_per_minute, 1)
+        token_tat = max(state[self.TOKEN_TAT], now) + self._cost(self.tokens_per_minute, tokens)
+        delay = max(request_tat, token_tat) - self.WINDOW - now
+        return max(0.0, delay), request_tat, token_tat
+    
+    def reserve(self, tokens: int = 0) -> float:
+        """Reserve the next slot for a request; returns how long to wait for it."""
+        with self._locked() as state:
+            delay, state[self.REQUEST_TAT], state[self.TOKEN_TAT] = self._delay(state, self.clock(), tokens)
+            state[self.ADMITTED] += 1
+            if delay > 0:
+                state[self.THROTTLED] += 1
+                state[self.WAITED] += delay
+            return delay
+    
+    def can_make_request(self, tokens: int = 0) -> bool:
+        """Admit a request if it fits right now; nothing is reserved otherwise."""
+        with self._locked() as state:
+            delay, request_tat, token_tat = self._delay(state, self.clock(), tokens)
+            if delay > 0:
+                state[self.THROTTLED] += 1
+                return False
+            state[self.REQUEST_TAT], state[self.TOKEN_TAT] = request_tat, token_tat
+            state[self.ADMITTED] += 1
             return True
-        return False
     
-    def wait_for_request(self) -> None:
+    def record_tokens(self, tokens: int):
+        """Charge tokens only known after the fact, e.g. a response's completion."""
+        if not self.tokens_per_minute or tokens <= 0:
+            return
+        with self._locked() as state:
+            state[self.TOKEN_TAT] = max(state[self.TOKEN_TAT], self.clock()) + self._cost(self.tokens_per_minute, tokens)
+    
+    def utilization(self) -> Dict[str, Any]:
+        """Share of each per-minute budget in use, pending wait, and lifetime counts.
+
+        A utilization above 1 means callers have reserved slots beyond the
+        current window and are queued.
+        """
+        with self._locked() as state:
+            now = self.clock()
+            delay = self._delay(state, now, 0)[0]
+            snapshot = list(state)
+        return {
+            "requests": max(0.0, snapshot[self.REQUEST_TAT] - now) / self.WINDOW if self.requests_per_minute else 0.0,
+            "tokens": max(0.0, snapshot[self.TOKEN_TAT] - now) / self.WINDOW if self.tokens_per_minute else 0.0,
+            "wait": delay,
+            "admitted": int(snapshot[self.ADMITTED]),
+            "throttled": int(snapshot[self.THROTTLED]),
+            "waited": snapshot[self.WAITED]
+        }
+    
+    def acquire(self, tokens: int = 0) -> float:
+        """Wait exactly until a request of this many tokens may be sent; returns the wait."""
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+    
+    async def acquire_async(self, tokens: int = 0) -> float:
+        """Like ``acquire``, but waits without blocking the event loop."""
+        delay = self.reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+    
+    def wait_for_request(self, tokens: int = 0) -> None:
         """Wait until a request can be made."""
-        while not self.can_make_request():
-            time.sleep(1)
+        self.acquire(tokens)
+
+class SharedRateLimiter(RateLimiter):
+    """RateLimiter whose state is shared by every process on the host.
+
+    The state lives in a small memory-mapped file guarded by ``flock``, so
+    all clients of a provider draw from one budget; an admission costs a
+    lock, unlock and a few bytes of shared memory, a few microseconds.
+    Times are wall-clock, since the file outlives reboots. The file is
+    reopened after a fork, as a shared flock would not exclude the parent,
+    and by an admission after ``close()``.
+    """
+    LAYOUT = struct.Struct("<ddqqd")
+    
+    def __init__(self, path: Path, requests_per_minute: Optional[float],
+                 tokens_per_minute: Optional[float] = None):
+        if fcntl is None:
+            raise RuntimeError("Shared rate limiting needs fcntl.flock, which this platform lacks")
+        super().__init__(requests_per_minute, tokens_per_minute)
+        self.path = Path(path)
+        self._pid = None
+        self._open()
+    
+    @staticmethod
+    def clock() -> float:
+        return time.time()
+    
+    def _open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size < self.LAYOUT.size:
+                    os.ftruncate(fd, self.LAYOUT.size)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            self._map = mmap.mmap(fd, self.LAYOUT.size)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+        self._pid = os.getpid()
+    
+    def close(self):
+        with self._lock:
+            if self._pid is not None:
+                self._map.close()
+                os.close(self._fd)
+                self._pid = None
+    
+    @contextlib.contextmanager
+    def _locked(self):
+        # The thread lock is needed too: flock does not exclude threads
+        # sharing one file descriptor
+        with self._lock:
+            if self._pid != os.getpid():
+                if self._pid is not None:  # Forked: drop the parent's handles
+                    self._map.close()
+                    os.close(self._fd)
+                self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                state = list(self.LAYOUT.unpack_from(self._map))
+                yield state
+                self.LAYOUT.pack_into(self._map, 0, *state)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+_shared_limiters: Dict[Path, SharedRateLimiter] = {}
+_shared_limiters_lock = threading.Lock()
+
+def rate_limit_path(config: LLMConfig, provider: str) -> Path:
+    """Path of the host-wide rate limit state for a provider."""
+    return config.get_rate_limit_dir() / f"{re.sub(r'[^A-Za-z0-9_.-]', '_', provider)}.state"
+
+def rate_limit_utilization(config: Optional[LLMConfig] = None) -> Dict[str, Dict[str, Any]]:
+    """Current utilization of every provider's host-wide rate limit."""
+    config = config or get_config()
+    usage = {}
+    if fcntl is None:
+        return usage
+    for path in sorted(config.get_rate_limit_dir().glob("*.state")):
+        provider_config = config.get_provider_config(path.stem)
+        limiter = SharedRateLimiter(path, provider_config.get("rate_limit", 60), provider_config.get("token_rate_limit"))
+        try:
+            usage[path.stem] = limiter.utilization()
+        finally:
+            limiter.close()
+    return usage
+
+def create_rate_limiter(config: LLMConfig, provider: str) -> RateLimiter:
+    """Get the rate limiter for a provider: shared with every process on the
+    host unless ``rate_limit_scope`` is "process" or the platform lacks flock."""
+    provider_config = config.get_provider_config(provider)
+    limits = (provider_config.get("rate_limit", 60), provider_config.get("token_rate_limit"))
+    if config.config.get("rate_limit_scope", "host") != "host" or fcntl is None:
+        return RateLimiter(*limits)
+    path = rate_limit_path(config, provider).resolve()
+    with _shared_limiters_lock:
+        limiter = _shared_limiters.get(path)
+        if limiter is None or (limiter.requests_per_minute, limiter.tokens_per_minute) != limits:
+            old = limiter
+            try:
+                limiter = _shared_limiters[path] = SharedRateLimiter(path, *limits)
+            except OSError as e:
+                logger.error(f"Error opening shared rate limit state {path}: {e}")
+                return RateLimiter(*limits)
+            if old is not None:
+                # Clients still holding it reopen the file if they use it again
+                old.close()
+        return limiter
 
 class LLMClient:
     """Enhanced LLM client using CursorAI's built-in capabilities."""
     
-    def __init__(self, provider: str = "cursor", model: Optional[str] = None):
+    def __init__(self, provider: str = "cursor", model: Optional[str] = None, config: Optional[LLMConfig] = None):
         self.provider = provider
         self.model = model
-        self.config = LLMConfig()
-        self.rate_limiter = RateLimiter(
-            self.config.get_provider_config(provider).get("rate_limit", 60)
-        )
+        self.config = config or get_config()
+        self.rate_limiter = create_rate_limiter(self.config, provider)
+        self._generation = self.config.generation
         logger.info(f"Initialized LLM client with provider={provider}, model={model}")
     
-    def _get_cache_key(self, prompt: str) -> str:
+    def refresh(self):
+        """Pick up a reloaded configuration, rebuilding the rate limiter if needed."""
+        self.config.refresh()
+        if self._generation != self.config.generation:
+            self.rate_limiter = create_rate_limiter(self.config, self.provider)
+            self._generation = self.config.generation
+    
+    def _get_cache_key(self, prompt: str, sampling: Optional[Dict[str, Any]] = None) -> str:
         """Generate a cache key for the prompt."""
-        return hashlib.md5(f"{self.provider}:{self.model}:{prompt}".encode()).hexdigest()
+        return ResponseCache.key(self.provider, self.model, prompt, sampling)
+    
+    def _response_cache(self) -> Optional[ResponseCache]:
+        """Get the persistent response cache, or None if it cannot be opened."""
+        try:
+            return get_response_cache(self.config)
+        except sqlite3.Error as e:
+            logger.error(f"Error opening response cache: {e}")
+            return None
+    
+    def query(self, prompt: str, **sampling) -> str:
+        """Send a query to CursorAI, answering repeated prompts from the response caches.
+
+        Sampling parameters (e.g. ``temperature``) are part of the cache key,
+        so responses produced under different settings are kept apart.
+        Concurrent calls with the same key share one upstream request.
+        """
+        return "".join(self.stream(prompt, **sampling))
+    
+    def stream(self, prompt: str, **sampling) -> Iterator[str]:
+        """Like ``query``, but yield the response in chunks as they arrive.
+
+        A cached response, or one shared with a concurrent identical query,
+        arrives as a single chunk.
+        """
+        cache_key = self._get_cache_key(prompt, sampling)
+        cached = self._cached_response(cache_key)
+        if cached is not None:
+            yield cached
+            return
+        near, audit = self._near_duplicate_response(prompt, sampling)
+        if near is not None and not audit:
+            yield near
+            return
+        if self.config.is_coalescing_enabled():
+            chunks = request_flights.stream(cache_key, lambda: self._fetch(prompt, cache_key, sampling))
+        else:
+            chunks = self._fetch(prompt, cache_key, sampling)
+        if near is None:
+            yield from chunks
+            return
+        fresh = []
+        for chunk in chunks:
+            fresh.append(chunk)
+            yield chunk
+        self._audit_near_duplicate(near, "".join(fresh))
+    
+    def _caching(self) -> Tuple[bool, float]:
+        ttl = self.config.get_cache_ttl(self.provider)
+        return self.config.is_cache_enabled() and ttl > 0, ttl
     
-    @lru_cache(maxsize=1000)
-    def query(self, prompt: str) -> str:
-        """Send a query to CursorAI."""
-        if self.config.is_rate_limiting_enabled():
-            self.rate_limiter.wait_for_request()
+    def _cached_response(self, cache_key: str) -> Optional[str]:
+        """Look a key up in the memory cache, then the persistent one."""
+        caching, ttl = self._caching()
+        if not caching:
+            return None
+        entry = memory_response_cache.get(cache_key)
+        if entry is None:
+            cache = self._response_cache()
+            if cache is not None:
+                try:
+                    entry = cache.get_entry(cache_key, ttl)
+                except sqlite3.Error as e:
+                    logger.error(f"Error reading response cache: {e}")
+            if entry is not None:
+                memory_response_cache.put(cache_key, entry)
+        if entry is None:
+            return None
+        logger.info(f"Response cache hit for key: {cache_key}")
+        return entry.response
+    
+    def _near_duplicates(self) -> Optional[NearDuplicateIndex]:
+        """Get the near-duplicate index if that opt-in cache layer is enabled and can be opened."""
+        if not self.config.is_near_duplicate_cache_enabled() or not self._caching()[0]:
+            return None
+        try:
+            return get_near_duplicate_index(self.config)
+        except sqlite3.Error as e:
+            logger.error(f"Error opening near-duplicate index: {e}")
+            return None
+    
+    def _near_duplicate_response(self, prompt: str, sampling: Dict[str, Any]) -> Tuple[Optional[str], bool]:
+        """Find the cached response of a near-duplicate prompt, and whether
+        this hit was sampled for an audit against a fresh response."""
+        index = self._near_duplicates()
+        if index is None:
+            return None, False
+        canonical = canonicalize_prompt(prompt, self.config.get_volatile_line_patterns())
+        try:
+            matches = index.lookup(NearDuplicateIndex.scope(self.provider, self.model, sampling), canonical,
+                                   self.config.get_near_duplicate_threshold())
+            for key, similarity in matches:
+                response = self._cached_response(key)
+                if response is None:
+                    index.discard(key)
+                    continue
+                index.record_hit(similarity)
+                logger.info(f"Near-duplicate cache hit (similarity {similarity:.3f}) for key: {key}")
+                return response, random.random() < self.config.get_near_duplicate_audit_rate()
+        except sqlite3.Error as e:
+            logger.error(f"Error reading near-duplicate index: {e}")
+        return None, False
+    
+    def _audit_near_duplicate(self, reused: str, fresh: str):
+        """Record whether a fresh response agrees with the near-duplicate one that would have been reused."""
+        index = self._near_duplicates()
+        if index is None:
+            return
+        agreed = jaccard(shingles(reused), shingles(fresh)) >= self.config.get_near_duplicate_threshold()
+        if not agreed:
+            logger.warning("Near-duplicate audit: fresh response differs from the reused one")
+        try:
+            index.record_audit(agreed)
+        except sqlite3.Error as e:
+            logger.error(f"Error writing near-duplicate index: {e}")
+    
+    def _index_near_duplicate(self, prompt: str, cache_key: str, sampling: Dict[str, Any]):
+        index = self._near_duplicates()
+        if index is None:
+            return
+        canonical = canonicalize_prompt(prompt, self.config.get_volatile_line_patterns())
+        try:
+            index.add(NearDuplicateIndex.scope(self.provider, self.model, sampling), cache_key, canonical)
+        except sqlite3.Error as e:
+            logger.error(f"Error writing near-duplicate index: {e}")
+    
+    def _hedge_plan(self) -> Optional[Tuple["LLMClient", float, HedgeBudget]]:
+        """The backup client, hedge delay and budget for a fresh request, or
+        None if this provider has no backup or too few timings yet.
+
+        The delay is the primary's rolling p95 time to first chunk.
+        """
+        target = self.config.get_hedge_target(self.provider)
+        if target is None:
+            return None
+        budget = get_hedge_budget(self.config, self.provider, self.model)
+        budget.earn()
+        delay = query_timings.percentile(self.provider, self.model, 0.95,
+                                         min_samples=self.config.config.get("hedge_min_samples", 20))
+        if delay is None:
+            return None
+        return pooled_llm_client(self.config, *target), delay, budget
+    
+    def _fetch(self, prompt: str, cache_key: str, sampling: Dict[str, Any]) -> Iterator[str]:
+        """Stream a fresh response, hedged if this provider has a backup."""
+        hedge = self._hedge_plan()
+        if hedge is not None:
+            yield from self._hedged_stream(prompt, cache_key, sampling, *hedge)
+        else:
+            yield from self._fetch_direct(prompt, cache_key, sampling)
+    
+    def _hedged_stream(self, prompt: str, cache_key: str, sampling: Dict[str, Any], backup: "LLMClient",
+                       delay: float, budget: HedgeBudget) -> Iterator[str]:
+        """Stream from whichever of this client and ``backup`` responds first.
+
+        The primary request starts at once. If it has not produced a chunk
+        ``delay`` seconds after its provider call began, or fails first, and
+        the budget allows, the same prompt goes to the backup; time spent
+        waiting on our own limiters does not count. The first request to
+        produce a chunk wins; the other is cancelled. A request cancelled
+        while it waits on a limiter never calls its provider; a provider call
+        that is already blocking cannot be interrupted, so a cancelled
+        request stops (and caches nothing) once that call returns.
+        """
+        events: queue.Queue = queue.Queue()
+        cancelled = {"primary": threading.Event(), "backup": threading.Event()}
+        
+        def race(name: str, client: "LLMClient", key: str):
+            stream = client._fetch_direct(prompt, key, sampling, cancelled[name],
+                                          lambda: events.put((name, _STREAM_CALLING, None)))
+            try:
+                for chunk in stream:
+                    if cancelled[name].is_set():
+                        return
+                    events.put((name, chunk, None))
+                if cancelled[name].is_set():
+                    return
+                events.put((name, _STREAM_DONE, None))
+            except Exception as e:
+                events.put((name, None, e))
+            finally:
+                stream.close()
         
-        cache_key = self._get_cache_key(prompt)
+        def launch(name: str, client: "LLMClient", key: str):
+            threading.Thread(target=race, args=(name, client, key), name=f"llm-hedge-{name}", daemon=True).start()
+        
+        launch("primary", self, cache_key)
+        # Set once the primary's provider call starts
+        deadline = None
+        racing, failed = {"primary"}, {}
+        winner = None
+        try:
+            while True:
+                timeout = None
+                if winner is None and "backup" not in racing and deadline is not None:
+                    timeout = max(0.0, deadline - time.monotonic())
+                try:
+                    name, chunk, error = events.get(timeout=timeout)
+                except queue.Empty:
+                    deadline = None
+                    if budget.try_spend():
+                        logger.info(f"No response from {self.provider} after {delay:.2f}s, hedging to {backup.provider}")
+                        racing.add("backup")
+                        launch("backup", backup, backup._get_cache_key(prompt, sampling))
+                    continue
+                if chunk is _STREAM_CALLING:
+                    if name == "primary":
+                        deadline = time.monotonic() + delay
+                    continue
+                if winner is None:
+                    if error is not None:
+                        failed[name] = error
+                        if name == "primary" and "backup" not in racing and budget.try_spend():
+                            logger.warning(f"{self.provider} failed ({error}), failing over to {backup.provider}")
+                            racing.add("backup")
+                            launch("backup", backup, backup._get_cache_key(prompt, sampling))
+                        elif failed.keys() == racing:
+                            raise failed["primary"]
+                        continue
+                    winner = name
+                    for other in racing - {winner}:
+                        cancelled[other].set()
+                    if "backup" in racing:
+                        budget.record_winner(winner == "backup")
+                if name != winner:
+                    continue
+                if error is not None:
+                    raise error
+                if chunk is _STREAM_DONE:
+                    return
+                yield chunk
+        finally:
+            for event in cancelled.values():
+                event.set()
+    
+    def _concurrency_limiter(self) -> Optional[AdaptiveConcurrencyLimiter]:
+        """Get the adaptive concurrency limiter, if rate limiting and it are enabled."""
+        if not self.config.is_rate_limiting_enabled() or not self.config.config.get("adaptive_concurrency", False):
+            return None
+        return get_concurrency_limiter(self.config, self.provider, self.model)
+    
+    def _fetch_direct(self, prompt: str, cache_key: str, sampling: Dict[str, Any],
+                      cancelled: Optional[threading.Event] = None,
+                      on_call: Optional[Callable[[], None]] = None) -> Iterator[str]:
+        """Stream a fresh response within the concurrency and rate limits.
+
+        Once ``cancelled`` is set the request yields nothing and stops at its
+        next limiter or before the provider call; ``on_call`` is called just
+        before the provider call starts.
+        """
+        if cancelled is not None and cancelled.is_set():
+            return
+        rate_limited = self.config.is_rate_limiting_enabled()
+        limiter = self._concurrency_limiter()
+        started = limiter.acquire() if limiter is not None else None
+        outcome = {}
+        try:
+            if cancelled is not None and cancelled.is_set():
+                return
+            if rate_limited:
+                self.rate_limiter.acquire(estimate_tokens(prompt))
+                if cancelled is not None and cancelled.is_set():
+                    return
+            if on_call is not None:
+                on_call()
+            outcome["latency"] = yield from self._stream_fresh(prompt, cache_key, sampling, rate_limited)
+        except Exception as e:
+            outcome["error"] = e
+            raise
+        finally:
+            if limiter is not None:
+                limiter.release(started, **outcome)
+    
+    def _stream_fresh(self, prompt: str, cache_key: str, sampling: Dict[str, Any],
+                      rate_limited: bool) -> Iterator[str]:
+        """Stream a fresh response, record its timings and cache it once
+        complete; the generator returns the time to first chunk."""
         logger.info(f"Querying CursorAI with cache key: {cache_key}")
+        chunks = []
+        ttft = None
+        start = time.perf_counter()
+        try:
+            for chunk in self._stream_provider(prompt):
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                chunks.append(chunk)
+                yield chunk
+        except GeneratorExit:
+            # Cancelled (e.g. a hedge won) or abandoned: record the wait so far as
+            # a lower bound, so hedging does not hide how slow the provider is
+            elapsed = time.perf_counter() - start
+            query_timings.record(self.provider, self.model, elapsed if ttft is None else ttft, elapsed)
+            raise
+        except ImportError:
+            logger.warning("CursorAI module not available - this is expected when running outside Cursor IDE")
+            yield CURSOR_UNAVAILABLE
+            return None
+        total = time.perf_counter() - start
+        ttft = total if ttft is None else ttft
+        query_timings.record(self.provider, self.model, ttft, total)
+        logger.info(f"Received response in {total:.2f}s (first chunk after {ttft:.2f}s)")
+        response = "".join(chunks) if chunks else None
+        if rate_limited and response is not None:
+            self.rate_limiter.record_tokens(estimate_tokens(response))
+        self._store(cache_key, response, total)
+        if response is not None:
+            self._index_near_duplicate(prompt, cache_key, sampling)
+        return ttft
+    
+    async def aquery(self, prompt: str, **sampling) -> str:
+        """Asyncio version of ``query``: waits for the rate limiter and the
+        provider without blocking the event loop."""
+        cache_key = self._get_cache_key(prompt, sampling)
+        loop = asyncio.get_running_loop()
+        cached = await loop.run_in_executor(provider_executor(), self._cached_response, cache_key)
+        if cached is not None:
+            return cached
+        near, audit = await loop.run_in_executor(provider_executor(), self._near_duplicate_response, prompt, sampling)
+        if near is not None and not audit:
+            return near
+        if self.config.is_coalescing_enabled():
+            response = await request_flights.do_async(cache_key, lambda: self._afetch(prompt, cache_key, sampling))
+        else:
+            response = await self._afetch(prompt, cache_key, sampling)
+        if near is not None:
+            await loop.run_in_executor(provider_executor(), self._audit_near_duplicate, near, response)
+        return response
+    
+    async def _afetch(self, prompt: str, cache_key: str, sampling: Dict[str, Any]) -> str:
+        """Asyncio version of ``_fetch``. The CursorAI call itself is
+        blocking, so the response is read on the provider thread pool."""
+        hedge = self._hedge_plan()
+        if hedge is not None:
+            return await asyncio.get_running_loop().run_in_executor(
+                provider_executor(), lambda: "".join(self._hedged_stream(prompt, cache_key, sampling, *hedge))
+            )
+        rate_limited = self.config.is_rate_limiting_enabled()
+        limiter = self._concurrency_limiter()
+        started = await limiter.acquire_async() if limiter is not None else None
+        outcome = {}
+        try:
+            if rate_limited:
+                await self.rate_limiter.acquire_async(estimate_tokens(prompt))
+            response, outcome["latency"] = await asyncio.get_running_loop().run_in_executor(
+                provider_executor(), lambda: drain(self._stream_fresh(prompt, cache_key, sampling, rate_limited))
+            )
+            return response
+        except Exception as e:
+            outcome["error"] = e
+            raise
+        finally:
+            if limiter is not None:
+                limiter.release(started, **outcome)
+    
+    async def aiter_query_many(self, prompts: Iterable[str], concurrency: int = 8,
+                               **sampling) -> AsyncIterator[QueryResult]:
+        """Query many prompts with up to ``concurrency`` in flight, yielding
+        results as they complete.
+
+        A prompt that fails yields a result carrying its error; the rest of
+        the batch carries on. Requests still wait for the rate limiter, and
+        for the adaptive concurrency limit if ``adaptive_concurrency`` is on.
+        """
+        if concurrency < 1:
+            raise ValueError(f"concurrency must be at least 1, got {concurrency}")
+        prompts = list(prompts)
+        pending = iter(enumerate(prompts))
+        results: asyncio.Queue = asyncio.Queue()
+        closing = False
+        
+        async def worker():
+            for index, prompt in pending:
+                try:
+                    result = QueryResult(index, prompt, await self.aquery(prompt, **sampling))
+                except asyncio.CancelledError as e:
+                    if closing:
+                        raise
+                    # Cancelled from outside the batch, e.g. by a call this prompt joined
+                    logger.error(f"Query for prompt {index} of batch was cancelled")
+                    error = RuntimeError(f"Query for prompt {index} of batch was cancelled")
+                    error.__cause__ = e
+                    result = QueryResult(index, prompt, error=error)
+                except Exception as e:
+                    logger.error(f"Error querying prompt {index} of batch: {e}")
+                    result = QueryResult(index, prompt, error=e)
+                results.put_nowait(result)
         
+        workers = [asyncio.create_task(worker()) for _ in range(min(concurrency, len(prompts)))]
+        try:
+            for _ in prompts:
+                yield await results.get()
+        finally:
+            closing = True
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+    
+    async def aquery_many(self, prompts: Iterable[str], concurrency: int = 8, as_completed: bool = False,
+                          **sampling) -> List[QueryResult]:
+        """Query many prompts with up to ``concurrency`` in flight; results are
+        in input order unless ``as_completed``."""
+        results = [result async for result in self.aiter_query_many(prompts, concurrency, **sampling)]
+        if not as_completed:
+            results.sort(key=lambda result: result.index)
+        return results
+    
+    def query_many(self, prompts: Iterable[str], concurrency: int = 8, as_completed: bool = False,
+                   **sampling) -> List[QueryResult]:
+        """Blocking ``aquery_many``, for callers without an event loop."""
+        return asyncio.run(self.aquery_many(prompts, concurrency, as_completed, **sampling))
+    
+    def _store(self, cache_key: str, response: Optional[str], latency: float):
+        """Put a fresh response in both caches."""
+        caching, ttl = self._caching()
+        if not caching or response is None:
+            return
+        now = time.time()
+        memory_response_cache.put(cache_key, CacheEntry(
+            response, self.provider, self.model, now, now + ttl, latency, len(response.encode("utf-8"))
+        ))
+        cache = self._response_cache()
+        if cache is not None:
+            try:
+                cache.put(cache_key, response, self.provider, self.model, latency)
+            except sqlite3.Error as e:
+                logger.error(f"Error writing response cache: {e}")
+    
+    def invalidate(self, prompt: Optional[str] = None, **sampling) -> int:
+        """Drop a prompt's cached response, or every response for this provider and model."""
+        if prompt is not None:
+            filters = {"key": self._get_cache_key(prompt, sampling)}
+        else:
+            filters = {"provider": self.provider, "model": self.model}
+        removed = memory_response_cache.invalidate(**filters)
+        cache = self._response_cache()
+        if cache is not None:
+            try:
+                removed = max(removed, cache.invalidate(**filters))
+            except sqlite3.Error as e:
+                logger.error(f"Error invalidating response cache: {e}")
+        return removed
+    
+    def _stream_provider(self, prompt: str) -> Iterator[str]:
+        """Yield a fresh response from CursorAI in chunks as they arrive.
+
+        Uses CursorAI's streaming interface where it has one; otherwise the
+        complete response is split into lines.
+        """
+        if os.environ.get('CURSOR_IDE'):
+            from cursor import CursorAI
+            stream = getattr(CursorAI, "stream", None)
+            if stream is not None:
+                yield from stream(prompt)
+                return
+        response = self._query_provider(prompt)
+        if response is not None:
+            yield from response.splitlines(keepends=True)
+    
+    def _query_provider(self, prompt: str) -> str:
+        """Get a fresh response from CursorAI."""
         try:
             # Check if we're running in Cursor IDE
             if os.environ.get('CURSOR_IDE'):
@@ -228,19 +2003,36 @@ Generic implementation plan template.
 - Testing framework
 [/PLAN]"""
         except ImportError:
-            logger.warning("CursorAI module not available - this is expected when running outside Cursor IDE")
-            return "This functionality is only available within the Cursor IDE environment."
+            raise
         except Exception as e:
             logger.error(f"Error querying CursorAI: {e}")
             raise
 
+_clients: Dict[Tuple[str, str, Optional[str]], LLMClient] = {}
+_clients_lock = threading.Lock()
+
+def pooled_llm_client(config: LLMConfig, provider: str, model: Optional[str] = None) -> LLMClient:
+    """Get the process-wide client of a configuration, provider and model."""
+    if not model:
+        model = config.get_provider_config(provider).get("default_model")
+    key = (config.config_path, provider, model)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = LLMClient(provider=provider, model=model, config=config)
+            return client
+    client.refresh()
+    return client
+
 def create_llm_client(provider: str = "cursor", model: Optional[str] = None) -> LLMClient:
-    """Create an LLM client instance with configuration."""
+    """Get the process-wide LLM client for a provider and model.
+
+    Clients are created once per configuration file, provider and model and
+    then reused, keeping their rate limiter and cache state; a changed
+    configuration file is picked up on the next call.
+    """
     try:
-        config = LLMConfig()
-        if not model:
-            model = config.get_provider_config(provider).get("default_model")
-        return LLMClient(provider=provider, model=model)
+        return pooled_llm_client(get_config(), provider, model)
     except Exception as e:
         logger.error(f"Failed to create LLM client: {e}")
         raise
@@ -271,19 +2063,39 @@ def main():
     """CLI entrypoint with enhanced features."""
     try:
         parser = argparse.ArgumentParser(description='Query CursorAI')
-        parser.add_argument('--prompt', type=str, required=True, help='The prompt to send to CursorAI')
+        parser.add_argument('--prompt', type=str, help='The prompt to send to CursorAI')
         parser.add_argument('--debug', action='store_true', help='Enable debug logging')
         parser.add_argument('--config', type=str, help='Path to configuration file')
-    args = parser.parse_args()
-    
+        parser.add_argument('--cache-stats', action='store_true', help='Print response cache statistics and exit')
+        parser.add_argument('--clear-cache', action='store_true', help='Remove every cached response and exit')
+        parser.add_argument('--rate-limits', action='store_true', help='Print host-wide rate limit utilization per provider and exit')
+        args = parser.parse_args()
+        
         if args.debug:
             logger.setLevel(logging.DEBUG)
         
         if args.config:
             os.environ['LLM_CONFIG_PATH'] = args.config
         
-        response = query_llm(args.prompt)
-    print(response)
+        if args.cache_stats or args.clear_cache:
+            cache = get_response_cache()
+            near_duplicates = get_near_duplicate_index()
+            if args.clear_cache:
+                cache.clear()
+                near_duplicates.clear()
+            stats = cache.stats()
+            stats["near_duplicates"] = near_duplicates.stats()
+            print(json.dumps(stats, indent=2))
+            return
+        if args.rate_limits:
+            print(json.dumps(rate_limit_utilization(), indent=2))
+            return
+        if not args.prompt:
+            parser.error("--prompt is required")
+        
+        for chunk in create_llm_client().stream(args.prompt):
+            print(chunk, end="", flush=True)
+        print()
     except Exception as e:
         logger.error(f"Error in main: {e}")
         sys.exit(1)
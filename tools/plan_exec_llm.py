@@ -7,9 +7,8 @@ from dotenv import load_dotenv
 import sys
 import time
 import logging
-from typing import Optional, Dict, Any
-from tools.token_tracker import TokenUsage, APIResponse, get_token_tracker
-from tools.llm_api import query_llm, create_llm_client, LLMConfig
+from typing import Optional, Callable
+from tools.llm_api import create_llm_client, get_config
 
 # Configure logging
 logging.basicConfig(
@@ -53,21 +52,24 @@ def read_file_content(file_path: str) -> Optional[str]:
         return None
 
 def write_file_content(file_path: str, content: str) -> bool:
-    """Write content to a specified file"""
+    """Write content to a specified file, replacing it in one step so readers never see it half written"""
+    temp_path = f"{file_path}.tmp"
     try:
-        with open(file_path, 'w', encoding='utf-8') as f:
+        with open(temp_path, 'w', encoding='utf-8') as f:
             f.write(content)
-            logger.info(f"Successfully wrote content to {file_path}")
-            return True
+        os.replace(temp_path, file_path)
+        logger.info(f"Successfully wrote content to {file_path}")
+        return True
     except Exception as e:
         logger.error(f"Error writing to {file_path}: {e}")
         return False
 
-def update_scratchpad(new_content: str) -> bool:
-    """Update the scratchpad file with new content"""
+def update_scratchpad(new_content: str, existing_content: Optional[str] = None) -> bool:
+    """Update the scratchpad file with new content, applied to ``existing_content`` if given instead of the file as it is now"""
     try:
         # Read existing content
-        existing_content = read_file_content(SCRATCHPAD_FILE)
+        if existing_content is None:
+            existing_content = read_file_content(SCRATCHPAD_FILE)
         if existing_content is None:
             # Create new file if it doesn't exist
             existing_content = "# Scratchpad\n\n"
@@ -139,25 +141,74 @@ def update_lessons(new_lesson: str) -> bool:
         logger.error(f"Error updating lessons: {e}")
         return False
 
+class ScratchpadStream:
+    """Chunk callback that echoes a streamed response to stdout and mirrors
+    the response so far into a marked in-progress section at the end of the
+    scratchpad, rewritten at most every ``interval`` seconds.
+
+    ``finish`` replaces the section with the final content; ``abort`` puts
+    the scratchpad back as it was, so a failed stream never leaves a
+    truncated response behind.
+    """
+    START_MARKER = "<!-- plan_exec_llm: response still streaming, replaced once it completes -->"
+    END_MARKER = "<!-- plan_exec_llm: end of streaming response -->"
+    
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.original = read_file_content(SCRATCHPAD_FILE) if os.path.exists(SCRATCHPAD_FILE) else None
+        self.chunks = []
+        self.last_write = time.monotonic()
+        self.written = False
+    
+    def __call__(self, chunk: str):
+        sys.stdout.write(chunk)
+        sys.stdout.flush()
+        self.chunks.append(chunk)
+        now = time.monotonic()
+        if now - self.last_write >= self.interval:
+            self.written = write_file_content(SCRATCHPAD_FILE, self._in_progress()) or self.written
+            self.last_write = now
+    
+    def _in_progress(self) -> str:
+        base = self.original if self.original is not None else "# Scratchpad\n"
+        return f"{base.rstrip()}\n\n{self.START_MARKER}\n{''.join(self.chunks)}\n{self.END_MARKER}\n"
+    
+    def finish(self, content: str) -> bool:
+        """Replace the in-progress section with the final scratchpad content"""
+        return update_scratchpad(content, self.original)
+    
+    def abort(self):
+        """Restore the scratchpad as it was before the stream started"""
+        if not self.written:
+            return
+        if self.original is not None:
+            write_file_content(SCRATCHPAD_FILE, self.original)
+        else:
+            try:
+                os.remove(SCRATCHPAD_FILE)
+            except OSError as e:
+                logger.error(f"Error removing {SCRATCHPAD_FILE}: {e}")
+
 def query_llm_with_plan(
     plan_content: str,
     user_prompt: Optional[str] = None,
     file_content: Optional[str] = None,
     provider: str = "openai",
-    model: Optional[str] = None
+    model: Optional[str] = None,
+    on_chunk: Optional[Callable[[str], None]] = None
 ) -> Optional[str]:
-    """Query the LLM with combined prompts"""
+    """Query the LLM with combined prompts, passing each chunk of the response to ``on_chunk`` as it arrives"""
     try:
         # Create LLM client with configuration
-        config = LLMConfig()
+        config = get_config()
         if not model:
             model = config.get_provider_config(provider).get("default_model")
         
         client = create_llm_client(provider=provider, model=model)
         logger.info(f"Created LLM client with provider={provider}, model={model}")
         
-    # Combine prompts
-    combined_prompt = f"""You are working on a multi-agent context. The executor is the one who actually does the work. And you are the planner. Now the executor is asking you for help. Please analyze the provided project plan and status, then address the executor's specific query or request.
+        # Combine prompts
+        combined_prompt = f"""You are working on a multi-agent context. The executor is the one who actually does the work. And you are the planner. Now the executor is asking you for help. Please analyze the provided project plan and status, then address the executor's specific query or request.
 
 You need to think like a founder. Prioritize agility and don't over-engineer. Think deep. Try to foresee challenges and derisk earlier. If opportunity sizing or probing experiments can reduce risk with low cost, instruct the executor to do them.
     
@@ -167,11 +218,11 @@ Project Plan and Status:
 ======
 """
 
-    if file_content:
-        combined_prompt += f"\nFile Content:\n======\n{file_content}\n======\n"
+        if file_content:
+            combined_prompt += f"\nFile Content:\n======\n{file_content}\n======\n"
 
-    if user_prompt:
-        combined_prompt += f"\nUser Query:\n{user_prompt}\n"
+        if user_prompt:
+            combined_prompt += f"\nUser Query:\n{user_prompt}\n"
 
         combined_prompt += """\nYour response should be in two parts:
 
@@ -198,7 +249,12 @@ Your markdown-formatted plan here...
 
         # Query the LLM
         logger.info("Sending combined prompt to LLM")
-        response = client.query(combined_prompt)
+        chunks = []
+        for chunk in client.stream(combined_prompt):
+            chunks.append(chunk)
+            if on_chunk:
+                on_chunk(chunk)
+        response = "".join(chunks)
         logger.info("Received response from LLM")
         
         # Extract lessons and plan
@@ -215,7 +271,7 @@ Your markdown-formatted plan here...
             return plan
         else:
             logger.warning("Response did not contain properly formatted sections")
-    return response
+        return response
             
     except Exception as e:
         logger.error(f"Error in query_llm_with_plan: {e}")
@@ -223,14 +279,15 @@ Your markdown-formatted plan here...
 
 def main():
     try:
-    parser = argparse.ArgumentParser(description='Query LLM with project plan context')
-    parser.add_argument('--prompt', type=str, help='Additional prompt to send to the LLM', required=False)
-    parser.add_argument('--file', type=str, help='Path to a file whose content should be included in the prompt', required=False)
-    parser.add_argument('--provider', choices=['openai','anthropic','gemini','local','deepseek','azure'], default='openai', help='The API provider to use')
-    parser.add_argument('--model', type=str, help='The model to use (default depends on provider)')
+        parser = argparse.ArgumentParser(description='Query LLM with project plan context')
+        parser.add_argument('--prompt', type=str, help='Additional prompt to send to the LLM', required=False)
+        parser.add_argument('--file', type=str, help='Path to a file whose content should be included in the prompt', required=False)
+        parser.add_argument('--provider', choices=['openai','anthropic','gemini','local','deepseek','azure'], default='openai', help='The API provider to use')
+        parser.add_argument('--model', type=str, help='The model to use (default depends on provider)')
         parser.add_argument('--debug', action='store_true', help='Enable debug logging')
         parser.add_argument('--config', type=str, help='Path to configuration file')
-    args = parser.parse_args()
+        parser.add_argument('--no-stream', action='store_true', help='Only show the response and write the scratchpad once it has fully arrived')
+        args = parser.parse_args()
 
         if args.debug:
             logger.setLevel(logging.DEBUG)
@@ -239,33 +296,47 @@ def main():
         if args.config:
             os.environ['LLM_CONFIG_PATH'] = args.config
 
-    # Load environment variables
-    load_environment()
+        # Load environment variables
+        load_environment()
 
-    # Read plan status
+        # Read plan status
         plan_content = read_file_content(STATUS_FILE)
         if not plan_content:
             logger.error("Failed to read plan status")
             sys.exit(1)
 
-    # Read file content if specified
-    file_content = None
-    if args.file:
-        file_content = read_file_content(args.file)
-        if file_content is None:
+        # Read file content if specified
+        file_content = None
+        if args.file:
+            file_content = read_file_content(args.file)
+            if file_content is None:
                 logger.error("Failed to read specified file")
-            sys.exit(1)
+                sys.exit(1)
 
-        # Query LLM and update scratchpad
-    response = query_llm_with_plan(plan_content, args.prompt, file_content, provider=args.provider, model=args.model)
-    if response:
-            if update_scratchpad(response):
+        # Query LLM and update scratchpad; while streaming, the partial
+        # response goes into an in-progress section that is replaced on
+        # success and removed on failure
+        stream = None if args.no_stream else ScratchpadStream()
+        try:
+            response = query_llm_with_plan(plan_content, args.prompt, file_content, provider=args.provider, model=args.model, on_chunk=stream)
+        except BaseException:
+            if stream:
+                stream.abort()
+            raise
+        if stream:
+            print()
+            if not response:
+                stream.abort()
+        if response:
+            if stream.finish(response) if stream else update_scratchpad(response):
                 print('Successfully updated scratchpad.md with the new plan.')
                 print('Please review the changes and proceed with implementation.')
             else:
                 logger.error("Failed to update scratchpad")
+                if stream:
+                    stream.abort()
                 sys.exit(1)
-    else:
+        else:
             logger.error("Failed to get response from LLM")
             sys.exit(1)
     except Exception as e:
@@ -1,16 +1,49 @@
 #!/usr/bin/env python3
 
 import os
+import re
+import math
 import time
 import json
 import argparse
+import atexit
+import contextlib
+import bisect
+import csv
+import gzip
+import heapq
+import itertools
+import queue
+import sqlite3
+import threading
+import weakref
+import collections
+import dataclasses
 from dataclasses import dataclass
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Iterator, Iterable, Callable, Tuple
 from pathlib import Path
 import uuid
 import sys
+from array import array
+from bisect import bisect_left
 from tabulate import tabulate
-from datetime import datetime
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import fcntl
+except ImportError:  # No flock (Windows): compactions and manifest rebuilds are not serialized
+    fcntl = None
+
+try:
+    import numpy as np
+except ImportError:  # Analytics fall back to pure Python
+    np = None
+
+try:
+    import zstandard
+except ImportError:  # zstd-compressed segments need the zstandard package
+    zstandard = None
 
 @dataclass
 class TokenUsage:
@@ -38,42 +71,2590 @@ class APIResponse:
     provider: str = "openai"
     model: str = "unknown"
 
+def session_log_path(logs_dir: Path, session_id: str) -> Path:
+    """Path of the append-only JSONL request log for a session"""
+    return logs_dir / f"session_{session_id}.jsonl"
+
+def shard_path_for_log(log_file: Path, pid: int) -> Path:
+    """Path of the per-process shard that process ``pid`` appends to"""
+    return log_file.with_name(f"{log_file.name[:-len('.jsonl')]}.p{pid}.jsonl")
+
+# File suffix of sealed segments for each supported compression
+SEGMENT_COMPRESSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+def segment_path_for_log(log_file: Path, pid: int, seq: int, compression: str = "gzip",
+                         time_range: Optional[Tuple[float, float]] = None) -> Path:
+    """Path of a sealed, compressed segment spilled from a process's shard.
+
+    With ``time_range`` the name also records the whole seconds the
+    segment's timestamps span, so readers can skip it without opening it.
+    """
+    span = f".t{math.floor(time_range[0])}-{math.ceil(time_range[1])}" if time_range else ""
+    suffix = SEGMENT_COMPRESSIONS[compression]
+    return log_file.with_name(f"{log_file.name[:-len('.jsonl')]}.p{pid}.{seq}{span}.jsonl{suffix}")
+
+# session_<id>.jsonl is the compacted log; session_<id>.p<pid>.jsonl are shards
+_LOG_NAME = re.compile(r"^session_(?P<session_id>.+?)(?:\.p(?P<pid>\d+))?\.jsonl$")
+# session_<id>.p<pid>.<seq>[.t<first>-<last>].jsonl.gz|.zst are sealed segments
+_SEGMENT_NAME = re.compile(r"^session_(?P<session_id>.+?)\.p(?P<pid>\d+)\.(?P<seq>\d+)"
+                           r"(?:\.t(?P<first>\d+)-(?P<last>\d+))?\.jsonl\.(?:gz|zst)$")
+# Timestamps as json.dumps writes them, for finding a segment's time range
+# without decoding every record
+_TIMESTAMP_FIELD = re.compile(r'"timestamp": (-?[0-9][0-9.eE+-]*)')
+# A shard is renamed to session_<id>.p<pid>.jsonl.sealing while it is compressed
+_SEALING_SUFFIX = ".sealing"
+# A compaction that rewrites the log or segments journals its inputs and
+# outputs in session_<id>.jsonl.compacting until the inputs are removed
+_COMPACTING_SUFFIX = ".compacting"
+
+def legacy_session_path(logs_dir: Path, session_id: str) -> Path:
+    """Path of a pre-JSONL single-document session file"""
+    return logs_dir / f"session_{session_id}.json"
+
+def _open_log(path: Path, mode: str = 'rt', compression: Optional[str] = None):
+    """Open a plain, gzip- or zstd-compressed JSONL log as text.
+
+    The compression is taken from the file suffix unless given.
+    """
+    if compression is None:
+        compression = {".gz": "gzip", ".zst": "zstd"}.get(path.suffix)
+    if compression == "gzip":
+        return gzip.open(path, mode, encoding='utf-8')
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError(f"Reading or writing {path.name} needs the zstandard package (pip install zstandard)")
+        return zstandard.open(path, mode, encoding='utf-8')
+    return open(path, mode[0], encoding='utf-8')
+
+def iter_log_requests(log_file: Path) -> Iterator[Dict]:
+    """Stream request records from a JSONL session log, one line at a time.
+
+    A torn trailing line (e.g. from a crash mid-append) is skipped rather
+    than failing the whole load.
+    """
+    with _open_log(log_file) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping malformed line in {log_file}", file=sys.stderr)
+
+def read_request_log(log_file: Path) -> List[Dict]:
+    """Read every request record from a JSONL session log"""
+    return list(iter_log_requests(log_file))
+
+def iter_legacy_requests(legacy_file: Path, chunk_size: int = 1 << 16) -> Iterator[Dict]:
+    """Stream the ``requests`` array of a legacy session_<id>.json file.
+
+    Reads the file in chunks and decodes one array element at a time, so
+    memory stays bounded by the largest single record rather than the file.
+    """
+    decoder = json.JSONDecoder()
+    with open(legacy_file, 'r', encoding='utf-8') as f:
+        buf = ""
+        eof = False
+        
+        def fill() -> bool:
+            nonlocal buf, eof
+            chunk = f.read(chunk_size)
+            if not chunk:
+                eof = True
+            buf += chunk
+            return bool(chunk)
+        
+        # Locate the start of the top-level "requests" array
+        key = re.compile(r'"requests"\s*:\s*\[')
+        match = key.search(buf)
+        while match is None:
+            if not fill():
+                return
+            match = key.search(buf)
+        buf = buf[match.end():]
+        
+        while True:
+            pos = 0
+            while True:
+                while pos < len(buf) and buf[pos] in " \t\r\n,":
+                    pos += 1
+                if pos == len(buf):
+                    buf = ""
+                    pos = 0
+                    if not fill():
+                        return
+                    continue
+                if buf[pos] == "]":
+                    return
+                try:
+                    request, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    # Element spans the chunk boundary; read more and retry
+                    if eof:
+                        print(f"Truncated requests array in {legacy_file}", file=sys.stderr)
+                        return
+                    buf = buf[pos:]
+                    pos = 0
+                    fill()
+                    continue
+                yield request
+                pos = end
+                if pos > chunk_size:
+                    buf = buf[pos:]
+                    pos = 0
+
+def summary_path_for_log(log_file: Path) -> Path:
+    """Path of the summary sidecar belonging to a JSONL session log"""
+    return log_file.with_name(f"{log_file.name[:-len('.jsonl')]}.summary.json")
+
+def read_summary_sidecar(log_file: Path) -> Optional[Dict]:
+    """Read the summary sidecar for a session log, if there is one"""
+    summary_file = summary_path_for_log(log_file)
+    if not summary_file.exists():
+        return None
+    with open(summary_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def session_shards(log_file: Path) -> Dict[int, Path]:
+    """Find the per-process shards of a session log, keyed by PID"""
+    base_id = log_file.name[len("session_"):-len(".jsonl")]
+    shards = {}
+    for shard in log_file.parent.glob(f"session_{base_id}.p*.jsonl"):
+        match = _LOG_NAME.match(shard.name)
+        if match and match.group("pid") and match.group("session_id") == base_id:
+            shards[int(match.group("pid"))] = shard
+    return shards
+
+def session_segments(log_file: Path) -> List[Path]:
+    """Find the sealed segments of a session log, oldest first"""
+    base_id = log_file.name[len("session_"):-len(".jsonl")]
+    segments = []
+    for segment in log_file.parent.glob(f"session_{base_id}.p*.jsonl.*"):
+        match = _SEGMENT_NAME.match(segment.name)
+        if match and match.group("session_id") == base_id:
+            segments.append((int(match.group("seq")), segment.name, segment))
+    return [segment for _, _, segment in sorted(segments)]
+
+def segment_time_range(segment: Path) -> Optional[Tuple[int, int]]:
+    """Whole seconds spanned by a segment's timestamps, if its name records them"""
+    match = _SEGMENT_NAME.match(segment.name)
+    if not match or match.group("first") is None:
+        return None
+    return int(match.group("first")), int(match.group("last"))
+
+def _text_time_range(text: str) -> Optional[Tuple[float, float]]:
+    """Earliest and latest request timestamp in a block of JSONL records"""
+    timestamps = [float(value) for value in _TIMESTAMP_FIELD.findall(text)]
+    if not timestamps:
+        return None
+    return min(timestamps), max(timestamps)
+
+def write_segment(log_file: Path, pid: int, seq: int, text: str, compression: str = "gzip") -> Path:
+    """Atomically write JSONL records as a compressed segment named after
+    their time range"""
+    segment = segment_path_for_log(log_file, pid, seq, compression, _text_time_range(text))
+    tmp_file = segment.with_name(f"{segment.name}.{os.getpid()}.tmp")
+    with _open_log(tmp_file, "wt", compression) as f:
+        f.write(text)
+    os.replace(tmp_file, segment)
+    return segment
+
+def _sealing_shards(log_file: Path) -> Dict[int, Path]:
+    """Find shards that are in the middle of being sealed, keyed by PID"""
+    base_id = log_file.name[len("session_"):-len(".jsonl")]
+    sealing = {}
+    for path in log_file.parent.glob(f"session_{base_id}.p*.jsonl{_SEALING_SUFFIX}"):
+        match = _LOG_NAME.match(path.name[:-len(_SEALING_SUFFIX)])
+        if match and match.group("pid") and match.group("session_id") == base_id:
+            sealing[int(match.group("pid"))] = path
+    return sealing
+
+def session_exists(log_file: Path) -> bool:
+    """Whether a session has a compacted log, shards or sealed segments"""
+    return log_file.exists() or bool(session_shards(log_file)) or bool(session_segments(log_file))
+
+def _complete_lines(text: str) -> str:
+    """Drop a torn final line left by a crashed writer"""
+    if text and not text.endswith("\n"):
+        text = text[:text.rfind("\n") + 1]
+    return text
+
+def seal_shard(shard: Path, log_file: Path, pid: int, compression: str = "gzip") -> Optional[Path]:
+    """Spill a shard into an immutable compressed segment.
+
+    The shard is renamed out of the way first, so appends that race with
+    sealing start a fresh shard instead of being lost; the segment is
+    written atomically before the renamed shard is removed. Returns the
+    segment path, or None if there was nothing to seal.
+    """
+    sealing = shard.with_name(shard.name + _SEALING_SUFFIX)
+    try:
+        os.rename(shard, sealing)
+    except FileNotFoundError:
+        return None
+    text = _complete_lines(sealing.read_text(encoding="utf-8"))
+    segment = None
+    if text:
+        segment = write_segment(log_file, pid, time.time_ns(), text, compression)
+    sealing.unlink()
+    return segment
+
+@contextlib.contextmanager
+def _flocked(lock_file: Path, exclusive: bool, blocking: bool = True):
+    """Hold an advisory lock on a file; yields whether it was taken.
+
+    Without ``blocking`` a lock held elsewhere is not waited for. Where
+    flock is unavailable every lock is granted.
+    """
+    if fcntl is None:
+        yield True
+        return
+    fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                        | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+    finally:
+        os.close(fd)
+
+def _session_locked(log_file: Path, exclusive: bool, blocking: bool = True):
+    """Hold a session's compaction lock: shared to read the session,
+    exclusive to move records between its log and segments"""
+    return _flocked(log_file.with_name(f"{log_file.name}.lock"), exclusive, blocking)
+
+def _journal_path(log_file: Path) -> Path:
+    return log_file.with_name(log_file.name + _COMPACTING_SUFFIX)
+
+def _write_journal(log_file: Path, entry: Dict):
+    _append_text(_journal_path(log_file), json.dumps(entry) + "\n", fsync=True)
+
+def _read_journal(log_file: Path) -> Optional[Tuple[bool, List[Path]]]:
+    """What a crashed compaction left behind, if anything.
+
+    Returns whether its outputs were complete, and the files that hold the
+    duplicated records: its inputs if so, else the outputs it had started.
+    """
+    try:
+        text = _journal_path(log_file).read_text(encoding="utf-8")
+    except FileNotFoundError:
+        return None
+    inputs, outputs, done = [], set(), False
+    for line in text.splitlines():
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        inputs.extend(log_file.with_name(name) for name in entry.get("inputs", ()))
+        if "output" in entry:
+            outputs.add(tuple(entry["output"]))
+        if entry.get("done"):
+            done = True
+        if "log_inode" in entry:
+            # The log was replaced as a whole; done once the replace happened
+            with contextlib.suppress(FileNotFoundError):
+                done = done or log_file.stat().st_ino == entry["log_inode"]
+    if done:
+        return True, inputs
+    started = []
+    for segment in session_segments(log_file):
+        match = _SEGMENT_NAME.match(segment.name)
+        if (int(match.group("pid")), int(match.group("seq"))) in outputs:
+            started.append(segment)
+    return False, started
+
+def _recover_compaction(log_file: Path):
+    """Finish or roll back a crashed compaction; needs the exclusive lock"""
+    leftover = _read_journal(log_file)
+    if leftover is None:
+        return
+    for path in leftover[1]:
+        with contextlib.suppress(FileNotFoundError):
+            path.unlink()
+    _journal_path(log_file).unlink()
+
+def iter_session_requests(log_file: Path, since: Optional[float] = None,
+                          until: Optional[float] = None) -> Iterator[Dict]:
+    """Stream a session through its per-process shards, segments and
+    compacted log.
+
+    Records carry a unique ``id``. The session's compaction lock is held
+    while streaming, so the compacted log and segments never share a
+    record and are read with no per-record state; only the ids read from
+    shards, whose records sealing may copy into a segment meanwhile, are
+    remembered to drop repeats. Records are not sorted.
+    
+    With ``since``/``until`` only requests in ``[since, until)`` are
+    yielded, and segments whose names place them outside that window are
+    never opened.
+    """
+    with _session_locked(log_file, exclusive=False):
+        yield from _iter_session_requests(log_file, since, until)
+
+def _iter_session_requests(log_file: Path, since: Optional[float],
+                           until: Optional[float]) -> Iterator[Dict]:
+    """``iter_session_requests`` for a caller that holds the session lock"""
+    leftover = _read_journal(log_file)
+    skipped = set(leftover[1]) if leftover else set()
+    seen = set()
+    read = set()
+    while True:
+        # Shards are read before segments and the log: sealing writes
+        # records to their segment before removing the source, so a file
+        # that vanishes mid-read is found further down the list or, for
+        # segments written after the listing, on the next pass
+        shards = [shard for _, shard in sorted(session_shards(log_file).items())]
+        sealing = [path for _, path in sorted(_sealing_shards(log_file).items())]
+        files = shards + sealing + session_segments(log_file) + [log_file]
+        missing = False
+        for path in files:
+            if path in read or path in skipped:
+                continue
+            read.add(path)
+            span = segment_time_range(path)
+            if span is not None and ((since is not None and span[1] < since)
+                                     or (until is not None and span[0] >= until)):
+                continue
+            # A shard that vanished is being sealed under its .sealing name
+            sources = [path, path.with_name(path.name + _SEALING_SUFFIX)] if path in shards else [path]
+            # Without flock compactions may overlap, so every id is remembered
+            remember = fcntl is None or path in shards or path in sealing
+            for source in sources:
+                if source in read and source is not path:
+                    continue
+                read.add(source)
+                try:
+                    for request in iter_log_requests(source):
+                        if ((since is not None and request["timestamp"] < since)
+                                or (until is not None and request["timestamp"] >= until)):
+                            continue
+                        request_id = request.get("id")
+                        if request_id is not None:
+                            if request_id in seen:
+                                continue
+                            if remember:
+                                seen.add(request_id)
+                        yield request
+                except FileNotFoundError:
+                    continue
+                break
+            else:
+                missing = True
+        if not missing:
+            return
+
+def read_session_requests(log_file: Path, since: Optional[float] = None,
+                          until: Optional[float] = None) -> List[Dict]:
+    """Read a session through its compacted log and all per-process shards,
+    ordered by timestamp"""
+    merged = list(iter_session_requests(log_file, since, until))
+    merged.sort(key=lambda r: r["timestamp"])
+    return merged
+
+def _pid_alive(pid: int) -> bool:
+    """Best-effort check whether a process is still running"""
+    if os.name == "nt":
+        # os.kill would terminate the process on Windows; never reclaim there
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _already_sealed(log_file: Path, pid: int, text: str) -> bool:
+    """Whether a seal that crashed before removing its .sealing file had
+    already written ``text`` to a segment"""
+    time_range = _text_time_range(text)
+    if time_range is None:
+        return False
+    span = (math.floor(time_range[0]), math.ceil(time_range[1]))
+    for segment in session_segments(log_file):
+        if int(_SEGMENT_NAME.match(segment.name).group("pid")) != pid or segment_time_range(segment) != span:
+            continue
+        try:
+            with _open_log(segment) as f:
+                if f.read() == text:
+                    return True
+        except (OSError, EOFError):
+            continue
+    return False
+
+def _ends_with(path: Path, text: str) -> bool:
+    """Whether a file's last bytes are exactly ``text``"""
+    data = text.encode("utf-8")
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() < len(data):
+                return False
+            f.seek(-len(data), os.SEEK_END)
+            return f.read(len(data)) == data
+    except FileNotFoundError:
+        return False
+
+def _ends_mid_line(path: Path) -> bool:
+    """Whether a file's last line is missing its newline (a torn append)"""
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                return False
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) != b"\n"
+    except FileNotFoundError:
+        return False
+
+def compact_session(log_file: Path, include_pids: tuple = ()) -> int:
+    """Fold shards of finished processes into the compacted session log.
+
+    Runs under the session's exclusive compaction lock and does nothing if
+    another compaction or a reader holds it. Each shard is appended to the
+    log in a single write and only then unlinked; a shard left behind by a
+    crash in between is recognised by the log already ending with it.
+    Shards of live processes are left alone unless their PID is in
+    ``include_pids``. Returns the number of shards compacted.
+    """
+    with _session_locked(log_file, exclusive=True, blocking=False) as locked:
+        if not locked:
+            return 0
+        _recover_compaction(log_file)
+        return _compact_shards(log_file, include_pids)
+
+def _compact_shards(log_file: Path, include_pids: tuple) -> int:
+    compacted = 0
+    pending = list(session_shards(log_file).items()) + list(_sealing_shards(log_file).items())
+    for pid, shard in sorted(pending):
+        if pid not in include_pids and (pid == os.getpid() or _pid_alive(pid)):
+            continue
+        try:
+            text = _complete_lines(shard.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            continue
+        if shard.name.endswith(_SEALING_SUFFIX) and _already_sealed(log_file, pid, text):
+            text = ""
+        if text and not _ends_with(log_file, text):
+            if _ends_mid_line(log_file):
+                text = "\n" + text
+            _append_text(log_file, text, fsync=True)
+        try:
+            shard.unlink()
+        except FileNotFoundError:
+            pass
+        compacted += 1
+    return compacted
+
+def upgrade_legacy_session(legacy_file: Path) -> Path:
+    """Convert a legacy ``session_<id>.json`` file to the JSONL layout.
+
+    The request log and summary sidecar are written next to the legacy file,
+    which is then renamed to ``session_<id>.json.bak`` so it is no longer
+    picked up as a session. Returns the path of the new request log.
+    """
+    with open(legacy_file, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    session_id = data.get('session_id') or legacy_file.stem[len("session_"):]
+    logs_dir = legacy_file.parent
+    log_file = session_log_path(logs_dir, session_id)
+    
+    _replace_text(log_file, "".join(json.dumps(request) + "\n" for request in data.get('requests', [])))
+    
+    sidecar = {
+        "session_id": session_id,
+        "start_time": data.get('start_time', time.time()),
+        "summary": data.get('summary', {})
+    }
+    _replace_text(summary_path_for_log(log_file), json.dumps(sidecar, indent=2))
+    
+    try:
+        legacy_file.rename(legacy_file.with_name(legacy_file.name + ".bak"))
+    except FileNotFoundError:
+        # Another process upgraded the same file concurrently
+        pass
+    return log_file
+
+MANIFEST_NAME = "manifest.jsonl"
+_MANIFEST_COUNTERS = ("requests", "prompt_tokens", "completion_tokens", "total_tokens", "cost", "thinking_time")
+
+def manifest_path(logs_dir: Path) -> Path:
+    """Path of the session manifest index in a logs directory"""
+    return logs_dir / MANIFEST_NAME
+
+def _manifest_locked(logs_dir: Path, exclusive: bool):
+    """Hold the manifest lock: shared to append rows, exclusive to rebuild"""
+    return _flocked(logs_dir / f"{MANIFEST_NAME}.lock", exclusive)
+
+def manifest_rebuilt_at(logs_dir: Path) -> Optional[int]:
+    """The cutoff stamped on the manifest by its last rebuild, if any"""
+    try:
+        with open(manifest_path(logs_dir), 'r', encoding='utf-8') as f:
+            return json.loads(f.readline()).get("rebuilt")
+    except (FileNotFoundError, json.JSONDecodeError, AttributeError):
+        return None
+
+def read_manifest(logs_dir: Path) -> Optional[Dict[str, Dict]]:
+    """Read the session manifest in one pass.
+
+    The manifest is an append-only file of per-session delta rows written
+    by trackers (and absolute rows written by ``rebuild_manifest``, after a
+    header row stamping when it ran); rows for the same session are summed.
+    Returns None if there is no manifest.
+    """
+    path = manifest_path(logs_dir)
+    try:
+        f = open(path, 'r', encoding='utf-8')
+    except FileNotFoundError:
+        return None
+    sessions: Dict[str, Dict] = {}
+    with f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if "session_id" not in row:
+                continue
+            entry = sessions.get(row["session_id"])
+            if entry is None:
+                sessions[row["session_id"]] = row
+                continue
+            for key in _MANIFEST_COUNTERS:
+                entry[key] += row[key]
+            entry["start_time"] = min(entry["start_time"], row["start_time"])
+            entry["last_time"] = max(entry["last_time"], row["last_time"])
+    return dict(sorted(sessions.items()))
+
+def _manifest_row(session_id: str, start_time: float, last_time: float, stats: "_GroupStats") -> str:
+    return json.dumps({
+        "session_id": session_id,
+        "start_time": start_time,
+        "last_time": last_time,
+        **stats.counters()
+    }) + "\n"
+
+def rebuild_manifest(logs_dir: Path) -> int:
+    """Rebuild the manifest from the session logs and rollups; returns the
+    session count.
+
+    Use after adding or removing log files by hand; ``list_sessions`` also
+    runs it to build a missing manifest. The rebuild counts requests from
+    before a whole-second cutoff, which it stamps on the manifest, and waits
+    past that second before reading the logs. Live trackers drop their
+    not-yet-appended totals from before the cutoff and append the rest, so
+    no request is counted twice. Trackers' appends wait while it runs.
+    """
+    with _manifest_locked(logs_dir, exclusive=True):
+        cutoff = int(time.time()) + 1
+        # Let requests of the cutoff's second reach the logs first
+        time.sleep(max(0.0, cutoff + 0.05 - time.time()))
+        sessions: Dict[str, Tuple[float, float, _GroupStats]] = {}
+        for session_id, session_file in find_session_files(logs_dir).items():
+            session_data = load_session(session_file)
+            if not session_data:
+                continue
+            stats = _GroupStats()
+            last_time = start_time = session_data.get("start_time", time.time())
+            for request in session_data.get("requests", []):
+                if request["timestamp"] < cutoff:
+                    stats.add(request)
+                    last_time = max(last_time, request["timestamp"])
+            sessions[session_id] = (start_time, last_time, stats)
+        # Requests dropped by retention survive only as rollups
+        for row in read_rollups(logs_dir):
+            start_time, last_time, stats = sessions.get(row["session_id"], (row["bucket"], row["bucket"], _GroupStats()))
+            stats.add_counters(row)
+            sessions[row["session_id"]] = (min(start_time, row["bucket"]), max(last_time, row["bucket"]), stats)
+        rows = [json.dumps({"rebuilt": cutoff}) + "\n"]
+        rows += [_manifest_row(session_id, *entry) for session_id, entry in sorted(sessions.items())]
+        _replace_text(manifest_path(logs_dir), "".join(rows))
+    return len(sessions)
+
+ROLLUPS_NAME = "rollups.jsonl"
+ROLLUP_WIDTH = 3600
+SEGMENT_TARGET_BYTES = 1 << 20
+SEGMENT_RECORDS = 50_000
+
+def rollups_path(logs_dir: Path) -> Path:
+    """Path of the hourly rollups kept for requests dropped by retention"""
+    return logs_dir / ROLLUPS_NAME
+
+def read_rollups(logs_dir: Path) -> List[Dict]:
+    """Read the rollup rows of expired requests, if any.
+
+    Each row holds the totals of one (session, hour, provider, model) group
+    from one ``source`` segment; ``bucket`` is the start of the UTC hour.
+    """
+    try:
+        f = open(rollups_path(logs_dir), 'r', encoding='utf-8')
+    except FileNotFoundError:
+        return []
+    rows = []
+    with f:
+        for line in f:
+            try:
+                rows.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return rows
+
+def _rollup_rows(session_id: str, source: str, requests: List[Dict]) -> str:
+    groups: Dict[Tuple[float, str, str], _GroupStats] = {}
+    for request in requests:
+        key = (request["timestamp"] // ROLLUP_WIDTH * ROLLUP_WIDTH, request["provider"], request["model"])
+        stats = groups.get(key)
+        if stats is None:
+            stats = groups[key] = _GroupStats()
+        stats.add(request)
+    return "".join(
+        json.dumps({
+            "session_id": session_id,
+            "source": source,
+            "bucket": bucket,
+            "provider": provider,
+            "model": model,
+            **stats.counters()
+        }) + "\n"
+        for (bucket, provider, model), stats in sorted(groups.items())
+    )
+
+def _segment_log(log_file: Path, compression: str) -> int:
+    """Cut an idle compacted log into time-ranged segments; returns how
+    many were written. Needs the exclusive compaction lock."""
+    try:
+        f = open(log_file, 'r', encoding='utf-8')
+    except FileNotFoundError:
+        return 0
+    written = 0
+    with f:
+        _write_journal(log_file, {"inputs": [log_file.name]})
+        while True:
+            text = _complete_lines("".join(itertools.islice(f, SEGMENT_RECORDS)))
+            if not text:
+                break
+            seq = time.time_ns()
+            _write_journal(log_file, {"output": [os.getpid(), seq]})
+            write_segment(log_file, os.getpid(), seq, text, compression)
+            written += 1
+    _write_journal(log_file, {"done": True})
+    log_file.unlink()
+    _journal_path(log_file).unlink()
+    return written
+
+def compact_segments(log_file: Path, retention: Optional[float] = None, compression: str = "gzip",
+                     target_bytes: int = SEGMENT_TARGET_BYTES, now: Optional[float] = None) -> Dict:
+    """Merge a session's small segments and expire requests past retention.
+
+    Shards of finished processes are compacted first and, once no process
+    has a shard left, the compacted log is cut into segments too. Runs of
+    segments smaller than ``target_bytes`` are merged, sorted by time, into
+    one segment. With ``retention`` (seconds), requests older than that are
+    dropped after their hourly totals are appended to ``rollups.jsonl``.
+    Rollup rows name the segment they came from and are never written twice
+    for one segment, so an interrupted run can simply be repeated.
+    
+    Runs under the session's exclusive compaction lock; if another
+    compaction or a reader holds it, nothing is done this time. Returns the
+    number of segments read and written and of requests expired.
+    """
+    result = {"read": 0, "written": 0, "expired": 0}
+    with _session_locked(log_file, exclusive=True, blocking=False) as locked:
+        if locked:
+            _recover_compaction(log_file)
+            _compact_shards(log_file, ())
+            _compact_segments(log_file, result, retention, compression, target_bytes, now)
+    return result
+
+def _compact_segments(log_file: Path, result: Dict, retention: Optional[float], compression: str,
+                      target_bytes: int, now: Optional[float]):
+    if not session_shards(log_file) and not _sealing_shards(log_file):
+        result["written"] += _segment_log(log_file, compression)
+    cutoff = None if retention is None else (time.time() if now is None else now) - retention
+    session_id = log_file.name[len("session_"):-len(".jsonl")]
+    rolled_up = {row.get("source") for row in read_rollups(log_file.parent)} if cutoff is not None else set()
+    
+    def expiring(segment: Path) -> bool:
+        span = segment_time_range(segment)
+        return cutoff is not None and (span is None or span[0] < cutoff)
+    
+    def merge(batch: List[Path]):
+        if len(batch) < 2 and not any(expiring(segment) for segment in batch):
+            return
+        kept, expired, seen = [], {}, set()
+        for segment in batch:
+            for request in iter_log_requests(segment):
+                if request.get("id") is not None:
+                    if request["id"] in seen:
+                        continue
+                    seen.add(request["id"])
+                if cutoff is not None and request["timestamp"] < cutoff:
+                    expired.setdefault(segment.name, []).append(request)
+                else:
+                    kept.append(request)
+        rows = "".join(_rollup_rows(session_id, source, requests)
+                       for source, requests in expired.items() if source not in rolled_up)
+        if rows:
+            _append_text(rollups_path(log_file.parent), rows, fsync=True)
+        _write_journal(log_file, {"inputs": [segment.name for segment in batch]})
+        if kept:
+            kept.sort(key=lambda request: request["timestamp"])
+            seq = int(_SEGMENT_NAME.match(batch[-1].name).group("seq")) + 1
+            _write_journal(log_file, {"output": [os.getpid(), seq]})
+            write_segment(log_file, os.getpid(), seq,
+                          "".join(json.dumps(request) + "\n" for request in kept), compression)
+            result["written"] += 1
+        # Inputs go only once their records are rolled up or rewritten
+        _write_journal(log_file, {"done": True})
+        for segment in batch:
+            with contextlib.suppress(FileNotFoundError):
+                segment.unlink()
+        _journal_path(log_file).unlink()
+        result["read"] += len(batch)
+        result["expired"] += sum(len(requests) for requests in expired.values())
+    
+    batch, batch_bytes = [], 0
+    for segment in session_segments(log_file):
+        try:
+            size = segment.stat().st_size
+        except FileNotFoundError:
+            continue
+        if size >= target_bytes and not expiring(segment):
+            # Already full-sized and within retention: left alone
+            merge(batch)
+            batch, batch_bytes = [], 0
+            continue
+        batch.append(segment)
+        batch_bytes += size
+        if batch_bytes >= target_bytes:
+            merge(batch)
+            batch, batch_bytes = [], 0
+    merge(batch)
+
+class SqliteUsageStore:
+    """SQLite-backed token usage store.
+
+    Requests live in one table indexed on timestamp, provider, model and
+    session, so historical queries filtered by time range, provider or
+    model are answered by index lookups instead of parsing log files.
+    WAL mode lets several processes write to the same database.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            start_time REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS requests (
+            id TEXT PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            timestamp REAL NOT NULL,
+            provider TEXT NOT NULL,
+            model TEXT NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            total_tokens INTEGER NOT NULL,
+            reasoning_tokens INTEGER,
+            cost REAL NOT NULL,
+            thinking_time REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_requests_timestamp ON requests (timestamp);
+        CREATE INDEX IF NOT EXISTS idx_requests_provider ON requests (provider, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_requests_model ON requests (model, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_requests_session ON requests (session_id, timestamp);
+    """
+    COLUMNS = ("id", "session_id", "timestamp", "provider", "model", "prompt_tokens",
+               "completion_tokens", "total_tokens", "reasoning_tokens", "cost", "thinking_time")
+    
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self._conn = sqlite3.connect(str(db_path), timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._lock = threading.Lock()
+    
+    def close(self):
+        self._conn.close()
+    
+    def ensure_session(self, session_id: str, start_time: float) -> float:
+        """Register a session if it is new; returns its recorded start time"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO sessions (session_id, start_time) VALUES (?, ?)",
+                (session_id, start_time)
+            )
+            row = self._conn.execute(
+                "SELECT start_time FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return row[0]
+    
+    @staticmethod
+    def _to_row(session_id: str, request: Dict, fallback_id: str) -> tuple:
+        usage = request["token_usage"]
+        return (
+            request.get("id") or fallback_id, session_id, request["timestamp"],
+            request["provider"], request["model"], usage["prompt_tokens"],
+            usage["completion_tokens"], usage["total_tokens"], usage.get("reasoning_tokens"),
+            request["cost"], request["thinking_time"]
+        )
+    
+    @staticmethod
+    def _to_request(row: tuple) -> Dict:
+        return {
+            "id": row[0],
+            "timestamp": row[2],
+            "provider": row[3],
+            "model": row[4],
+            "token_usage": {
+                "prompt_tokens": row[5],
+                "completion_tokens": row[6],
+                "total_tokens": row[7],
+                "reasoning_tokens": row[8]
+            },
+            "cost": row[9],
+            "thinking_time": row[10]
+        }
+    
+    def insert_requests(self, session_id: str, requests: List[Dict]) -> int:
+        """Insert request records, ignoring ids that are already stored.
+
+        Records without an ``id`` (from legacy logs) get one derived from the
+        session and their position, so re-importing a file is idempotent.
+        """
+        rows = [self._to_row(session_id, r, f"{session_id}:{i}") for i, r in enumerate(requests)]
+        with self._lock, self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                f"INSERT OR IGNORE INTO requests ({', '.join(self.COLUMNS)}) "
+                f"VALUES ({', '.join('?' for _ in self.COLUMNS)})",
+                rows
+            )
+            return self._conn.total_changes - before
+    
+    @staticmethod
+    def _where(session_id: Optional[str] = None, since: Optional[float] = None,
+               until: Optional[float] = None, provider: Optional[str] = None,
+               model: Optional[str] = None) -> tuple:
+        clauses, params = [], []
+        for column, op, value in (("session_id", "=", session_id), ("timestamp", ">=", since),
+                                  ("timestamp", "<", until), ("provider", "=", provider),
+                                  ("model", "=", model)):
+            if value is not None:
+                clauses.append(f"{column} {op} ?")
+                params.append(value)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+    
+    def iter_requests(self, **filters):
+        """Yield matching request records in timestamp order"""
+        where, params = self._where(**filters)
+        cursor = self._conn.execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM requests{where} ORDER BY timestamp", params
+        )
+        for row in cursor:
+            yield self._to_request(row)
+    
+    def load_requests(self, session_id: str) -> List[Dict]:
+        """Load every request record of a session in timestamp order"""
+        return list(self.iter_requests(session_id=session_id))
+    
+    def session_start(self, session_id: str) -> Optional[float]:
+        row = self._conn.execute(
+            "SELECT start_time FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return row[0] if row else None
+    
+    def list_sessions(self, **filters) -> List[Dict]:
+        """Per-session totals over the matching requests"""
+        where, params = self._where(**filters)
+        rows = self._conn.execute(
+            "SELECT r.session_id, COALESCE(s.start_time, MIN(r.timestamp)), MAX(r.timestamp), "
+            "COUNT(*), SUM(r.total_tokens), SUM(r.cost) "
+            f"FROM requests r LEFT JOIN sessions s USING (session_id){where} "
+            "GROUP BY r.session_id ORDER BY r.session_id",
+            params
+        ).fetchall()
+        return [
+            {
+                "session_id": session_id,
+                "start_time": start_time,
+                "end_time": end_time,
+                "total_requests": count,
+                "total_tokens": tokens,
+                "total_cost": cost
+            }
+            for session_id, start_time, end_time, count, tokens, cost in rows
+        ]
+    
+    def summarize(self, start_time: Optional[float] = None, **filters) -> Dict:
+        """Session-style summary over the matching requests, computed in SQL"""
+        where, params = self._where(**filters)
+        totals = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(prompt_tokens), 0), COALESCE(SUM(completion_tokens), 0), "
+            "COALESCE(SUM(total_tokens), 0), COALESCE(SUM(cost), 0.0), COALESCE(SUM(thinking_time), 0.0), "
+            f"MIN(timestamp), MAX(timestamp) FROM requests{where}",
+            params
+        ).fetchone()
+        provider_stats = {
+            provider: {"requests": count, "total_tokens": tokens, "total_cost": cost}
+            for provider, count, tokens, cost in self._conn.execute(
+                f"SELECT provider, COUNT(*), SUM(total_tokens), SUM(cost) FROM requests{where} GROUP BY provider",
+                params
+            )
+        }
+        model_stats = {
+            model: {
+                "requests": count,
+                "prompt_tokens": prompt,
+                "completion_tokens": completion,
+                "total_tokens": tokens,
+                "total_cost": cost,
+                "total_thinking_time": thinking
+            }
+            for model, count, prompt, completion, tokens, cost, thinking in self._conn.execute(
+                "SELECT model, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), SUM(total_tokens), "
+                f"SUM(cost), SUM(thinking_time) FROM requests{where} GROUP BY model",
+                params
+            )
+        }
+        first, last = totals[6], totals[7]
+        if start_time is None:
+            start_time = first if first is not None else time.time()
+        return {
+            "total_requests": totals[0],
+            "total_prompt_tokens": totals[1],
+            "total_completion_tokens": totals[2],
+            "total_tokens": totals[3],
+            "total_cost": totals[4],
+            "total_thinking_time": totals[5],
+            "provider_stats": provider_stats,
+            "model_stats": model_stats,
+            "session_duration": (last if last is not None else time.time()) - start_time
+        }
+    
+    def import_sessions(self, logs_dir: Path) -> int:
+        """One-shot import of every JSON/JSONL session in logs_dir.
+
+        Safe to re-run: already imported records are skipped. Returns the
+        number of newly inserted requests.
+        """
+        imported = 0
+        for session_id, session_file in find_session_files(logs_dir).items():
+            session_data = load_session(session_file)
+            if not session_data:
+                continue
+            self.ensure_session(session_id, session_data.get("start_time", time.time()))
+            imported += self.insert_requests(session_id, session_data.get("requests", []))
+        return imported
+
+class _ExactSum:
+    """Running float sum that is exact until the final rounding.
+
+    Keeps Shewchuk partials (the algorithm behind ``math.fsum``), so the
+    result is independent of the order values are added or merged in and
+    always equals ``math.fsum`` over the same values.
+    """
+    __slots__ = ("partials",)
+    
+    def __init__(self):
+        self.partials: List[float] = []
+    
+    def add(self, x: float):
+        partials = self.partials
+        i = 0
+        for y in partials:
+            if abs(x) < abs(y):
+                x, y = y, x
+            hi = x + y
+            lo = y - (hi - x)
+            if lo:
+                partials[i] = lo
+                i += 1
+            x = hi
+        partials[i:] = [x]
+    
+    def merge(self, other: "_ExactSum"):
+        for x in other.partials:
+            self.add(x)
+    
+    @property
+    def value(self) -> float:
+        return math.fsum(self.partials)
+
+class _GroupStats:
+    """Running totals for the requests of one provider or model"""
+    __slots__ = ("requests", "prompt_tokens", "completion_tokens", "total_tokens", "cost", "thinking_time")
+    
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_tokens = 0
+        self.cost = _ExactSum()
+        self.thinking_time = _ExactSum()
+    
+    def add(self, request: Dict):
+        usage = request["token_usage"]
+        self.requests += 1
+        self.prompt_tokens += usage["prompt_tokens"]
+        self.completion_tokens += usage["completion_tokens"]
+        self.total_tokens += usage["total_tokens"]
+        self.cost.add(request["cost"])
+        self.thinking_time.add(request["thinking_time"])
+    
+    def merge(self, other: "_GroupStats"):
+        self.requests += other.requests
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.total_tokens += other.total_tokens
+        self.cost.merge(other.cost)
+        self.thinking_time.merge(other.thinking_time)
+    
+    def counters(self) -> Dict:
+        """The totals as plain numbers, as stored in manifest and rollup rows"""
+        return {
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+            "cost": self.cost.value,
+            "thinking_time": self.thinking_time.value
+        }
+    
+    def add_counters(self, row: Dict):
+        """Add totals stored by ``counters()``"""
+        self.requests += row["requests"]
+        self.prompt_tokens += row["prompt_tokens"]
+        self.completion_tokens += row["completion_tokens"]
+        self.total_tokens += row["total_tokens"]
+        self.cost.add(row["cost"])
+        self.thinking_time.add(row["thinking_time"])
+
+class SessionAggregates:
+    """Running session totals, updated in O(1) per tracked request.
+
+    ``to_summary`` costs time proportional to the number of distinct
+    providers and models, never to the number of requests.
+    """
+    def __init__(self):
+        self.totals = _GroupStats()
+        self.providers: Dict[str, _GroupStats] = {}
+        self.models: Dict[str, _GroupStats] = {}
+        self.first_timestamp: Optional[float] = None
+    
+    @classmethod
+    def from_requests(cls, requests: List[Dict]) -> "SessionAggregates":
+        aggregates = cls()
+        for request in requests:
+            aggregates.add(request)
+        return aggregates
+    
+    def add(self, request: Dict):
+        self.totals.add(request)
+        if self.first_timestamp is None or request["timestamp"] < self.first_timestamp:
+            self.first_timestamp = request["timestamp"]
+        provider = self.providers.get(request["provider"])
+        if provider is None:
+            provider = self.providers[request["provider"]] = _GroupStats()
+        provider.add(request)
+        model = self.models.get(request["model"])
+        if model is None:
+            model = self.models[request["model"]] = _GroupStats()
+        model.add(request)
+    
+    def merge(self, other: "SessionAggregates"):
+        self.totals.merge(other.totals)
+        if other.first_timestamp is not None and (self.first_timestamp is None
+                                                  or other.first_timestamp < self.first_timestamp):
+            self.first_timestamp = other.first_timestamp
+        for groups, other_groups in ((self.providers, other.providers), (self.models, other.models)):
+            for key, stats in other_groups.items():
+                groups.setdefault(key, _GroupStats()).merge(stats)
+    
+    def to_summary(self, start_time: float) -> Dict:
+        totals = self.totals
+        return {
+            "total_requests": totals.requests,
+            "total_prompt_tokens": totals.prompt_tokens,
+            "total_completion_tokens": totals.completion_tokens,
+            "total_tokens": totals.total_tokens,
+            "total_cost": totals.cost.value,
+            "total_thinking_time": totals.thinking_time.value,
+            "provider_stats": {
+                provider: {
+                    "requests": stats.requests,
+                    "total_tokens": stats.total_tokens,
+                    "total_cost": stats.cost.value
+                }
+                for provider, stats in self.providers.items()
+            },
+            "model_stats": {
+                model: {
+                    "requests": stats.requests,
+                    "prompt_tokens": stats.prompt_tokens,
+                    "completion_tokens": stats.completion_tokens,
+                    "total_tokens": stats.total_tokens,
+                    "total_cost": stats.cost.value,
+                    "total_thinking_time": stats.thinking_time.value
+                }
+                for model, stats in self.models.items()
+            },
+            "session_duration": time.time() - start_time
+        }
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    """Linearly interpolated percentile, matching numpy's default method"""
+    if not sorted_values:
+        return float("nan")
+    position = (len(sorted_values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+class _PairStats:
+    """Running totals per (provider, model) pair.
+
+    One group update per request instead of the three ``SessionAggregates``
+    makes (session, provider and model), for hot paths that fold their
+    totals into a ``SessionAggregates`` later with ``merge_into``.
+    """
+    __slots__ = ("groups", "first_timestamp")
+    
+    def __init__(self):
+        self.groups: Dict[Tuple[str, str], _GroupStats] = {}
+        self.first_timestamp: Optional[float] = None
+    
+    def add(self, request: Dict):
+        key = (request["provider"], request["model"])
+        stats = self.groups.get(key)
+        if stats is None:
+            stats = self.groups[key] = _GroupStats()
+        stats.add(request)
+        if self.first_timestamp is None or request["timestamp"] < self.first_timestamp:
+            self.first_timestamp = request["timestamp"]
+    
+    def merge_into(self, aggregates: SessionAggregates):
+        for (provider, model), stats in self.groups.items():
+            aggregates.totals.merge(stats)
+            aggregates.providers.setdefault(provider, _GroupStats()).merge(stats)
+            aggregates.models.setdefault(model, _GroupStats()).merge(stats)
+        if self.first_timestamp is not None and (aggregates.first_timestamp is None
+                                                 or self.first_timestamp < aggregates.first_timestamp):
+            aggregates.first_timestamp = self.first_timestamp
+
+class RequestColumns:
+    """Compact columnar request history.
+
+    Numeric fields live in typed ``array`` columns (about 48 bytes per
+    request instead of a nested dict), and provider/model names are
+    dictionary-encoded as small integer codes. It still behaves like a
+    sequence of request dicts, which are materialized on access. The
+    analytics methods work on whole columns, through zero-copy NumPy views
+    when NumPy is installed.
+    
+    With a ``capacity`` only the newest ``capacity`` requests are kept, as a
+    ring buffer: older rows are hidden behind a start offset and physically
+    dropped in batches, so memory stays flat at about twice the capacity.
+    """
+    _COLUMNS = ("timestamp", "prompt_tokens", "completion_tokens", "total_tokens", "reasoning_tokens",
+                "cost", "thinking_time", "provider_code", "model_code")
+    
+    def __init__(self, capacity: Optional[int] = None):
+        self.capacity = capacity
+        self._start = 0
+        self.timestamp = array('d')
+        self.prompt_tokens = array('i')
+        self.completion_tokens = array('i')
+        self.total_tokens = array('i')
+        self.reasoning_tokens = array('i')  # -1 when not reported
+        self.cost = array('d')
+        self.thinking_time = array('d')
+        self.provider_code = array('H')
+        self.model_code = array('H')
+        self.providers: List[str] = []
+        self.models: List[str] = []
+        self._provider_index: Dict[str, int] = {}
+        self._model_index: Dict[str, int] = {}
+    
+    @classmethod
+    def from_records(cls, requests, capacity: Optional[int] = None) -> "RequestColumns":
+        columns = cls(capacity)
+        for request in requests:
+            columns.append(request)
+        return columns
+    
+    @staticmethod
+    def _encode(value: str, values: List[str], index: Dict[str, int]) -> int:
+        code = index.get(value)
+        if code is None:
+            code = index[value] = len(values)
+            values.append(value)
+        return code
+    
+    def append(self, request: Dict):
+        usage = request["token_usage"]
+        reasoning = usage.get("reasoning_tokens")
+        self.timestamp.append(request["timestamp"])
+        self.prompt_tokens.append(usage["prompt_tokens"])
+        self.completion_tokens.append(usage["completion_tokens"])
+        self.total_tokens.append(usage["total_tokens"])
+        self.reasoning_tokens.append(-1 if reasoning is None else reasoning)
+        self.cost.append(request["cost"])
+        self.thinking_time.append(request["thinking_time"])
+        self.provider_code.append(self._encode(request["provider"], self.providers, self._provider_index))
+        self.model_code.append(self._encode(request["model"], self.models, self._model_index))
+        if self.capacity is not None and len(self) > self.capacity:
+            self._trim()
+    
+    def extend(self, other: "RequestColumns"):
+        """Append every live row of another column store, column by column"""
+        start = other._start
+        for name in self._COLUMNS[:-2]:
+            getattr(self, name).extend(getattr(other, name)[start:])
+        for codes, other_codes, values, index, other_values in (
+                (self.provider_code, other.provider_code, self.providers, self._provider_index, other.providers),
+                (self.model_code, other.model_code, self.models, self._model_index, other.models)):
+            mapping = [self._encode(value, values, index) for value in other_values]
+            if mapping == list(range(len(mapping))):
+                codes.extend(other_codes[start:])
+            else:
+                codes.extend(array('H', (mapping[code] for code in other_codes[start:])))
+        if self.capacity is not None and len(self) > self.capacity:
+            self._trim()
+    
+    def copy(self) -> "RequestColumns":
+        """An independent copy of the live rows"""
+        columns = RequestColumns(self.capacity)
+        columns.extend(self)
+        return columns
+    
+    def _trim(self):
+        """Hide rows beyond the capacity, dropping them once enough pile up"""
+        self._start = len(self.timestamp) - self.capacity
+        if self._start >= max(self.capacity, 1):
+            for name in self._COLUMNS:
+                del getattr(self, name)[:self._start]
+            self._start = 0
+    
+    def __len__(self) -> int:
+        return len(self.timestamp) - self._start
+    
+    def __bool__(self) -> bool:
+        return len(self) > 0
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("request index out of range")
+        index += self._start
+        reasoning = self.reasoning_tokens[index]
+        return {
+            "timestamp": self.timestamp[index],
+            "provider": self.providers[self.provider_code[index]],
+            "model": self.models[self.model_code[index]],
+            "token_usage": {
+                "prompt_tokens": self.prompt_tokens[index],
+                "completion_tokens": self.completion_tokens[index],
+                "total_tokens": self.total_tokens[index],
+                "reasoning_tokens": None if reasoning < 0 else reasoning
+            },
+            "cost": self.cost[index],
+            "thinking_time": self.thinking_time[index]
+        }
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+    
+    def memory_bytes(self) -> int:
+        """Approximate bytes held by the column buffers"""
+        columns = (getattr(self, name) for name in self._COLUMNS)
+        return sum(column.buffer_info()[1] * column.itemsize for column in columns)
+    
+    def _values(self, column: array) -> array:
+        """The live rows of a column, for the pure-Python paths"""
+        return column[self._start:] if self._start else column
+    
+    def _np(self, column: array, dtype):
+        """Zero-copy NumPy view of the live rows of a column"""
+        return np.frombuffer(column, dtype=dtype)[self._start:]
+    
+    def _mask(self, provider: Optional[str] = None, model: Optional[str] = None):
+        """Row selector for a provider/model filter: numpy mask or index list"""
+        wanted = []
+        if provider is not None:
+            wanted.append((self.provider_code, self._provider_index.get(provider, -1)))
+        if model is not None:
+            wanted.append((self.model_code, self._model_index.get(model, -1)))
+        if np is not None:
+            mask = np.ones(len(self), dtype=bool)
+            for column, code in wanted:
+                mask &= self._np(column, np.uint16) == code
+            return mask
+        start = self._start
+        return [i for i in range(start, len(self.timestamp)) if all(column[i] == code for column, code in wanted)]
+    
+    def latency_percentiles(self, percentiles=(50, 95, 99), provider: Optional[str] = None,
+                            model: Optional[str] = None) -> Dict[float, float]:
+        """Percentiles of thinking_time, optionally for one provider/model"""
+        if np is not None:
+            values = self._np(self.thinking_time, np.float64)
+            if provider is not None or model is not None:
+                values = values[self._mask(provider, model)]
+            if not len(values):
+                return {q: float("nan") for q in percentiles}
+            return dict(zip(percentiles, (float(v) for v in np.percentile(values, percentiles))))
+        if provider is None and model is None:
+            values = sorted(self._values(self.thinking_time))
+        else:
+            values = sorted(self.thinking_time[i] for i in self._mask(provider, model))
+        return {q: _percentile(values, q) for q in percentiles}
+    
+    def tokens_per_second(self) -> Dict[str, float]:
+        """Completion tokens per second of thinking time, per model"""
+        if np is not None:
+            codes = self._np(self.model_code, np.uint16)
+            tokens = np.bincount(codes, weights=self._np(self.completion_tokens, np.int32),
+                                 minlength=len(self.models))
+            seconds = np.bincount(codes, weights=self._np(self.thinking_time, np.float64),
+                                  minlength=len(self.models))
+        else:
+            tokens = [0.0] * len(self.models)
+            seconds = [0.0] * len(self.models)
+            for code, completion, elapsed in zip(self._values(self.model_code), self._values(self.completion_tokens),
+                                                 self._values(self.thinking_time)):
+                tokens[code] += completion
+                seconds[code] += elapsed
+        return {
+            model: (float(tokens[code]) / float(seconds[code])) if seconds[code] else 0.0
+            for code, model in enumerate(self.models)
+        }
+    
+    def cost_per_model_per_hour(self) -> Dict[str, Dict[float, float]]:
+        """Cost per model, bucketed by the UTC hour each request started in"""
+        result: Dict[str, Dict[float, float]] = {}
+        if not len(self):
+            return result
+        if np is not None:
+            hours = (self._np(self.timestamp, np.float64) // 3600).astype(np.int64)
+            codes = self._np(self.model_code, np.uint16).astype(np.int64)
+            first_hour = hours.min()
+            span = int(hours.max() - first_hour) + 1
+            keys = codes * span + (hours - first_hour)
+            unique_keys, inverse = np.unique(keys, return_inverse=True)
+            totals = np.bincount(inverse, weights=self._np(self.cost, np.float64))
+            for key, total in zip(unique_keys.tolist(), totals.tolist()):
+                code, hour = divmod(key, span)
+                result.setdefault(self.models[code], {})[float((hour + first_hour) * 3600)] = total
+            return result
+        for code, timestamp, cost in zip(self._values(self.model_code), self._values(self.timestamp),
+                                         self._values(self.cost)):
+            buckets = result.setdefault(self.models[code], {})
+            hour = (timestamp // 3600) * 3600
+            buckets[hour] = buckets.get(hour, 0.0) + cost
+        return result
+
+@dataclass(frozen=True)
+class ModelPrice:
+    """Price of one model from ``effective_date`` (UTC, ``YYYY-MM-DD``) on"""
+    provider: str
+    model: str
+    effective_date: str
+    input_per_m: float
+    output_per_m: float
+    
+    @property
+    def effective_time(self) -> float:
+        return datetime.strptime(self.effective_date, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+    
+    def cost(self, prompt_tokens: int, completion_tokens: int) -> float:
+        return (prompt_tokens / 1_000_000) * self.input_per_m + (completion_tokens / 1_000_000) * self.output_per_m
+
+class _PriceVersions:
+    """The price history of one (provider, model), oldest first"""
+    __slots__ = ("starts", "prices", "input_per_m", "output_per_m")
+    
+    def __init__(self, prices: List[ModelPrice]):
+        self.prices = sorted(prices, key=lambda price: price.effective_time)
+        self.starts = [price.effective_time for price in self.prices]
+        self.input_per_m = [price.input_per_m for price in self.prices]
+        self.output_per_m = [price.output_per_m for price in self.prices]
+    
+    def index_at(self, timestamp: float) -> int:
+        # Requests older than the first entry are charged at the first price
+        return max(bisect.bisect_right(self.starts, timestamp) - 1, 0)
+
+class PricingRegistry:
+    """Versioned per-model prices, keyed by (provider, model, effective_date).
+
+    Prices are per million tokens. ``price()`` is a dict lookup for the
+    current price and a bisect over a model's few versions for historical
+    ones. ``cost_columns()`` prices a whole ``RequestColumns`` batch at once,
+    vectorized with NumPy when installed.
+    
+    The built-in ``DEFAULT_PRICES`` can be extended or overridden by a JSON
+    file (``TOKEN_TRACKER_PRICING``) holding a ``prices`` list of objects
+    with the ``ModelPrice`` fields.
+    """
+    # Claude prices: https://www.anthropic.com/claude/sonnet
+    DEFAULT_PRICES = (
+        ModelPrice("openai", "o1", "1970-01-01", 15.0, 60.0),
+        ModelPrice("openai", "gpt-4o", "1970-01-01", 10.0, 30.0),
+        ModelPrice("openai", "deepseek-chat", "1970-01-01", 0.2, 0.2),
+        ModelPrice("anthropic", "claude-3-5-sonnet-20241022", "1970-01-01", 3.0, 15.0),
+        ModelPrice("anthropic", "claude-3-sonnet-20240229", "1970-01-01", 3.0, 15.0),
+    )
+    
+    def __init__(self, prices=DEFAULT_PRICES):
+        self._exact: Dict[Tuple[str, str, str], ModelPrice] = {}
+        for price in prices:
+            self._exact[(price.provider.lower(), price.model, price.effective_date)] = price
+        grouped: Dict[Tuple[str, str], List[ModelPrice]] = {}
+        for (provider, model, _), price in self._exact.items():
+            grouped.setdefault((provider, model), []).append(price)
+        self._versions = {key: _PriceVersions(prices) for key, prices in grouped.items()}
+        self._current = {key: versions.prices[-1] for key, versions in self._versions.items()}
+    
+    @classmethod
+    def load(cls, path: Optional[Path] = None) -> "PricingRegistry":
+        """Build a registry from the defaults plus an optional JSON price file"""
+        prices = list(cls.DEFAULT_PRICES)
+        if path is not None:
+            with open(path, 'r', encoding='utf-8') as f:
+                prices.extend(ModelPrice(**entry) for entry in json.load(f)["prices"])
+        return cls(prices)
+    
+    def models(self, provider: str) -> List[str]:
+        return sorted(model for p, model in self._versions if p == provider.lower())
+    
+    def price(self, provider: str, model: str, at: Optional[float] = None) -> ModelPrice:
+        """The price in effect at timestamp ``at`` (default: now)
+
+        Raises:
+            ValueError: If the model has no price for this provider
+        """
+        key = (provider.lower(), model)
+        if at is None:
+            price = self._current.get(key)
+            if price is not None:
+                return price
+        else:
+            versions = self._versions.get(key)
+            if versions is not None:
+                return versions.prices[versions.index_at(at)]
+        raise ValueError(
+            f"Unsupported {provider} model for cost calculation: {model}. "
+            f"Supported models: {', '.join(self.models(provider)) or 'none'}."
+        )
+    
+    def price_on(self, provider: str, model: str, effective_date: str) -> Optional[ModelPrice]:
+        """The price entry that took effect on exactly this date, if any"""
+        return self._exact.get((provider.lower(), model, effective_date))
+    
+    def cost(self, provider: str, model: str, prompt_tokens: int, completion_tokens: int,
+             at: Optional[float] = None) -> float:
+        return self.price(provider, model, at).cost(prompt_tokens, completion_tokens)
+    
+    def cost_columns(self, columns: "RequestColumns"):
+        """Price every row of a column batch at its own timestamp.
+
+        Returns the new costs (a NumPy array, or a list without NumPy) and
+        a mask of rows whose model has no price; those keep their old cost.
+        """
+        if np is not None:
+            costs = columns._np(columns.cost, np.float64).copy()
+            unpriced = np.zeros(len(columns), dtype=bool)
+            timestamps = columns._np(columns.timestamp, np.float64)
+            prompt = columns._np(columns.prompt_tokens, np.int32)
+            completion = columns._np(columns.completion_tokens, np.int32)
+            width = max(len(columns.models), 1)
+            pairs = columns._np(columns.provider_code, np.uint16).astype(np.int64) * width
+            pairs += columns._np(columns.model_code, np.uint16)
+            keys, inverse = np.unique(pairs, return_inverse=True)
+            for group, key in enumerate(keys.tolist()):
+                rows = np.flatnonzero(inverse == group)
+                versions = self._versions.get((columns.providers[key // width].lower(), columns.models[key % width]))
+                if versions is None:
+                    unpriced[rows] = True
+                    continue
+                index = np.searchsorted(np.asarray(versions.starts), timestamps[rows], side="right") - 1
+                index = np.maximum(index, 0)
+                costs[rows] = ((prompt[rows] / 1_000_000) * np.asarray(versions.input_per_m)[index]
+                               + (completion[rows] / 1_000_000) * np.asarray(versions.output_per_m)[index])
+            return costs, unpriced
+        costs = list(columns._values(columns.cost))
+        unpriced = [False] * len(costs)
+        lookups = {}
+        for i, (provider_code, model_code, timestamp, prompt, completion) in enumerate(zip(
+                columns._values(columns.provider_code), columns._values(columns.model_code),
+                columns._values(columns.timestamp), columns._values(columns.prompt_tokens),
+                columns._values(columns.completion_tokens))):
+            key = (provider_code, model_code)
+            if key not in lookups:
+                lookups[key] = self._versions.get((columns.providers[provider_code].lower(), columns.models[model_code]))
+            versions = lookups[key]
+            if versions is None:
+                unpriced[i] = True
+                continue
+            v = versions.index_at(timestamp)
+            costs[i] = (prompt / 1_000_000) * versions.input_per_m[v] + (completion / 1_000_000) * versions.output_per_m[v]
+        return costs, unpriced
+
+_pricing_registries: Dict[Optional[str], PricingRegistry] = {}
+
+def get_pricing_registry(path: Optional[Path] = None) -> PricingRegistry:
+    """The pricing registry for a price file (default: ``TOKEN_TRACKER_PRICING``),
+    loaded once per process"""
+    if path is None and os.environ.get("TOKEN_TRACKER_PRICING"):
+        path = Path(os.environ["TOKEN_TRACKER_PRICING"])
+    key = str(path) if path is not None else None
+    registry = _pricing_registries.get(key)
+    if registry is None:
+        registry = _pricing_registries[key] = PricingRegistry.load(path)
+    return registry
+
+RECOST_CHUNK = 100_000
+
+def recost_session(log_file: Path, registry: PricingRegistry, write: bool = True) -> Dict:
+    """Recompute every request cost in a session log with current prices.
+
+    Records are streamed in chunks of ``RECOST_CHUNK`` and priced column-wise.
+    With ``write`` the session is rewritten as one compacted log (sealed
+    segments are folded in) with a fresh summary sidecar; this needs the
+    session to have no live writers. Returns the request count, old and new
+    total cost, and the number of requests whose model has no price.
+    
+    Raises:
+        RuntimeError: If ``write`` is set and a process still has a live shard
+    """
+    with _session_locked(log_file, exclusive=True):
+        _recover_compaction(log_file)
+        _compact_shards(log_file, ())
+        return _recost_session(log_file, registry, write)
+
+def _recost_session(log_file: Path, registry: PricingRegistry, write: bool) -> Dict:
+    if write and (session_shards(log_file) or _sealing_shards(log_file)):
+        raise RuntimeError(f"Session {log_file.name} has live writers; re-cost it once they finish")
+    segments = session_segments(log_file)
+    old_cost, totals = _ExactSum(), _PairStats()
+    unpriced_count = 0
+    tmp_file = log_file.with_name(f"{log_file.name}.{os.getpid()}.recost.tmp")
+    out = open(tmp_file, "w", encoding="utf-8") if write else None
+    try:
+        records = _iter_session_requests(log_file, None, None)
+        while True:
+            chunk = list(itertools.islice(records, RECOST_CHUNK))
+            if not chunk:
+                break
+            costs, unpriced = registry.cost_columns(RequestColumns.from_records(chunk))
+            for request, cost, skipped in zip(chunk, costs, unpriced):
+                old_cost.add(request["cost"])
+                if skipped:
+                    unpriced_count += 1
+                else:
+                    request["cost"] = float(cost)
+                totals.add(request)
+            if out is not None:
+                out.write("".join(json.dumps(request) + "\n" for request in chunk))
+    finally:
+        if out is not None:
+            out.close()
+    aggregates = SessionAggregates()
+    totals.merge_into(aggregates)
+    if write:
+        _write_journal(log_file, {"inputs": [segment.name for segment in segments],
+                                  "log_inode": tmp_file.stat().st_ino})
+        os.replace(tmp_file, log_file)
+        for segment in segments:
+            segment.unlink()
+        _journal_path(log_file).unlink()
+        sidecar = read_summary_sidecar(log_file) or {}
+        start_time = sidecar.get("start_time", aggregates.first_timestamp or time.time())
+        _replace_text(summary_path_for_log(log_file), json.dumps({
+            "session_id": log_file.name[len("session_"):-len(".jsonl")],
+            "start_time": start_time,
+            "summary": aggregates.to_summary(start_time)
+        }, indent=2))
+    return {
+        "requests": aggregates.totals.requests,
+        "old_cost": old_cost.value,
+        "new_cost": aggregates.totals.cost.value,
+        "unpriced": unpriced_count
+    }
+
+FSYNC_POLICIES = ("none", "interval", "always")
+QUEUE_FULL_POLICIES = ("block", "drop")
+
+@dataclass
+class FlushSettings:
+    """How tracked requests reach disk.
+
+    Attributes:
+        background: Hand writes to a background thread instead of writing on
+            the request path
+        flush_interval: Seconds the writer waits to fill a batch; also the
+            fsync period for the ``interval`` policy
+        batch_size: Maximum number of queued writes handled per batch
+        fsync: ``none``, ``interval`` (at most once per flush_interval) or
+            ``always`` (after every batch, or every request when synchronous)
+        queue_size: Capacity of the in-memory write queue
+        on_full: ``block`` the caller until there is room, or ``drop`` the
+            sample and count it
+    """
+    background: bool = False
+    flush_interval: float = 1.0
+    batch_size: int = 256
+    fsync: str = "none"
+    queue_size: int = 10000
+    on_full: str = "block"
+    
+    def __post_init__(self):
+        if self.fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unsupported fsync policy: {self.fsync}. Use one of {', '.join(FSYNC_POLICIES)}.")
+        if self.on_full not in QUEUE_FULL_POLICIES:
+            raise ValueError(f"Unsupported queue-full policy: {self.on_full}. Use one of {', '.join(QUEUE_FULL_POLICIES)}.")
+    
+    @classmethod
+    def from_env(cls) -> "FlushSettings":
+        """Build settings from TOKEN_TRACKER_* environment variables"""
+        env = os.environ
+        return cls(
+            background=env.get("TOKEN_TRACKER_BACKGROUND", "") not in ("", "0"),
+            flush_interval=float(env.get("TOKEN_TRACKER_FLUSH_INTERVAL", 1.0)),
+            batch_size=int(env.get("TOKEN_TRACKER_BATCH_SIZE", 256)),
+            fsync=env.get("TOKEN_TRACKER_FSYNC", "none"),
+            queue_size=int(env.get("TOKEN_TRACKER_QUEUE_SIZE", 10000)),
+            on_full=env.get("TOKEN_TRACKER_ON_FULL", "block")
+        )
+
+@dataclass
+class RotationSettings:
+    """When a process's shard is sealed into a compressed segment.
+
+    Attributes:
+        max_bytes: Seal once about this many bytes were appended to the shard
+        max_age: Seal once the shard's oldest unsealed request is this many
+            seconds old; checked when a request is tracked
+        compression: ``gzip``, or ``zstd`` (needs the zstandard package),
+            for sealed segments
+    """
+    max_bytes: Optional[int] = None
+    max_age: Optional[float] = None
+    compression: str = "gzip"
+    
+    def __post_init__(self):
+        if self.compression not in SEGMENT_COMPRESSIONS:
+            raise ValueError(f"Unsupported compression: {self.compression}. Use one of {', '.join(SEGMENT_COMPRESSIONS)}.")
+        if self.compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package (pip install zstandard)")
+    
+    @classmethod
+    def from_env(cls) -> "RotationSettings":
+        """Build settings from TOKEN_TRACKER_ROTATE_* environment variables"""
+        env = os.environ
+        return cls(
+            max_bytes=int(env.get("TOKEN_TRACKER_ROTATE_BYTES", "0") or 0) or None,
+            max_age=float(env.get("TOKEN_TRACKER_ROTATE_AGE", "0") or 0) or None,
+            compression=env.get("TOKEN_TRACKER_COMPRESSION", "gzip")
+        )
+    
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes is not None or self.max_age is not None
+
+def _append_text(path: Path, text: str, fsync: bool = False):
+    """Append text to a file, optionally forcing it to stable storage"""
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(text)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+
+def _replace_text(path: Path, text: str, fsync: bool = False):
+    """Atomically replace a file's contents"""
+    tmp_file = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        f.write(text)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
+class BackgroundLogWriter:
+    """Writes token log appends and sidecar replacements off the request path.
+
+    Work items go through a bounded queue. The writer thread drains up to
+    ``batch_size`` items (waiting at most ``flush_interval`` for a batch to
+    fill), concatenates appends per file into a single write and keeps only
+    the newest replacement per file.
+    """
+    _STOP = object()
+    
+    def __init__(self, settings: FlushSettings):
+        self.settings = settings
+        self.dropped = 0
+        self._queue: "queue.Queue" = queue.Queue(maxsize=settings.queue_size)
+        self._last_fsync = time.monotonic()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="token-log-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+    
+    def append(self, path: Path, text: str) -> bool:
+        """Queue text to append to path; returns False if it was dropped"""
+        return self._submit(("append", path, text))
+    
+    def replace(self, path: Path, text: str) -> bool:
+        """Queue a full replacement of path; returns False if it was dropped"""
+        return self._submit(("replace", path, text))
+    
+    def _submit(self, item) -> bool:
+        if self.settings.on_full == "block":
+            self._queue.put(item)
+            return True
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+    
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Block until everything queued so far is written"""
+        if self._closed:
+            return True
+        done = threading.Event()
+        self._queue.put(("flush", None, done))
+        return done.wait(timeout)
+    
+    def close(self):
+        """Write out the queue and stop the writer thread"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(self._STOP)
+        self._thread.join()
+        atexit.unregister(self.close)
+    
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.settings.flush_interval
+            while len(batch) < self.settings.batch_size and batch[-1] is not self._STOP and batch[-1][0] != "flush":
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            stop = batch[-1] is self._STOP
+            try:
+                self._write_batch([item for item in batch if item is not self._STOP])
+            except Exception as e:
+                print(f"Error writing token logs: {e}", file=sys.stderr)
+            if stop:
+                return
+    
+    def _write_batch(self, batch):
+        appends: Dict[Path, List[str]] = {}
+        replacements: Dict[Path, str] = {}
+        waiters = []
+        for kind, path, payload in batch:
+            if kind == "append":
+                appends.setdefault(path, []).append(payload)
+            elif kind == "replace":
+                replacements[path] = payload
+            else:
+                waiters.append(payload)
+        
+        policy = self.settings.fsync
+        now = time.monotonic()
+        do_fsync = policy == "always" or (
+            policy == "interval" and now - self._last_fsync >= self.settings.flush_interval
+        )
+        try:
+            for path, texts in appends.items():
+                _append_text(path, "".join(texts), do_fsync)
+            for path, text in replacements.items():
+                _replace_text(path, text, do_fsync)
+            if do_fsync:
+                self._last_fsync = now
+        finally:
+            for done in waiters:
+                done.set()
+
+class _MetricSeries:
+    """Counters and a latency histogram for one (provider, model); the
+    request count is the histogram's total, so observing one costs no
+    separate counter. ``bounds`` are the histogram's upper bounds, kept
+    here so ``observe`` finds them without another lookup."""
+    __slots__ = ("prompt_tokens", "completion_tokens", "total_tokens", "cost", "latency_sum", "buckets", "bounds")
+    
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_tokens = 0
+        self.cost = 0.0
+        self.latency_sum = 0.0
+        self.buckets = [0] * (len(bounds) + 1)
+        self.bounds = bounds
+    
+    @property
+    def requests(self) -> int:
+        return sum(self.buckets)
+
+def _label_value(value) -> str:
+    """Escape a label value for the text exposition format"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class UsageMetrics:
+    """In-process request, token, cost and latency metrics.
+
+    Each thread observes into its own series, so ``observe`` takes no lock
+    and costs well under a microsecond; ``snapshot()`` and ``exposition()``
+    sum the threads' series when read. The series of exited threads are
+    folded into one, so thread churn does not grow them. Counters only ever grow, for the
+    life of the process. Latencies (``thinking_time``) go into cumulative
+    histogram buckets with upper bounds ``LATENCY_BUCKETS`` seconds.
+    """
+    LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+    
+    def __init__(self, latency_buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.latency_buckets = tuple(sorted(latency_buckets))
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Each thread's series by provider, then model: two lookups of
+        # existing strings are cheaper per observation than building a key
+        self._thread_series: List[Dict[str, Dict[str, _MetricSeries]]] = []
+        # Series of exited threads, queued by their thread-exit finalizers
+        # until they are folded into ``_exited_series``
+        self._exited: collections.deque = collections.deque()
+        self._exited_series: Dict[Tuple[str, str], _MetricSeries] = {}
+        self._collectors: List[Callable[[], Iterable[str]]] = []
+    
+    def add_collector(self, collector: Callable[[], Iterable[str]]):
+        """Append the lines ``collector()`` returns, in the text exposition
+        format, to ``exposition()``; for state kept outside the tracker, such
+        as gauges"""
+        with self._lock:
+            self._collectors.append(collector)
+    
+    def observe(self, provider: str, model: str, prompt_tokens: int, completion_tokens: int,
+                total_tokens: int, cost: float, latency: float):
+        try:
+            series = self._local.series[provider][model]
+        except (AttributeError, KeyError):
+            series = self._new_series(provider, model)
+        series.prompt_tokens += prompt_tokens
+        series.completion_tokens += completion_tokens
+        series.total_tokens += total_tokens
+        series.cost += cost
+        series.latency_sum += latency
+        series.buckets[bisect_left(series.bounds, latency)] += 1
+    
+    def _new_series(self, provider: str, model: str) -> _MetricSeries:
+        thread_series = getattr(self._local, "series", None)
+        if thread_series is None:
+            thread_series = self._local.series = {}
+            with self._lock:
+                self._fold_exited()
+                self._thread_series.append(thread_series)
+            _on_thread_exit(self._local, self._exited.append, thread_series)
+        series = thread_series.setdefault(provider, {})[model] = _MetricSeries(self.latency_buckets)
+        return series
+    
+    @classmethod
+    def _merge_series(cls, into: Dict[Tuple[str, str], _MetricSeries], thread_series: Dict[str, Dict[str, _MetricSeries]]):
+        for provider, by_model in list(thread_series.items()):
+            for model, series in list(by_model.items()):
+                cls._add_series(into, (provider, model), series)
+    
+    @staticmethod
+    def _add_series(into: Dict[Tuple[str, str], _MetricSeries], key: Tuple[str, str], series: _MetricSeries):
+        total = into.get(key)
+        if total is None:
+            total = into[key] = _MetricSeries(series.bounds)
+        total.prompt_tokens += series.prompt_tokens
+        total.completion_tokens += series.completion_tokens
+        total.total_tokens += series.total_tokens
+        total.cost += series.cost
+        total.latency_sum += series.latency_sum
+        total.buckets = [a + b for a, b in zip(total.buckets, series.buckets)]
+    
+    def _fold_exited(self):
+        """Fold the series of exited threads into one and drop them, so
+        thread churn does not grow ``_thread_series``; needs ``_lock``"""
+        while self._exited:
+            thread_series = self._exited.popleft()
+            self._merge_series(self._exited_series, thread_series)
+            self._thread_series.remove(thread_series)
+    
+    def snapshot(self) -> List[Dict]:
+        """Current totals per (provider, model), sorted by provider and model.
+
+        ``latency_buckets`` maps each upper bound (the last is ``inf``) to
+        the cumulative number of requests at or below it.
+        """
+        merged: Dict[Tuple[str, str], _MetricSeries] = {}
+        with self._lock:
+            self._fold_exited()
+            for key, series in self._exited_series.items():
+                self._add_series(merged, key, series)
+            thread_series = list(self._thread_series)
+        for series_by_key in thread_series:
+            self._merge_series(merged, series_by_key)
+        bounds = self.latency_buckets + (math.inf,)
+        return [
+            {
+                "provider": provider,
+                "model": model,
+                "requests": series.requests,
+                "prompt_tokens": series.prompt_tokens,
+                "completion_tokens": series.completion_tokens,
+                "total_tokens": series.total_tokens,
+                "cost": series.cost,
+                "latency_sum": series.latency_sum,
+                "latency_buckets": dict(zip(bounds, itertools.accumulate(series.buckets)))
+            }
+            for (provider, model), series in sorted(merged.items())
+        ]
+    
+    def exposition(self) -> str:
+        """The metrics in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        
+        def labels(row, **extra):
+            pairs = {"provider": row["provider"], "model": row["model"], **extra}
+            return "{" + ",".join(f'{key}="{_label_value(value)}"' for key, value in pairs.items()) + "}"
+        
+        lines = [
+            "# HELP llm_requests_total Tracked LLM API requests.",
+            "# TYPE llm_requests_total counter",
+        ]
+        lines.extend(f"llm_requests_total{labels(row)} {row['requests']}" for row in snapshot)
+        lines += ["# HELP llm_tokens_total Tokens used by tracked requests.", "# TYPE llm_tokens_total counter"]
+        for row in snapshot:
+            for kind in ("prompt", "completion"):
+                lines.append(f"llm_tokens_total{labels(row, type=kind)} {row[kind + '_tokens']}")
+        lines += ["# HELP llm_cost_dollars_total Cost of tracked requests in dollars.",
+                  "# TYPE llm_cost_dollars_total counter"]
+        lines.extend(f"llm_cost_dollars_total{labels(row)} {row['cost']!r}" for row in snapshot)
+        lines += ["# HELP llm_request_duration_seconds Time to complete tracked requests.",
+                  "# TYPE llm_request_duration_seconds histogram"]
+        for row in snapshot:
+            for bound, count in row["latency_buckets"].items():
+                le = "+Inf" if bound == math.inf else repr(float(bound))
+                lines.append(f"llm_request_duration_seconds_bucket{labels(row, le=le)} {count}")
+            lines.append(f"llm_request_duration_seconds_sum{labels(row)} {row['latency_sum']!r}")
+            lines.append(f"llm_request_duration_seconds_count{labels(row)} {row['requests']}")
+        with self._lock:
+            collectors = list(self._collectors)
+        for collector in collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+usage_metrics = UsageMetrics()
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    metrics: UsageMetrics = usage_metrics
+    
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.metrics.exposition().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port: int = 9464, host: str = "127.0.0.1",
+                         metrics: Optional[UsageMetrics] = None) -> ThreadingHTTPServer:
+    """Serve ``/metrics`` in the text exposition format from a daemon thread.
+
+    Pass ``port=0`` to pick a free port (see ``server.server_address``);
+    call ``server.shutdown()`` to stop it.
+    """
+    handler = type("MetricsHandler", (_MetricsHandler,), {"metrics": metrics or usage_metrics})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="token-tracker-metrics", daemon=True).start()
+    return server
+
+class _RequestIds:
+    """Unique record ids: a random per-process prefix and a counter.
+
+    As unique as ``uuid4().hex`` (same length) without reading the OS
+    entropy pool for every request.
+    """
+    def __init__(self):
+        self._reset()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+    
+    def _reset(self):
+        self._prefix = uuid.uuid4().hex[:20]
+        self._counter = itertools.count()
+    
+    def __call__(self) -> str:
+        return f"{self._prefix}{next(self._counter):012x}"
+
+new_request_id = _RequestIds()
+
+class _ThreadExit:
+    """Held only by a thread-local, so a ``weakref.finalize`` on it runs
+    when the thread exits"""
+    __slots__ = ("__weakref__",)
+
+def _on_thread_exit(local: threading.local, callback: Callable, *args):
+    """Call ``callback(*args)`` once the calling thread has exited"""
+    local.exit_sentinel = sentinel = _ThreadExit()
+    weakref.finalize(sentinel, callback, *args)
+
+class _Stripe:
+    """One thread's share of a tracker's running state.
+
+    Only the owning thread updates a stripe, under the stripe's own lock, so
+    the lock is uncontended except while a reader drains the stripe.
+    """
+    __slots__ = ("lock", "totals", "history", "manifest", "manifest_last_time")
+    
+    def __init__(self, capacity: Optional[int] = None):
+        self.lock = threading.Lock()
+        self.totals = _PairStats()
+        self.history = RequestColumns(capacity)
+        # Totals not yet appended to the manifest, per whole second, so the
+        # part a manifest rebuild already counted can be dropped
+        self.manifest: Dict[int, _GroupStats] = {}
+        self.manifest_last_time = 0.0
+
+# JSONL trackers whose pending manifest totals are written at exit. Held
+# weakly, so registering does not keep a tracker alive until then
+_manifest_trackers: "weakref.WeakSet[TokenTracker]" = weakref.WeakSet()
+
+@atexit.register
+def _write_manifest_rows():
+    for tracker in list(_manifest_trackers):
+        tracker._write_manifest_row()
+
 class TokenTracker:
-    def __init__(self, session_id: Optional[str] = None, logs_dir: Optional[Path] = None):
+    """Tracks LLM API usage for a session.
+
+    Each tracked request is appended as one line to this process's shard,
+    ``session_<id>.p<pid>.jsonl``; shards of finished processes are folded
+    into ``session_<id>.jsonl`` by ``compact_session``, so several processes
+    can share a session without overwriting each other. The session summary
+    lives in a small ``session_<id>.summary.json`` sidecar, so the bytes
+    written per request do not grow with the session.
+    Summary totals are maintained incrementally; with ``verify_aggregates``
+    (or ``TOKEN_TRACKER_VERIFY=1``) every tracked request is followed by a
+    full recompute that must match them exactly.
+    
+    With ``FlushSettings(background=True)`` log writes are handed to a
+    ``BackgroundLogWriter``; call ``flush()`` or ``close()`` to wait for them.
+    
+    ``backend="sqlite"`` (or ``TOKEN_TRACKER_BACKEND=sqlite``) stores requests
+    in ``usage.db`` inside the logs directory instead, via ``SqliteUsageStore``.
+    
+    Once the directory has a ``manifest.jsonl``, JSONL trackers append this
+    process's new totals to it at most every ``MANIFEST_INTERVAL`` seconds
+    and on ``flush()``/``close()``/exit, so listing sessions never scans the
+    logs. Worker processes that exit without running atexit handlers, and
+    code that drops a tracker before exit, should call ``close()`` themselves.
+    
+    Construction touches no files. The session's history is loaded on first
+    use (``requests``, ``get_session_summary()``, ...); until then requests
+    tracked for an existing session are appended without reading the old
+    ones, and the summary sidecar is refreshed once the history is loaded.
+    
+    With ``max_history`` (or ``TOKEN_TRACKER_MAX_HISTORY``) only the newest
+    ``max_history`` requests are kept in memory. Summary totals still
+    cover every request, and ``iter_history()`` streams the full history
+    back from disk. ``rotation`` (or ``TOKEN_TRACKER_ROTATE_*``) seals the
+    shard into compressed segments by size or age, and picks the segment
+    compression; bounded trackers without a rotation limit seal it every
+    ``BOUNDED_SHARD_BYTES``, so the hot shard does not grow with the
+    session either. Segment sizes never depend on ``max_history``.
+    
+    Trackers are thread-safe. Each thread tracks into its own ``_Stripe`` of
+    running totals, so ``track_request`` takes no tracker-wide lock; readers
+    drain the stripes into the shared totals under ``_lock``, and the
+    summary APIs return snapshots taken there. The sidecar is refreshed at
+    most every ``SUMMARY_INTERVAL`` seconds and on ``flush()``/``close()``.
+    Switching ``logs_dir``/``session_file`` while other threads are tracking
+    is not supported.
+    
+    Every tracked request is also counted in ``metrics`` (the process-wide
+    ``usage_metrics`` by default); see ``start_metrics_server``.
+    """
+    BACKENDS = ("jsonl", "sqlite")
+    BOUNDED_SHARD_BYTES = 8 * 1024 * 1024
+    MANIFEST_INTERVAL = 5.0
+    SUMMARY_INTERVAL = 1.0
+    
+    def __init__(self, session_id: Optional[str] = None, logs_dir: Optional[Path] = None,
+                 verify_aggregates: Optional[bool] = None, flush_settings: Optional[FlushSettings] = None,
+                 backend: Optional[str] = None, max_history: Optional[int] = None,
+                 metrics: Optional[UsageMetrics] = None, rotation: Optional[RotationSettings] = None):
         # If no session_id provided, use today's date
         self.session_id = session_id or datetime.now().strftime("%Y-%m-%d")
-        self.session_start = time.time()
-        self.requests: List[Dict] = []
+        self._session_start = time.time()
+        if max_history is None:
+            max_history = int(os.environ.get("TOKEN_TRACKER_MAX_HISTORY", "0") or 0) or None
+        if max_history is not None and max_history < 1:
+            raise ValueError(f"max_history must be at least 1, got {max_history}")
+        self.max_history = max_history
+        self.rotation = rotation or RotationSettings.from_env()
+        if max_history is not None and not self.rotation.enabled:
+            self.rotation = dataclasses.replace(self.rotation, max_bytes=self.BOUNDED_SHARD_BYTES)
+        self.metrics = metrics if metrics is not None else usage_metrics
+        self._history = RequestColumns(max_history)
+        self._aggregates = SessionAggregates()
+        # Guards the shared history/aggregates, stripe registration and file
+        # maintenance; track_request only takes it with a non-blocking try
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._stripes: List[_Stripe] = []
+        # Stripes of exited threads, queued by their thread-exit finalizers
+        # (deque appends need no lock) until they are folded in and dropped
+        self._exited_stripes: collections.deque = collections.deque()
+        # Keeps the manifest totals of dropped stripes until they are written
+        self._exited_manifest = _Stripe()
+        self._shard_key = None
+        self._shard_file: Optional[Path] = None
+        # Kept open for synchronous appends; closed whenever the shard is
+        # sealed, compacted or switched
+        self._shard_fd: Optional[int] = None
+        self._shard_fd_path: Optional[Path] = None
+        self._fd_lock = threading.Lock()
+        # Bytes appended to the shard, and when, since it was last sealed.
+        # Updated without a lock, so only approximate under threads; the
+        # rotation thresholds are soft anyway
+        self._shard_bytes = 0
+        self._shard_started: Optional[float] = None
+        if verify_aggregates is None:
+            verify_aggregates = os.environ.get("TOKEN_TRACKER_VERIFY", "") not in ("", "0")
+        self.verify_aggregates = verify_aggregates
+        self.flush_settings = flush_settings or FlushSettings.from_env()
+        self.backend = backend or os.environ.get("TOKEN_TRACKER_BACKEND", "jsonl")
+        if self.backend not in self.BACKENDS:
+            raise ValueError(f"Unsupported token tracker backend: {self.backend}. Use one of {', '.join(self.BACKENDS)}.")
+        use_writer = self.flush_settings.background and self.backend == "jsonl"
+        self._writer = BackgroundLogWriter(self.flush_settings) if use_writer else None
+        self._store: Optional[SqliteUsageStore] = None
+        self._manifest_written = time.monotonic()
+        self._summary_written = 0.0
+        # History is read on first use; the logs directory (or database) is
+        # only created by the first write
+        self._loaded = False
+        self._write_ready = False
         
-        # Create logs directory if it doesn't exist
         self._logs_dir = logs_dir or Path("token_logs")
-        self._logs_dir.mkdir(exist_ok=True)
-        
-        # Initialize session file
-        self._session_file = self._logs_dir / f"session_{self.session_id}.json"
-        
-        # Load existing session data if file exists
-        if self._session_file.exists():
+        self._session_file = session_log_path(self._logs_dir, self.session_id)
+        if self.backend == "jsonl":
+            _manifest_trackers.add(self)
+    
+    def _open_store(self) -> SqliteUsageStore:
+        """Open the SQLite store in the logs directory, once"""
+        if self._store is None:
+            with self._lock:
+                if self._store is None:
+                    self._logs_dir.mkdir(exist_ok=True)
+                    store = SqliteUsageStore(self._logs_dir / "usage.db")
+                    self._session_start = store.ensure_session(self.session_id, self._session_start)
+                    self._store = store
+        return self._store
+    
+    def _has_stored_session(self) -> bool:
+        """Whether the current session already has requests on disk"""
+        return (session_exists(self._session_file)
+                or legacy_session_path(self._logs_dir, self.session_id).exists())
+    
+    def _stripe(self) -> _Stripe:
+        """The calling thread's stripe, registered on first use"""
+        try:
+            return self._local.stripe
+        except AttributeError:
+            stripe = _Stripe(self.max_history)
+            with self._lock:
+                self._prune_stripes()
+                self._stripes.append(stripe)
+            self._local.stripe = stripe
+            _on_thread_exit(self._local, self._exited_stripes.append, stripe)
+            return stripe
+    
+    def _prune_stripes(self):
+        """Fold the stripes of exited threads into the shared state and
+        drop them, so thread churn does not grow ``_stripes``; needs ``_lock``"""
+        exited = []
+        while self._exited_stripes:
+            exited.append(self._exited_stripes.popleft())
+        if not exited:
+            return
+        # Only stripes taken before the drain are known to be fully drained
+        self._drain()
+        kept = self._exited_manifest
+        for stripe in exited:
+            with stripe.lock:
+                for second, stats in stripe.manifest.items():
+                    if second in kept.manifest:
+                        kept.manifest[second].merge(stats)
+                    else:
+                        kept.manifest[second] = stats
+                kept.manifest_last_time = max(kept.manifest_last_time, stripe.manifest_last_time)
+            self._stripes.remove(stripe)
+    
+    @contextlib.contextmanager
+    def _stripes_locked(self):
+        """Hold every stripe lock, so no request is mid-track; needs ``_lock``"""
+        with contextlib.ExitStack() as stack:
+            for stripe in self._stripes:
+                stack.enter_context(stripe.lock)
+            yield
+    
+    def _drain(self):
+        """Fold every stripe into the shared history and totals; needs ``_lock``"""
+        drained = []
+        for stripe in self._stripes:
+            with stripe.lock:
+                if not stripe.totals.groups:
+                    continue
+                totals, history = stripe.totals, stripe.history
+                stripe.totals = _PairStats()
+                stripe.history = RequestColumns(self.max_history)
+            totals.merge_into(self._aggregates)
+            drained.append(history)
+        if len(drained) == 1:
+            self._history.extend(drained[0])
+        elif drained:
+            # Interleave threads' requests by time
+            for request in heapq.merge(*drained, key=lambda request: request["timestamp"]):
+                self._history.append(request)
+    
+    def _ensure_loaded(self):
+        """Load the session's history, and any legacy session file, on first use"""
+        if self._loaded:
+            return
+        with self._lock, self._stripes_locked():
+            if self._loaded:
+                return
+            if self._writer is not None:
+                self._writer.flush()
+            if self.backend == "sqlite":
+                self._set_history(self._open_store().load_requests(self.session_id))
+            elif not self._has_stored_session():
+                self._set_history([])
+            else:
+                self._upgrade_legacy_session()
+                self._load_session_file(self._session_file)
+            self._loaded = True
+    
+    def _prepare_write(self):
+        """Create the logs directory or database before the first write.
+
+        A session with nothing on disk yet has no history to load, so it is
+        marked loaded right away and keeps its sidecar up to date.
+        """
+        if self._write_ready:
+            return
+        with self._lock:
+            if self._write_ready:
+                return
+            if self.backend == "sqlite":
+                self._open_store()
+            else:
+                if not self._loaded and not self._has_stored_session():
+                    self._ensure_loaded()
+                self._logs_dir.mkdir(exist_ok=True)
+            self._write_ready = True
+    
+    def _upgrade_legacy_session(self):
+        """Import a legacy session_<id>.json file into the JSONL layout"""
+        legacy_file = legacy_session_path(self._logs_dir, self.session_id)
+        if legacy_file.exists() and not self._session_file.exists():
             try:
-                with open(self._session_file, 'r') as f:
-                    data = json.load(f)
-                    self.session_start = data.get('start_time', self.session_start)
-                    self.requests = data.get('requests', [])
+                upgrade_legacy_session(legacy_file)
             except Exception as e:
-                print(f"Error loading existing session file: {e}", file=sys.stderr)
-        
-        self._save_session()
+                print(f"Error upgrading legacy session file: {e}", file=sys.stderr)
+    
+    def _load_session_file(self, path: Path):
+        """Rebuild in-memory state from a session log and its sidecar"""
+        try:
+            if self.max_history is None:
+                self._set_history(read_session_requests(path))
+            else:
+                self._set_history(iter_session_requests(path))
+            sidecar = read_summary_sidecar(path)
+            if sidecar:
+                self._session_start = sidecar.get('start_time', self._session_start)
+            elif self._aggregates.first_timestamp is not None:
+                self._session_start = min(self._session_start, self._aggregates.first_timestamp)
+        except Exception as e:
+            print(f"Error loading existing session file: {e}", file=sys.stderr)
+    
+    def _set_history(self, requests):
+        """Replace the in-memory history and aggregates with loaded records.
+
+        A bounded tracker accepts any iterable and reads it once, keeping
+        only the newest ``max_history`` records in memory.
+        """
+        if self.max_history is None:
+            self._aggregates = SessionAggregates.from_requests(requests)
+            self._history = RequestColumns.from_records(requests)
+            return
+        self._aggregates = SessionAggregates()
+        newest = []
+        for seq, request in enumerate(requests):
+            self._aggregates.add(request)
+            entry = (request["timestamp"], seq, request)
+            if len(newest) < self.max_history:
+                heapq.heappush(newest, entry)
+            elif entry > newest[0]:
+                heapq.heapreplace(newest, entry)
+        newest.sort()
+        self._history = RequestColumns.from_records((request for _, _, request in newest), self.max_history)
+    
+    def snapshot(self) -> Tuple[SessionAggregates, float]:
+        """A consistent copy of the session totals and start time"""
+        self._ensure_loaded()
+        with self._lock:
+            self._drain()
+            snapshot = SessionAggregates()
+            snapshot.merge(self._aggregates)
+            return snapshot, self._session_start
+    
+    @property
+    def session_start(self) -> float:
+        """When the session started; loads the session on first use"""
+        self._ensure_loaded()
+        return self._session_start
+    
+    @session_start.setter
+    def session_start(self, value: float):
+        self._session_start = value
+    
+    @property
+    def requests(self) -> RequestColumns:
+        """Request history, stored columnar; indexing yields request dicts.
+
+        Requests tracked by other threads are folded in on each access,
+        and a copy is returned, so later requests do not change it.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            self._drain()
+            return self._history.copy()
+    
+    @property
+    def summary_file(self) -> Path:
+        """Get the summary sidecar path for the current session file"""
+        return summary_path_for_log(self._session_file)
+    
+    @property
+    def shard_file(self) -> Path:
+        """Get the shard this process appends its requests to"""
+        key = (self._session_file, os.getpid())
+        if self._shard_key != key:
+            self._shard_key = key
+            self._shard_file = shard_path_for_log(*key)
+        return self._shard_file
+    
+    def _append_request(self, request_data: Dict):
+        """Append a single request record to this process's shard"""
+        if self.backend == "sqlite":
+            self._open_store().insert_requests(self.session_id, [request_data])
+            return
+        line = json.dumps(request_data) + "\n"
+        self._shard_bytes += len(line)
+        if self._shard_started is None:
+            self._shard_started = time.monotonic()
+        if self._writer is not None:
+            self._writer.append(self.shard_file, line)
+            return
+        fd = self._shard_handle()
+        data = line.encode("utf-8")
+        while data:
+            # O_APPEND makes each write land whole at the end of the shard
+            data = data[os.write(fd, data):]
+        if self.flush_settings.fsync == "always":
+            os.fsync(fd)
+    
+    def _shard_handle(self) -> int:
+        """File descriptor of this process's shard, opened once for appends"""
+        shard = self.shard_file
+        if self._shard_fd_path != shard:
+            # Called under a stripe lock, so never ``_lock`` here
+            with self._fd_lock:
+                if self._shard_fd_path != shard:
+                    self._close_shard_handle()
+                    self._shard_fd = os.open(shard, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                    self._shard_fd_path = shard
+        return self._shard_fd
+    
+    def _close_shard_handle(self):
+        """Close the cached shard descriptor; needs ``_lock`` and every stripe
+        lock, or otherwise no concurrent appends"""
+        if self._shard_fd is not None:
+            os.close(self._shard_fd)
+            self._shard_fd = None
+            self._shard_fd_path = None
     
-    def _save_session(self):
-        """Save current session data to file"""
+    def _rotation_due(self) -> bool:
+        """Whether the shard has outgrown ``rotation``'s size or age limit"""
+        rotation = self.rotation
+        if rotation.max_bytes is not None and self._shard_bytes >= rotation.max_bytes:
+            return True
+        started = self._shard_started
+        return (rotation.max_age is not None and started is not None
+                and time.monotonic() - started >= rotation.max_age)
+    
+    def _seal_shard(self, when_due: bool = False):
+        """Spill this process's shard into a compressed cold segment.
+
+        With ``when_due`` the shard is only sealed if rotation is still due
+        once the locks are held, so racing threads seal it once.
+        """
+        with self._lock, self._stripes_locked():
+            if when_due and not self._rotation_due():
+                return
+            # No thread is mid-append while the shard is renamed away
+            if self._writer is not None:
+                self._writer.flush()
+            self._close_shard_handle()
+            seal_shard(self.shard_file, self._session_file, os.getpid(), self.rotation.compression)
+            self._shard_bytes = 0
+            self._shard_started = None
+    
+    def iter_history(self) -> Iterator[Dict]:
+        """Stream every request of the session, including those no longer
+        held in memory. Bounded trackers read them back from disk unsorted."""
+        if self.max_history is None:
+            return iter(self.requests)
+        self._ensure_loaded()
+        return self._iter_stored(self._session_file)
+    
+    def _iter_stored(self, log_file: Path) -> Iterator[Dict]:
+        """Stream the session's requests as written to disk or the store"""
+        self.flush()
+        if self.backend == "sqlite":
+            return self._open_store().iter_requests(session_id=self.session_id)
+        return iter_session_requests(log_file)
+    
+    def _save_summary(self):
+        """Write the session summary sidecar"""
+        if self.backend == "sqlite":
+            # The database answers summary queries itself
+            return
+        aggregates, start_time = self.snapshot()
         session_data = {
             "session_id": self.session_id,
-            "start_time": self.session_start,
-            "requests": self.requests,
-            "summary": self.get_session_summary()
+            "start_time": start_time,
+            "summary": aggregates.to_summary(start_time)
         }
-        with open(self._session_file, "w") as f:
-            json.dump(session_data, f, indent=2)
+        self._summary_written = time.monotonic()
+        if self._writer is not None:
+            self._writer.replace(self.summary_file, json.dumps(session_data, indent=2))
+        else:
+            _replace_text(self.summary_file, json.dumps(session_data, indent=2), self.flush_settings.fsync == "always")
+    
+    def _save_session(self, source: Path):
+        """Write the full session history to the current log and summary.
+
+        Bounded trackers copy it over from ``source``, the log they were
+        tracking before, one record at a time.
+        """
+        self.flush()
+        records = self._iter_stored(source) if self.max_history is not None else self.requests
+        tmp_file = self._session_file.with_name(f"{self._session_file.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            for request in records:
+                f.write(json.dumps(request) + "\n")
+        os.replace(tmp_file, self._session_file)
+        self._save_summary()
+    
+    def _write_manifest_row(self):
+        """Append the totals tracked since the last manifest row"""
+        with self._lock:
+            self._prune_stripes()
+            pending: Dict[int, _GroupStats] = {}
+            last_time = 0.0
+            for stripe in self._stripes + [self._exited_manifest]:
+                with stripe.lock:
+                    buckets, stripe.manifest = stripe.manifest, {}
+                    last_time = max(last_time, stripe.manifest_last_time)
+                for second, stats in buckets.items():
+                    if second in pending:
+                        pending[second].merge(stats)
+                    else:
+                        pending[second] = stats
+            self._manifest_written = time.monotonic()
+            if self.backend == "jsonl":
+                _manifest_trackers.add(self)
+            if pending:
+                self._append_manifest_row(pending, last_time)
+    
+    def _append_manifest_row(self, pending: Dict[int, _GroupStats], last_time: float):
+        path = manifest_path(self._logs_dir)
+        if not path.exists():
+            # Nothing to keep up to date yet; the first listing builds the
+            # manifest from the logs, which already hold these requests
+            return
+        with _manifest_locked(self._logs_dir, exclusive=False):
+            rebuilt = manifest_rebuilt_at(self._logs_dir) or 0
+            stats = _GroupStats()
+            for second, bucket in pending.items():
+                if second >= rebuilt:
+                    stats.merge(bucket)
+            if stats.requests:
+                _append_text(path, _manifest_row(self.session_id, self._session_start, last_time, stats))
+    
+    @property
+    def dropped_requests(self) -> int:
+        """Number of requests the background writer dropped on a full queue"""
+        return self._writer.dropped if self._writer is not None else 0
+    
+    def flush(self):
+        """Wait until every tracked request, and the summary, has been written"""
+        self._write_manifest_row()
+        if self._loaded and self._write_ready:
+            self._save_summary()
+        if self._writer is not None:
+            self._writer.flush()
+    
+    def close(self):
+        """Flush pending writes and fold this process's shard into the log.
+
+        The background writer, if any, is stopped. The tracker stays usable;
+        later requests are written synchronously to a fresh shard.
+        """
+        self._write_manifest_row()
+        if self._loaded and self._write_ready:
+            self._save_summary()
+        with self._lock, self._stripes_locked():
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            if self.backend == "sqlite":
+                return
+            self._close_shard_handle()
+            compact_session(self._session_file, include_pids=(os.getpid(),))
+            self._shard_bytes = 0
+            self._shard_started = None
+            # Nothing is left to write at exit. A request tracked after this
+            # writes its manifest row right away, which registers the tracker again
+            _manifest_trackers.discard(self)
+            self._manifest_written = -math.inf
     
     @property
     def logs_dir(self) -> Path:
@@ -83,9 +2664,20 @@ class TokenTracker:
     @logs_dir.setter
     def logs_dir(self, path: Path):
         """Set the logs directory path and update session file path"""
-        self._logs_dir = path
-        self._logs_dir.mkdir(exist_ok=True)
-        self.session_file = self._logs_dir / f"session_{self.session_id}.json"
+        self.flush()
+        with self._lock:
+            if self.backend == "sqlite":
+                # Reopened, and the session reloaded, on next use
+                self._drain()
+                if self._store is not None:
+                    self._store.close()
+                    self._store = None
+                self._logs_dir = path
+                self._session_file = session_log_path(self._logs_dir, self.session_id)
+                self._loaded = self._write_ready = False
+                return
+            self.session_file = session_log_path(path, self.session_id)
+            self._logs_dir = path
     
     @property
     def session_file(self) -> Path:
@@ -94,68 +2686,46 @@ class TokenTracker:
     
     @session_file.setter
     def session_file(self, path: Path):
-        """Set the session file path and load data if it exists"""
+        """Set the session file path; its data, if any, is loaded on next use"""
         old_file = self._session_file
-        self._session_file = path
-        
-        # If we have data and the new file doesn't exist, save our data
-        if old_file.exists() and not path.exists() and self.requests:
-            self._save_session()
-        # If the new file exists, load its data
-        elif path.exists():
-            try:
-                with open(path, 'r') as f:
-                    data = json.load(f)
-                    self.session_start = data.get('start_time', self.session_start)
-                    self.requests = data.get('requests', [])
-            except Exception as e:
-                print(f"Error loading existing session file: {e}", file=sys.stderr)
+        has_data = session_exists(path) or legacy_session_path(path.parent, self.session_id).exists()
+        if not has_data:
+            # Our history is carried over to the new file
+            self._ensure_loaded()
+        with self._lock:
+            self._drain()
+            self._session_file = path
+            self._write_ready = False
+            
+            # If we have data and the new file doesn't exist, save our data
+            if not has_data and self._aggregates.totals.requests:
+                path.parent.mkdir(exist_ok=True)
+                self._save_session(old_file)
+            # If the new file exists, load its data when it is needed
+            elif has_data:
+                self._loaded = False
     
     @staticmethod
     def calculate_openai_cost(prompt_tokens: int, completion_tokens: int, model: str) -> float:
         """Calculate OpenAI API cost based on model and token usage"""
-        # Only support o1, gpt-4o, and deepseek-chat models
-        if model == "o1":
-            # o1 pricing per 1M tokens
-            INPUT_PRICE_PER_M = 15.0
-            OUTPUT_PRICE_PER_M = 60.0
-        elif model == "gpt-4o":
-            # gpt-4o pricing per 1M tokens
-            INPUT_PRICE_PER_M = 10.0
-            OUTPUT_PRICE_PER_M = 30.0
-        elif model == "deepseek-chat":
-            # DeepSeek pricing per 1M tokens
-            INPUT_PRICE_PER_M = 0.2  # $0.20 per million input tokens
-            OUTPUT_PRICE_PER_M = 0.2  # $0.20 per million output tokens
-        else:
-            raise ValueError(f"Unsupported OpenAI model for cost calculation: {model}. Only o1, gpt-4o, and deepseek-chat are supported.")
-        
-        input_cost = (prompt_tokens / 1_000_000) * INPUT_PRICE_PER_M
-        output_cost = (completion_tokens / 1_000_000) * OUTPUT_PRICE_PER_M
-        return input_cost + output_cost
+        return get_pricing_registry().cost("openai", model, prompt_tokens, completion_tokens)
     
     @staticmethod
     def calculate_claude_cost(prompt_tokens: int, completion_tokens: int, model: str) -> float:
         """Calculate Claude API cost based on model and token usage"""
-        # Claude-3 Sonnet pricing per 1M tokens
-        # Source: https://www.anthropic.com/claude/sonnet
-        if model in ["claude-3-5-sonnet-20241022", "claude-3-sonnet-20240229"]:
-            INPUT_PRICE_PER_M = 3.0  # $3 per million input tokens
-            OUTPUT_PRICE_PER_M = 15.0  # $15 per million output tokens
-        else:
-            raise ValueError(f"Unsupported Claude model for cost calculation: {model}. Only claude-3-5-sonnet-20241022 and claude-3-sonnet-20240229 are supported.")
-        
-        input_cost = (prompt_tokens / 1_000_000) * INPUT_PRICE_PER_M
-        output_cost = (completion_tokens / 1_000_000) * OUTPUT_PRICE_PER_M
-        return input_cost + output_cost
+        return get_pricing_registry().cost("anthropic", model, prompt_tokens, completion_tokens)
     
     def track_request(self, response: APIResponse):
         """Track a new API request"""
         # Only track costs for OpenAI and Anthropic
         if response.provider.lower() not in ["openai", "anthropic"]:
             return
-            
+        
+        usage = response.token_usage
+        self.metrics.observe(response.provider, response.model, usage.prompt_tokens, usage.completion_tokens,
+                             usage.total_tokens, response.cost, response.thinking_time)
         request_data = {
+            "id": new_request_id(),
             "timestamp": time.time(),
             "provider": response.provider,
             "model": response.model,
@@ -168,70 +2738,159 @@ class TokenTracker:
             "cost": response.cost,
             "thinking_time": response.thinking_time
         }
-        self.requests.append(request_data)
-        self._save_session()
+        self._prepare_write()
+        stripe = self._stripe()
+        with stripe.lock:
+            # Until the history is needed, new requests only go to disk
+            if self._loaded:
+                stripe.history.append(request_data)
+                stripe.totals.add(request_data)
+            self._append_request(request_data)
+            if self.backend == "jsonl":
+                second = int(request_data["timestamp"])
+                bucket = stripe.manifest.get(second)
+                if bucket is None:
+                    bucket = stripe.manifest[second] = _GroupStats()
+                bucket.add(request_data)
+                stripe.manifest_last_time = request_data["timestamp"]
+        if self.rotation.enabled and self.backend == "jsonl" and self._rotation_due():
+            self._seal_shard(when_due=True)
+        if self.verify_aggregates:
+            self.verify_summary()
+        
+        # Periodic sidecar and manifest updates; skipped, not waited for,
+        # while another thread holds the lock
+        now = time.monotonic()
+        jsonl = self.backend == "jsonl"
+        summary_due = jsonl and self._loaded and now - self._summary_written >= self.SUMMARY_INTERVAL
+        manifest_due = jsonl and now - self._manifest_written >= self.MANIFEST_INTERVAL
+        if (summary_due or manifest_due) and self._lock.acquire(blocking=False):
+            try:
+                if summary_due:
+                    self._save_summary()
+                if manifest_due:
+                    self._write_manifest_row()
+            finally:
+                self._lock.release()
     
     def get_session_summary(self) -> Dict:
         """Get summary of token usage and costs for the current session"""
-        total_prompt_tokens = sum(r["token_usage"]["prompt_tokens"] for r in self.requests)
-        total_completion_tokens = sum(r["token_usage"]["completion_tokens"] for r in self.requests)
-        total_tokens = sum(r["token_usage"]["total_tokens"] for r in self.requests)
-        total_cost = sum(r["cost"] for r in self.requests)
-        total_thinking_time = sum(r["thinking_time"] for r in self.requests)
-        
-        # Group by provider
-        provider_stats = {}
-        for r in self.requests:
-            provider = r["provider"]
-            if provider not in provider_stats:
-                provider_stats[provider] = {
-                    "requests": 0,
-                    "total_tokens": 0,
-                    "total_cost": 0.0
-                }
-            provider_stats[provider]["requests"] += 1
-            provider_stats[provider]["total_tokens"] += r["token_usage"]["total_tokens"]
-            provider_stats[provider]["total_cost"] += r["cost"]
-        
-        return {
-            "total_requests": len(self.requests),
-            "total_prompt_tokens": total_prompt_tokens,
-            "total_completion_tokens": total_completion_tokens,
-            "total_tokens": total_tokens,
-            "total_cost": total_cost,
-            "total_thinking_time": total_thinking_time,
-            "provider_stats": provider_stats,
-            "session_duration": time.time() - self.session_start
+        aggregates, start_time = self.snapshot()
+        return aggregates.to_summary(start_time)
+    
+    def verify_summary(self):
+        """Check the running aggregates against a full recompute.
+
+        Raises:
+            RuntimeError: If any summary field differs from the recompute
+        """
+        self._ensure_loaded()
+        with self._lock:
+            self._drain()
+            incremental = self._aggregates.to_summary(self._session_start)
+            history = self._history if self.max_history is None else list(self._iter_stored(self._session_file))
+            recomputed = summarize_requests(history, self._session_start)
+        mismatched = [
+            key for key in recomputed
+            if key != "session_duration" and incremental.get(key) != recomputed[key]
+        ]
+        if mismatched:
+            raise RuntimeError(f"Session aggregates diverged from full recompute: {', '.join(mismatched)}")
+
+def summarize_requests(requests: List[Dict], start_time: float) -> Dict:
+    """Compute a session summary from a list of request records.
+
+    This is the full recompute that ``SessionAggregates`` must match; float
+    totals use ``math.fsum`` so the result does not depend on order.
+    """
+    total_prompt_tokens = sum(r["token_usage"]["prompt_tokens"] for r in requests)
+    total_completion_tokens = sum(r["token_usage"]["completion_tokens"] for r in requests)
+    total_tokens = sum(r["token_usage"]["total_tokens"] for r in requests)
+    total_cost = math.fsum(r["cost"] for r in requests)
+    total_thinking_time = math.fsum(r["thinking_time"] for r in requests)
+    
+    # Group by provider and by model
+    providers: Dict[str, List[Dict]] = {}
+    models: Dict[str, List[Dict]] = {}
+    for r in requests:
+        providers.setdefault(r["provider"], []).append(r)
+        models.setdefault(r["model"], []).append(r)
+    
+    provider_stats = {
+        provider: {
+            "requests": len(group),
+            "total_tokens": sum(r["token_usage"]["total_tokens"] for r in group),
+            "total_cost": math.fsum(r["cost"] for r in group)
+        }
+        for provider, group in providers.items()
+    }
+    model_stats = {
+        model: {
+            "requests": len(group),
+            "prompt_tokens": sum(r["token_usage"]["prompt_tokens"] for r in group),
+            "completion_tokens": sum(r["token_usage"]["completion_tokens"] for r in group),
+            "total_tokens": sum(r["token_usage"]["total_tokens"] for r in group),
+            "total_cost": math.fsum(r["cost"] for r in group),
+            "total_thinking_time": math.fsum(r["thinking_time"] for r in group)
         }
+        for model, group in models.items()
+    }
+    
+    return {
+        "total_requests": len(requests),
+        "total_prompt_tokens": total_prompt_tokens,
+        "total_completion_tokens": total_completion_tokens,
+        "total_tokens": total_tokens,
+        "total_cost": total_cost,
+        "total_thinking_time": total_thinking_time,
+        "provider_stats": provider_stats,
+        "model_stats": model_stats,
+        "session_duration": time.time() - start_time
+    }
 
 # Global token tracker instance
 _token_tracker: Optional[TokenTracker] = None
+_token_tracker_lock = threading.Lock()
+_metrics_server_started = False
 
 def get_token_tracker(session_id: Optional[str] = None, logs_dir: Optional[Path] = None) -> TokenTracker:
-    """Get or create a global token tracker instance"""
-    global _token_tracker
-    current_date = datetime.now().strftime("%Y-%m-%d")
-    
-    # If no tracker exists, create one
-    if _token_tracker is None:
-        _token_tracker = TokenTracker(session_id or current_date, logs_dir=logs_dir)
-        return _token_tracker
-    
-    # If no session_id provided, reuse current tracker
-    if session_id is None:
-        if logs_dir is not None:
-            _token_tracker.logs_dir = logs_dir
-        return _token_tracker
-    
-    # If session_id matches current tracker, reuse it
-    if session_id == _token_tracker.session_id:
-        if logs_dir is not None:
-            _token_tracker.logs_dir = logs_dir
+    """Get or create a global token tracker instance (thread-safe).
+
+    With ``TOKEN_TRACKER_METRICS_PORT`` set, the first call also starts the
+    local metrics endpoint on that port.
+    """
+    global _token_tracker, _metrics_server_started
+    with _token_tracker_lock:
+        port = os.environ.get("TOKEN_TRACKER_METRICS_PORT")
+        if port and not _metrics_server_started:
+            _metrics_server_started = True
+            try:
+                start_metrics_server(int(port))
+            except (OSError, ValueError) as e:
+                print(f"Error starting metrics endpoint on port {port}: {e}", file=sys.stderr)
+        current_date = datetime.now().strftime("%Y-%m-%d")
+        
+        # If no tracker exists, create one
+        if _token_tracker is None:
+            _token_tracker = TokenTracker(session_id or current_date, logs_dir=logs_dir)
+            return _token_tracker
+        
+        # If no session_id provided, reuse current tracker
+        if session_id is None:
+            if logs_dir is not None and logs_dir != _token_tracker.logs_dir:
+                _token_tracker.logs_dir = logs_dir
+            return _token_tracker
+        
+        # If session_id matches current tracker, reuse it
+        if session_id == _token_tracker.session_id:
+            if logs_dir is not None and logs_dir != _token_tracker.logs_dir:
+                _token_tracker.logs_dir = logs_dir
+            return _token_tracker
+        
+        # Otherwise, flush the old session and create a new tracker
+        _token_tracker.close()
+        _token_tracker = TokenTracker(session_id, logs_dir=logs_dir)
         return _token_tracker
-    
-    # Otherwise, create a new tracker
-    _token_tracker = TokenTracker(session_id, logs_dir=logs_dir)
-    return _token_tracker
 
 # Viewing functionality (moved from view_usage.py)
 def format_cost(cost: float) -> str:
@@ -248,15 +2907,124 @@ def format_duration(seconds: float) -> str:
     hours = minutes / 60
     return f"{hours:.2f}h"
 
-def load_session(session_file: Path) -> Optional[Dict]:
-    """Load a session file and return its contents"""
+def load_session(session_file: Path, stream_requests: bool = False, since: Optional[float] = None,
+                 until: Optional[float] = None) -> Optional[Dict]:
+    """Load a session file and return its contents.
+
+    JSONL session logs are rebuilt into the same shape as the legacy
+    single-document files: ``session_id``, ``start_time``, ``requests`` and
+    a freshly computed ``summary``.
+    
+    With ``stream_requests`` the summary is computed in one streaming pass
+    and ``requests`` is a one-shot iterator over a second pass (unsorted), so
+    memory does not grow with the session.
+    
+    ``since``/``until`` restrict JSONL sessions to requests in that window;
+    compressed segments outside it are not read.
+    """
     try:
-        with open(session_file, 'r') as f:
-            return json.load(f)
+        if session_file.suffix != ".jsonl":
+            with open(session_file, 'r') as f:
+                return json.load(f)
+        
+        if stream_requests:
+            aggregates = SessionAggregates.from_requests(iter_session_requests(session_file, since, until))
+            sidecar = read_summary_sidecar(session_file) or {}
+            start_time = sidecar.get('start_time', aggregates.first_timestamp or time.time())
+            return {
+                "session_id": session_file.name[len("session_"):-len(".jsonl")],
+                "start_time": start_time,
+                "requests": iter_session_requests(session_file, since, until),
+                "summary": aggregates.to_summary(start_time)
+            }
+        
+        requests = read_session_requests(session_file, since, until)
+        sidecar = read_summary_sidecar(session_file) or {}
+        start_time = sidecar.get('start_time', requests[0]["timestamp"] if requests else time.time())
+        return {
+            "session_id": session_file.name[len("session_"):-len(".jsonl")],
+            "start_time": start_time,
+            "requests": requests,
+            "summary": summarize_requests(requests, start_time)
+        }
     except Exception as e:
         print(f"Error loading session file {session_file}: {e}", file=sys.stderr)
         return None
 
+def find_session_files(logs_dir: Path) -> Dict[str, Path]:
+    """Map session IDs to their log files, preferring JSONL over legacy JSON.
+
+    A session that so far only has per-process shards or sealed segments
+    maps to the path its compacted log will have.
+    """
+    sessions = {}
+    for legacy_file in logs_dir.glob("session_*.json"):
+        if legacy_file.name.endswith(".summary.json"):
+            continue
+        sessions[legacy_file.stem[len("session_"):]] = legacy_file
+    for log_file in logs_dir.glob("session_*.jsonl*"):
+        match = _LOG_NAME.match(log_file.name) or _SEGMENT_NAME.match(log_file.name)
+        if match:
+            session_id = match.group("session_id")
+            sessions[session_id] = session_log_path(logs_dir, session_id)
+    return dict(sorted(sessions.items()))
+
+def compact_sessions(logs_dir: Path) -> int:
+    """Compact the shards of finished processes for every session"""
+    compacted = 0
+    for session_file in find_session_files(logs_dir).values():
+        if session_file.suffix == ".jsonl":
+            compacted += compact_session(session_file)
+    return compacted
+
+def compact_all_segments(logs_dir: Path, retention: Optional[float] = None, compression: str = "gzip",
+                         target_bytes: int = SEGMENT_TARGET_BYTES) -> Dict:
+    """Run ``compact_segments`` on every JSONL session; returns summed counts"""
+    totals = {"read": 0, "written": 0, "expired": 0}
+    now = time.time()
+    for session_file in find_session_files(logs_dir).values():
+        if session_file.suffix == ".jsonl":
+            result = compact_segments(session_file, retention, compression, target_bytes, now)
+            for key in totals:
+                totals[key] += result[key]
+    return totals
+
+def recost_sessions(logs_dir: Path, registry: PricingRegistry, write: bool = True,
+                    session_id: Optional[str] = None) -> int:
+    """Re-cost every JSONL session (or one) and print old and new totals.
+
+    Returns the number of sessions re-costed. Legacy JSON sessions need
+    ``--upgrade`` first. The manifest, if any, is rebuilt afterwards.
+    """
+    recosted = 0
+    for sid, session_file in find_session_files(logs_dir).items():
+        if session_id is not None and sid != session_id:
+            continue
+        if session_file.suffix != ".jsonl":
+            print(f"Skipping legacy session {sid} (run with --upgrade first)", file=sys.stderr)
+            continue
+        try:
+            result = recost_session(session_file, registry, write)
+        except RuntimeError as e:
+            print(f"Error re-costing session {sid}: {e}", file=sys.stderr)
+            continue
+        recosted += 1
+        unpriced = f"  ({result['unpriced']} unpriced)" if result["unpriced"] else ""
+        print(f"Session: {sid}  Requests: {result['requests']}  "
+              f"Cost: {format_cost(result['old_cost'])} -> {format_cost(result['new_cost'])}{unpriced}")
+    if write and recosted and manifest_path(logs_dir).exists():
+        rebuild_manifest(logs_dir)
+    return recosted
+
+def upgrade_sessions(logs_dir: Path) -> int:
+    """Upgrade every legacy session file in logs_dir; returns the count"""
+    upgraded = 0
+    for session_id, session_file in find_session_files(logs_dir).items():
+        if session_file.suffix == ".json":
+            upgrade_legacy_session(session_file)
+            upgraded += 1
+    return upgraded
+
 def display_session_summary(session_data: Dict, show_requests: bool = False):
     """Display a summary of the session"""
     summary = session_data["summary"]
@@ -293,46 +3061,208 @@ def display_session_summary(session_data: Dict, show_requests: bool = False):
         tablefmt="simple"
     ))
     
-    # Print individual requests if requested
+    # Print model stats (absent from summaries written before they existed)
+    if summary.get("model_stats"):
+        print("\nModel Statistics")
+        print("================")
+        model_data = []
+        for model, stats in summary["model_stats"].items():
+            model_data.append([
+                model,
+                stats["requests"],
+                f"{stats['total_tokens']:,}",
+                format_cost(stats["total_cost"]),
+                f"{stats['total_thinking_time']:.2f}s"
+            ])
+        print(tabulate(
+            model_data,
+            headers=["Model", "Requests", "Tokens", "Cost", "Time"],
+            tablefmt="simple"
+        ))
+    
+    # Print individual requests if requested; rows are printed as they are
+    # read, so long histories stream instead of being tabulated in memory
     if show_requests:
         print("\nIndividual Requests")
         print("==================")
-        request_data = []
+        row = "{:<10}  {:<28}  {:>12}  {:>12}  {:>9}"
+        print(row.format("Provider", "Model", "Tokens", "Cost", "Time"))
+        print(row.format("-" * 10, "-" * 28, "-" * 12, "-" * 12, "-" * 9))
         for req in session_data["requests"]:
-            request_data.append([
+            print(row.format(
                 req["provider"],
                 req["model"],
                 f"{req['token_usage']['total_tokens']:,}",
                 format_cost(req["cost"]),
                 f"{req['thinking_time']:.2f}s"
-            ])
-        print(tabulate(
-            request_data,
-            headers=["Provider", "Model", "Tokens", "Cost", "Time"],
-            tablefmt="simple"
-        ))
+            ))
+
+ROLLUP_GRANULARITIES = {"hour": 3600, "day": 86400, "week": 7 * 86400}
+# Weekly buckets start on Monday; 1970-01-05 (epoch + 4 days) was a Monday
+_WEEK_OFFSET = 4 * 86400
+
+def iter_all_requests(logs_dir: Path, since: Optional[float] = None,
+                      until: Optional[float] = None) -> Iterator[Tuple[str, Dict]]:
+    """Stream (session_id, request) pairs across every session in logs_dir.
+
+    With ``since``/``until`` only requests in ``[since, until)`` are
+    yielded; segments outside that window are skipped unread.
+    """
+    for session_id, session_file in find_session_files(logs_dir).items():
+        if session_file.suffix == ".jsonl":
+            records = iter_session_requests(session_file, since, until)
+        else:
+            records = (request for request in iter_legacy_requests(session_file)
+                       if (since is None or request["timestamp"] >= since)
+                       and (until is None or request["timestamp"] < until))
+        for request in records:
+            yield session_id, request
+
+class UsageRollup:
+    """Streaming time-bucketed rollup of requests by provider and model.
+
+    Memory grows with the number of (bucket, provider, model) groups, not
+    with the number of requests added. Buckets are aligned to UTC.
+    """
+    def __init__(self, granularity: str = "day"):
+        if granularity not in ROLLUP_GRANULARITIES:
+            raise ValueError(f"Unsupported rollup granularity: {granularity}. Use one of {', '.join(ROLLUP_GRANULARITIES)}.")
+        self.granularity = granularity
+        self._width = ROLLUP_GRANULARITIES[granularity]
+        self._offset = _WEEK_OFFSET if granularity == "week" else 0
+        self._groups: Dict[Tuple[float, str, str], _GroupStats] = {}
+    
+    def bucket_start(self, timestamp: float) -> float:
+        return ((timestamp - self._offset) // self._width) * self._width + self._offset
+    
+    def _group(self, timestamp: float, provider: str, model: str) -> _GroupStats:
+        key = (self.bucket_start(timestamp), provider, model)
+        stats = self._groups.get(key)
+        if stats is None:
+            stats = self._groups[key] = _GroupStats()
+        return stats
+    
+    def add(self, request: Dict):
+        self._group(request["timestamp"], request["provider"], request["model"]).add(request)
+    
+    def add_rollup(self, row: Dict):
+        """Add an hourly row kept in ``rollups.jsonl`` for expired requests"""
+        self._group(row["bucket"], row["provider"], row["model"]).add_counters(row)
+    
+    def rows(self) -> List[Dict]:
+        """Rollup rows ordered by bucket, provider and model"""
+        return [
+            {
+                "bucket": datetime.fromtimestamp(bucket, timezone.utc).strftime("%Y-%m-%dT%H:%MZ"),
+                "provider": provider,
+                "model": model,
+                **stats.counters()
+            }
+            for (bucket, provider, model), stats in sorted(self._groups.items())
+        ]
+
+def write_rollup(rows: List[Dict], fmt: str = "table", out=None):
+    """Write rollup rows as a table, CSV or JSONL"""
+    out = out or sys.stdout
+    if fmt == "jsonl":
+        for row in rows:
+            out.write(json.dumps(row) + "\n")
+    elif fmt == "csv":
+        writer = csv.DictWriter(out, fieldnames=list(rows[0]) if rows else ["bucket"])
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        table = [
+            [row["bucket"], row["provider"], row["model"], row["requests"],
+             f"{row['total_tokens']:,}", format_cost(row["cost"])]
+            for row in rows
+        ]
+        out.write(tabulate(table, headers=["Bucket", "Provider", "Model", "Requests", "Tokens", "Cost"],
+                           tablefmt="simple") + "\n")
+
+def display_session_analytics(columns: RequestColumns):
+    """Display latency percentiles, throughput and hourly cost per model"""
+    print("\nLatency and Throughput")
+    print("======================")
+    rows = []
+    tokens_per_second = columns.tokens_per_second()
+    for model in columns.models:
+        latency = columns.latency_percentiles(model=model)
+        rows.append([model, f"{latency[50]:.2f}s", f"{latency[95]:.2f}s", f"{latency[99]:.2f}s",
+                     f"{tokens_per_second[model]:.1f}"])
+    print(tabulate(rows, headers=["Model", "p50", "p95", "p99", "Tokens/s"], tablefmt="simple"))
+    
+    print("\nCost per Model per Hour")
+    print("=======================")
+    rows = []
+    for model, buckets in columns.cost_per_model_per_hour().items():
+        for hour, cost in sorted(buckets.items()):
+            rows.append([model, datetime.fromtimestamp(hour, tz=timezone.utc).strftime("%Y-%m-%d %H:00"), format_cost(cost)])
+    print(tabulate(rows, headers=["Model", "Hour (UTC)", "Cost"], tablefmt="simple"))
 
 def list_sessions(logs_dir: Path):
-    """List all available session files"""
-    session_files = sorted(logs_dir.glob("session_*.json"))
-    if not session_files:
+    """List all sessions from the manifest, building it on first use"""
+    sessions = read_manifest(logs_dir)
+    if sessions is None:
+        if not find_session_files(logs_dir):
+            print("No session files found.")
+            return
+        rebuild_manifest(logs_dir)
+        sessions = read_manifest(logs_dir) or {}
+    if not sessions:
         print("No session files found.")
         return
     
-    for session_file in session_files:
-        session_data = load_session(session_file)
-        if session_data:
-            summary = session_data["summary"]
-            print(f"\nSession: {session_data['session_id']}")
-            print(f"Duration: {format_duration(summary['session_duration'])}")
-            print(f"Requests: {summary['total_requests']}")
-            print(f"Total Cost: {format_cost(summary['total_cost'])}")
-            print(f"Total Tokens: {summary['total_tokens']:,}")
+    for session_id, row in sessions.items():
+        print(f"\nSession: {session_id}")
+        print(f"Duration: {format_duration(row['last_time'] - row['start_time'])}")
+        print(f"Requests: {row['requests']}")
+        print(f"Total Cost: {format_cost(row['cost'])}")
+        print(f"Total Tokens: {row['total_tokens']:,}")
+
+def list_store_sessions(store: SqliteUsageStore, **filters):
+    """List sessions from the usage database, restricted to matching requests"""
+    sessions = store.list_sessions(**filters)
+    if not sessions:
+        print("No matching requests found.")
+        return
+    
+    for session in sessions:
+        print(f"\nSession: {session['session_id']}")
+        print(f"Duration: {format_duration(session['end_time'] - session['start_time'])}")
+        print(f"Requests: {session['total_requests']}")
+        print(f"Total Cost: {format_cost(session['total_cost'])}")
+        print(f"Total Tokens: {session['total_tokens']:,}")
+
+def parse_time(value: str) -> float:
+    """Parse an ISO date or datetime from the command line into a timestamp;
+    without an offset it is taken as UTC, like the logs' timestamps"""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
 
 def main():
     parser = argparse.ArgumentParser(description='View LLM API usage statistics')
     parser.add_argument('--session', type=str, help='Session ID to view details for')
     parser.add_argument('--requests', action='store_true', help='Show individual requests')
+    parser.add_argument('--analytics', action='store_true', help='Show latency percentiles, throughput and hourly cost per model')
+    parser.add_argument('--upgrade', action='store_true', help='Convert legacy session_<id>.json files to JSONL logs')
+    parser.add_argument('--compact', action='store_true', help='Fold shards of finished processes into the session logs, then merge small segments')
+    parser.add_argument('--retention-days', type=float, help='With --compact, drop requests older than this many days, keeping their hourly rollups')
+    parser.add_argument('--compression', choices=list(SEGMENT_COMPRESSIONS), default='gzip', help='Compression for segments written by --compact')
+    parser.add_argument('--rebuild-manifest', action='store_true', help='Rebuild the session manifest after adding or removing log files by hand')
+    parser.add_argument('--recost', action='store_true', help='Recompute request costs in the session logs (or --session) from the price table')
+    parser.add_argument('--pricing', type=str, help='JSON price file to use (default: TOKEN_TRACKER_PRICING or built-in prices)')
+    parser.add_argument('--dry-run', action='store_true', help='With --recost, print the new totals without rewriting any logs')
+    parser.add_argument('--backend', choices=TokenTracker.BACKENDS, help='Read from JSONL logs or the SQLite usage database')
+    parser.add_argument('--import-json', action='store_true', help='Import all JSON/JSONL session logs into the SQLite usage database')
+    parser.add_argument('--since', type=parse_time, help='Only include requests at or after this ISO date/time (UTC unless it has an offset)')
+    parser.add_argument('--until', type=parse_time, help='Only include requests before this ISO date/time (UTC unless it has an offset)')
+    parser.add_argument('--model', type=str, help='Only include requests for this model')
+    parser.add_argument('--provider', type=str, help='Only include requests for this provider')
+    parser.add_argument('--rollup', choices=list(ROLLUP_GRANULARITIES), help='Stream all logs into hourly/daily/weekly buckets by provider and model')
+    parser.add_argument('--format', choices=['table', 'csv', 'jsonl'], default='table', help='Output format for --rollup')
     args = parser.parse_args()
     
     logs_dir = Path("token_logs")
@@ -340,17 +3270,121 @@ def main():
         print("No logs directory found")
         return
     
+    if args.upgrade:
+        upgraded = upgrade_sessions(logs_dir)
+        print(f"Upgraded {upgraded} legacy session file(s)")
+        return
+    
+    if args.compact:
+        compacted = compact_sessions(logs_dir)
+        retention = args.retention_days * 86400 if args.retention_days is not None else None
+        try:
+            result = compact_all_segments(logs_dir, retention, args.compression)
+        except RuntimeError as e:
+            print(f"Error compacting segments: {e}", file=sys.stderr)
+            return
+        print(f"Compacted {compacted} shard(s); merged {result['read']} segment(s) into {result['written']}")
+        if retention is not None:
+            print(f"Expired {result['expired']} request(s) into {rollups_path(logs_dir)}")
+        return
+    
+    if args.rebuild_manifest:
+        rebuilt = rebuild_manifest(logs_dir)
+        print(f"Rebuilt manifest with {rebuilt} session(s)")
+        return
+    
+    if args.recost:
+        registry = get_pricing_registry(Path(args.pricing) if args.pricing else None)
+        recosted = recost_sessions(logs_dir, registry, write=not args.dry_run, session_id=args.session)
+        print(f"Re-costed {recosted} session(s)" + (" (dry run)" if args.dry_run else ""))
+        return
+    
+    # Filters are answered by the usage database, except for --rollup, which
+    # applies them while streaming the logs
+    filters = {"since": args.since, "until": args.until, "model": args.model, "provider": args.provider}
+    if args.rollup:
+        rollup = UsageRollup(args.rollup)
+        if args.backend == "sqlite":
+            store = SqliteUsageStore(logs_dir / "usage.db")
+            try:
+                for request in store.iter_requests(session_id=args.session, **filters):
+                    rollup.add(request)
+            finally:
+                store.close()
+        else:
+            for session_id, request in iter_all_requests(logs_dir, args.since, args.until):
+                if ((args.session is None or session_id == args.session)
+                        and (args.model is None or request["model"] == args.model)
+                        and (args.provider is None or request["provider"] == args.provider)):
+                    rollup.add(request)
+            # Requests dropped by --retention-days survive as hourly rows,
+            # filtered to the hour
+            for row in read_rollups(logs_dir):
+                if ((args.session is None or row["session_id"] == args.session)
+                        and (args.since is None or row["bucket"] >= args.since)
+                        and (args.until is None or row["bucket"] < args.until)
+                        and (args.model is None or row["model"] == args.model)
+                        and (args.provider is None or row["provider"] == args.provider)):
+                    rollup.add_rollup(row)
+        write_rollup(rollup.rows(), args.format)
+        return
+    
+    # Without a usage database, a time window on one session is read from
+    # its logs, skipping segments outside the window
+    logs_window = (args.session is not None and args.model is None and args.provider is None
+                   and not (logs_dir / "usage.db").exists())
+    use_store = (args.import_json or args.backend == "sqlite"
+                 or (any(v is not None for v in filters.values()) and not logs_window))
+    if use_store:
+        db_path = logs_dir / "usage.db"
+        if not db_path.exists() and not args.import_json:
+            print(f"Usage database not found: {db_path} (run with --import-json first)")
+            return
+        store = SqliteUsageStore(db_path)
+        try:
+            if args.import_json:
+                imported = store.import_sessions(logs_dir)
+                print(f"Imported {imported} request(s) into {db_path}")
+                return
+            if args.session:
+                summary = store.summarize(store.session_start(args.session), session_id=args.session, **filters)
+                requests = list(store.iter_requests(session_id=args.session, **filters)) if args.requests else []
+                display_session_summary(
+                    {"session_id": args.session, "summary": summary, "requests": requests},
+                    args.requests
+                )
+                if args.analytics:
+                    display_session_analytics(RequestColumns.from_records(
+                        store.iter_requests(session_id=args.session, **filters)
+                    ))
+            else:
+                list_store_sessions(store, **filters)
+        finally:
+            store.close()
+        return
+    
     if args.session:
-        session_file = logs_dir / f"session_{args.session}.json"
-        if not session_file.exists():
-            print(f"Session file not found: {session_file}")
+        manifest = read_manifest(logs_dir) or {}
+        if args.session in manifest:
+            session_file = session_log_path(logs_dir, args.session)
+            if not session_exists(session_file):
+                session_file = legacy_session_path(logs_dir, args.session)
+        else:
+            session_file = find_session_files(logs_dir).get(args.session)
+        if session_file is None or not (session_file.exists() or session_exists(session_file)):
+            print(f"Session file not found: {session_log_path(logs_dir, args.session)}")
             return
         
-        session_data = load_session(session_file)
+        streaming = args.requests and session_file.suffix == ".jsonl"
+        session_data = load_session(session_file, stream_requests=streaming, since=args.since, until=args.until)
         if session_data:
             display_session_summary(session_data, args.requests)
+            if args.analytics:
+                requests = (iter_session_requests(session_file, args.since, args.until) if streaming
+                            else session_data["requests"])
+                display_session_analytics(RequestColumns.from_records(requests))
     else:
         list_sessions(logs_dir)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
\ No newline at end of file